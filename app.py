@@ -1,22 +1,172 @@
-from fastapi import FastAPI, Request, HTTPException, Query, Response
-from fastapi.responses import FileResponse, PlainTextResponse
+from fastapi import (
+    FastAPI,
+    File,
+    Form,
+    Request,
+    HTTPException,
+    Query,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
 from typing import Optional, List
+import bootstrap
+import config
+import dns_cache
+import dns_listener
+import edns
+import dns_wire
+import doh_pool
+import dot_pool
 import dns_tester
+import history
+import latency_stats
+import metrics
+import ratelimit
+import shared_state
+import singleflight
+import system_resolver
+import forwarder
+import upstreams
 import dns.message
+import dns.rcode
 import dns.rdatatype
 import base64
 import asyncio
+import json
+import time
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warm_up_task
+    listener = None
+    if config.DNS_LISTEN:
+        listener = dns_listener.DNSListener(
+            lambda wire, client_ip: forward_dns_query(wire, client_ip=client_ip),
+            config.DNS_LISTEN_HOST,
+            config.DNS_LISTEN_PORT,
+            reuse_port=config.WORKERS > 1,
+            idle_timeout=config.DNS_LISTEN_IDLE_TIMEOUT,
+            max_connections=config.DNS_LISTEN_MAX_CONNECTIONS,
+            max_pipelined=config.DNS_LISTEN_MAX_PIPELINED,
+        )
+        await listener.start()
+    # Resolve DoH/DoT hostnames before the first query needs them.
+    bootstrap_hosts = [
+        bootstrap.upstream_host(s["type"], s["server"]) for s in DEFAULT_SERVERS
+    ]
+    bootstrap_task = asyncio.create_task(
+        bootstrap.addresses.run([host for host in bootstrap_hosts if host])
+    )
+    if config.WARMUP:
+        warm_up_task = asyncio.create_task(_warm_up())
+    history_task = None
+    if history_store is not None:
+        history_task = asyncio.create_task(
+            history.run_checks(history_store, history_checks, _history_probe)
+        )
+
+    yield
+
+    bootstrap_task.cancel()
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    if history_task is not None:
+        history_task.cancel()
+    if listener is not None:
+        await listener.stop()
+    for task in list(prefetch_tasks):
+        task.cancel()
+    await doh_pool.pool.aclose()
+    await dot_pool.pool.aclose()
+    await dot_pool.tcp_pool.aclose()
+    if shared_store is not None:
+        shared_store.close()
+    if history_store is not None:
+        await history_store.close()
+
 
 app = FastAPI(
     title="EZDNSTester API",
     description="DNS Resolution Tester with DoH server and CLI query support",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.mount("/img", StaticFiles(directory="img"), name="img")
 
+# State shared with the other worker processes, if there are any.
+shared_store = (
+    shared_state.SharedStore(config.SHARED_STATE_PATH)
+    if config.SHARED_STATE_PATH
+    else None
+)
+
+upstream_health = upstreams.UpstreamHealth(
+    alpha=config.LATENCY_EWMA_ALPHA,
+    failure_threshold=config.BREAKER_FAILURE_THRESHOLD,
+    cooldown=config.BREAKER_COOLDOWN,
+    shared=shared_store,
+    refresh_interval=config.SHARED_HEALTH_REFRESH,
+)
+
+response_cache = dns_cache.DNSCache(
+    max_entries=config.CACHE_MAX_ENTRIES,
+    max_ttl=config.CACHE_MAX_TTL,
+    max_negative_ttl=config.CACHE_MAX_NEGATIVE_TTL,
+    stale_ttl=config.CACHE_STALE_TTL,
+    stale_answer_ttl=config.CACHE_STALE_ANSWER_TTL,
+    prefetch_min_hits=config.PREFETCH_MIN_HITS,
+    prefetch_window=config.PREFETCH_WINDOW,
+    shared=shared_store,
+)
+
+# What happens to the EDNS Client Subnet of forwarded queries.
+ecs_policy = edns.EcsPolicy(
+    config.ECS_MODE,
+    ipv4_prefix=config.ECS_PREFIX_V4,
+    ipv6_prefix=config.ECS_PREFIX_V6,
+)
+
+# Admission control for every query sent upstream, forwarded or probed.
+upstream_scheduler = ratelimit.UpstreamScheduler(
+    max_in_flight=config.MAX_IN_FLIGHT,
+    max_backlog=config.MAX_BACKLOG,
+    max_wait=config.MAX_QUEUE_WAIT,
+    default_qps=config.UPSTREAM_QPS,
+    default_burst=config.UPSTREAM_BURST,
+)
+
+# Scheduled probes and the latency history they are recorded in.
+history_checks = history.parse_checks(config.HISTORY_CHECKS, config.HISTORY_INTERVAL)
+history_store = (
+    history.HistoryStore(
+        config.HISTORY_PATH,
+        raw_retention=config.HISTORY_RAW_DAYS * 86400,
+        minute_retention=config.HISTORY_MINUTE_DAYS * 86400,
+        hour_retention=config.HISTORY_HOUR_DAYS * 86400,
+    )
+    if history_checks
+    else None
+)
+
+# Startup warm-up of the upstream connection pools, see /api/ready.
+warm_up_task: Optional[asyncio.Task] = None
+
+# Upstream lookups in progress, shared by identical concurrent queries.
+upstream_flights = singleflight.SingleFlight()
+# Background cache refreshes, referenced until they finish.
+prefetch_tasks: set = set()
+
 
 class TestRequest(BaseModel):
     type: str
@@ -24,6 +174,24 @@ class TestRequest(BaseModel):
     domain: str
     proxy: Optional[str] = None
     record_type: Optional[str] = "A"
+    samples: Optional[int] = None
+    warmup: Optional[int] = None
+    cache_bust: Optional[bool] = False
+    dnssec: Optional[bool] = False
+    ecs: Optional[str] = None
+
+
+class StreamServer(BaseModel):
+    type: str
+    server: str
+    name: Optional[str] = None
+
+
+class StreamTestRequest(BaseModel):
+    domain: str
+    servers: List[StreamServer]
+    proxy: Optional[str] = None
+    record_type: Optional[str] = "A"
 
 
 class QueryRequest(BaseModel):
@@ -31,6 +199,20 @@ class QueryRequest(BaseModel):
     servers: Optional[List[str]] = None
     record_type: Optional[str] = "A"
     proxy: Optional[str] = None
+    samples: Optional[int] = None
+    warmup: Optional[int] = None
+    cache_bust: Optional[bool] = False
+    dnssec: Optional[bool] = False
+    ecs: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    domains: List[str]
+    servers: Optional[List[str]] = None
+    record_type: Optional[str] = "A"
+    proxy: Optional[str] = None
+    concurrency: Optional[int] = None
+    rate_limit: Optional[float] = None
 
 
 DEFAULT_SERVERS = [
@@ -48,6 +230,16 @@ DEFAULT_SERVERS = [
     {"name": "Cloudflare-UDP", "server": "1.1.1.1", "type": "udp"},
 ]
 
+upstreams.configure(DEFAULT_SERVERS)
+
+# Rate limits of the default servers apply to every query sent to them; the
+# ``#qps=..`` suffix of a request can only make them stricter.
+for _server in DEFAULT_SERVERS:
+    if _server.get("qps") is not None:
+        upstream_scheduler.configure(
+            upstreams.upstream_key(_server), _server["qps"], _server.get("burst")
+        )
+
 
 @app.get("/", response_class=FileResponse)
 async def read_root():
@@ -56,147 +248,310 @@ async def read_root():
 
 @app.post("/api/test")
 async def run_test(test_req: TestRequest):
-    server = test_req.server.split("#")[0]
+    server, limits = upstreams.split_limits(test_req.server)
     record_type = test_req.record_type or "A"
 
-    if test_req.type == "local":
-        return dns_tester.test_local(test_req.domain, record_type)
-    elif test_req.type == "udp":
-        return dns_tester.test_udp(server, test_req.domain, record_type)
-    elif test_req.type == "dot":
-        return dns_tester.test_dot(server, test_req.domain, record_type)
-    elif test_req.type == "doh":
-        return await dns_tester.test_doh(
-            server, test_req.domain, test_req.proxy, record_type
-        )
-    else:
+    if test_req.type not in ("local", "udp", "dot", "doh"):
         raise HTTPException(status_code=400, detail="Invalid test type")
+    parsed = {"type": test_req.type, "server": server, **limits}
+    _check_server(parsed)
+    _check_benchmark_options(test_req.samples, test_req.warmup)
+    _check_ecs(test_req.ecs)
+
+    return await _run_probe(
+        parsed,
+        test_req.domain,
+        record_type,
+        test_req.proxy,
+        test_req.samples,
+        test_req.warmup,
+        test_req.cache_bust,
+        bool(test_req.dnssec),
+        test_req.ecs,
+    )
+
+
+@app.post("/api/test/stream")
+async def run_test_stream(stream_req: StreamTestRequest):
+    """Probe every server concurrently, pushing each result as an SSE event."""
+    record_type = stream_req.record_type or "A"
+
+    async def probe(index: int, s: StreamServer) -> dict:
+        server, limits = upstreams.split_limits(s.server)
+        parsed = {"type": s.type, "server": server, **limits}
+        if s.type not in ("local", "udp", "dot", "doh"):
+            result = {"status": "error", "error": "Invalid test type"}
+        else:
+            try:
+                result = await _run_probe(
+                    parsed, stream_req.domain, record_type, stream_req.proxy
+                )
+            except Exception as e:
+                result = {"status": "error", "error": str(e)}
+        return {**result, "index": index, "name": s.name, "type": s.type}
+
+    async def events():
+        tasks = [
+            asyncio.create_task(probe(i, s)) for i, s in enumerate(stream_req.servers)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                yield f"event: result\ndata: {json.dumps(result)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 def parse_server_string(server_str: str) -> dict:
-    """Parse server string: 'type://server' or plain 'server' (defaults to UDP)."""
+    """Parse server string: 'type://server' or plain 'server' (defaults to UDP).
+
+    An optional '#qps=..&burst=..' suffix adds a (stricter) rate limit.
+    """
+    server_str, limits = upstreams.split_limits(server_str)
     if server_str.startswith("local://") or server_str == "local":
-        return {"type": "local", "server": "local"}
+        return {"type": "local", "server": "local", **limits}
     elif server_str.startswith("doh://"):
-        return {"type": "doh", "server": server_str[6:]}
+        return {"type": "doh", "server": server_str[6:], **limits}
     elif server_str.startswith("udp://"):
-        return {"type": "udp", "server": server_str[6:]}
+        return {"type": "udp", "server": server_str[6:], **limits}
     elif server_str.startswith("dot://"):
-        return {"type": "dot", "server": server_str[6:]}
+        return {"type": "dot", "server": server_str[6:], **limits}
     else:
-        return {"type": "udp", "server": server_str}
+        return {"type": "udp", "server": server_str, **limits}
 
 
 async def forward_dns_query(
-    wire_data: bytes, upstream: Optional[str] = None, proxy: Optional[str] = None
+    wire_data: bytes,
+    upstream: Optional[str] = None,
+    proxy: Optional[str] = None,
+    timer: Optional[metrics.StageTimer] = None,
+    client_ip: Optional[str] = None,
 ) -> bytes:
+    """Answer a wire-format query from the cache or an upstream.
+
+    Concurrent queries for the same question and upstream share a single
+    upstream lookup. Popular cached answers are refreshed in the background
+    shortly before they expire, and when the upstream lookup fails an
+    expired answer is served instead of SERVFAIL (RFC 8767). Stage timings
+    (parse, cache, upstream, ...) are added to ``timer``.
+
+    The query's EDNS Client Subnet is handled by ``ecs_policy``, which may
+    synthesize one from ``client_ip``; answers are cached and shared only
+    between queries with the same EDNS, DO/CD bits and subnet.
+    """
+    if timer is None:
+        timer = metrics.StageTimer(metrics.FORWARD_STAGE_DURATION)
+    start_time = time.perf_counter()
+    rcode = "SERVFAIL"
 
     try:
-        query = dns.message.from_wire(wire_data)
-        domain = str(query.question[0].name)
-        rdtype = query.question[0].rdtype
-        rdtype_str = dns.rdatatype.to_text(rdtype)
-
-        if upstream:
-            parsed = parse_server_string(upstream)
-            server_type = parsed["type"]
-            server = parsed["server"]
-
-            if server_type == "local":
-                result = dns_tester.test_local(domain.rstrip("."), rdtype_str)
-            elif server_type == "udp":
-                result = dns_tester.test_udp(server, domain.rstrip("."), rdtype_str)
-            elif server_type == "dot":
-                result = dns_tester.test_dot(server, domain.rstrip("."), rdtype_str)
-            elif server_type == "doh":
-                result = await dns_tester.test_doh(
-                    server, domain.rstrip("."), proxy, rdtype_str
+        with timer.stage("parse"):
+            query_id, question = dns_wire.parse_query(wire_data)
+            # The name as this client spelled it, for answers first fetched
+            # for someone else.
+            qname = wire_data[12 : 12 + len(question[0])]
+            prepared = ecs_policy.prepare(wire_data, client_ip)
+
+        key = dns_cache.DNSCache.make_key(question, upstream, prepared.partition)
+        # Where an answer the upstream did not tailor to the subnet is kept.
+        global_key = None
+        if prepared.shared_partition is not None:
+            global_key = dns_cache.DNSCache.make_key(
+                question, upstream, prepared.shared_partition
+            )
+        if config.CACHE_ENABLED:
+            with timer.stage("cache"):
+                cached = response_cache.get(key, query_id, global_key, qname)
+            metrics.FORWARD_CACHE.inc(result="miss" if cached is None else "hit")
+            if cached is not None:
+                if response_cache.should_prefetch(key) or (
+                    global_key is not None
+                    and response_cache.should_prefetch(global_key)
+                ):
+                    _start_prefetch(prepared, key, global_key, upstream, proxy)
+                rcode = dns.rcode.to_text(forwarder.response_rcode(cached))
+                return cached
+
+        error = None
+        response_wire = None
+        try:
+            with timer.stage("upstream"):
+                response_wire, shared = await upstream_flights.do(
+                    key,
+                    lambda: _lookup_upstream(
+                        prepared, key, global_key, upstream, proxy, timer
+                    ),
                 )
-            else:
-                raise ValueError(f"Unknown server type: {server_type}")
-        else:
-            result = None
-            for s in DEFAULT_SERVERS:
-                server_type = s["type"]
-                server = s["server"]
-                try:
-                    if server_type == "local":
-                        result = dns_tester.test_local(domain.rstrip("."), rdtype_str)
-                    elif server_type == "udp":
-                        result = dns_tester.test_udp(
-                            server, domain.rstrip("."), rdtype_str
-                        )
-                    elif server_type == "dot":
-                        result = dns_tester.test_dot(
-                            server, domain.rstrip("."), rdtype_str
-                        )
-                    elif server_type == "doh":
-                        result = await dns_tester.test_doh(
-                            server, domain.rstrip("."), proxy, rdtype_str
-                        )
-
-                    if (
-                        result
-                        and result.get("status") == "success"
-                        and result.get("answers")
-                    ):
-                        break
-                except:
-                    continue
-
-            if not result:
-                result = {"status": "error", "error": "All upstream servers failed"}
-
-        response = dns.message.make_response(query)
-
-        if result.get("status") == "success" and result.get("answers"):
-            for ans in result["answers"]:
-                if ans.startswith("["):
-                    type_end = ans.index("]")
-                    ans_type = ans[1:type_end]
-                    ans_value = ans[type_end + 2 :]
-
-                    ans_rdtype = dns.rdatatype.from_text(ans_type)
-                    rrset = response.find_rrset(
-                        response.answer,
-                        query.question[0].name,
-                        dns.rdataclass.IN,
-                        ans_rdtype,
-                        create=True,
-                    )
-                    rd = dns.rdata.from_text(dns.rdataclass.IN, ans_rdtype, ans_value)
-                    rrset.add(rd)
-        else:
-            response.set_rcode(dns.rcode.SERVFAIL)
+            if shared:
+                metrics.FORWARD_COALESCED.inc()
+            response_wire = bytearray(forwarder.with_id(response_wire, query_id))
+            dns_wire.restore_qname(response_wire, qname)
+            response_wire = bytes(response_wire)
+        except Exception as e:
+            error = e
+
+        if error is not None or (
+            forwarder.response_rcode(response_wire) not in forwarder.ACCEPTED_RCODES
+        ):
+            stale = None
+            if config.CACHE_ENABLED:
+                stale = response_cache.get_stale(key, query_id, global_key, qname)
+            if stale is not None:
+                metrics.FORWARD_STALE.inc()
+                response_wire = stale
+            elif error is not None:
+                raise error
 
-        return response.to_wire()
+        rcode = dns.rcode.to_text(forwarder.response_rcode(response_wire))
+        return response_wire
 
     except Exception as e:
         try:
-            query = dns.message.from_wire(wire_data)
-            response = dns.message.make_response(query)
-            response.set_rcode(dns.rcode.SERVFAIL)
-            return response.to_wire()
+            with timer.stage("servfail"):
+                query = dns.message.from_wire(wire_data)
+                response = dns.message.make_response(query)
+                response.set_rcode(dns.rcode.SERVFAIL)
+                return response.to_wire()
         except:
+            rcode = "invalid"
             raise HTTPException(status_code=500, detail=str(e))
 
+    finally:
+        metrics.FORWARD_QUERIES.inc(rcode=rcode)
+        metrics.FORWARD_DURATION.observe(time.perf_counter() - start_time)
+
+
+async def _lookup_upstream(
+    prepared: edns.Prepared,
+    key: tuple,
+    global_key: Optional[tuple],
+    upstream: Optional[str],
+    proxy: Optional[str],
+    timer: metrics.StageTimer,
+) -> bytes:
+    """Forward to ``upstream`` (or race the defaults) and cache the answer.
+
+    Answers with ECS scope 0 to a synthesized subnet are cached under
+    ``global_key``, for every client subnet.
+    """
+    wire_data = prepared.wire
+    if upstream:
+        parsed = parse_server_string(upstream)
+        upstream_key = upstreams.upstream_key(parsed)
+        if not upstream_health.allow(upstream_key):
+            raise forwarder.UpstreamError(f"Circuit open for {upstream_key}")
+        response_wire = await forwarder.forward_tracked(
+            wire_data,
+            parsed,
+            proxy,
+            health=upstream_health,
+            scheduler=upstream_scheduler,
+        )
+    else:
+        response_wire = await forwarder.race(
+            wire_data,
+            DEFAULT_SERVERS,
+            proxy,
+            fanout=config.RACE_FANOUT,
+            hedge_delay=config.HEDGE_DELAY,
+            health=upstream_health,
+            scheduler=upstream_scheduler,
+        )
+
+    response_wire, is_global = ecs_policy.finish(response_wire, prepared)
+    if config.CACHE_ENABLED:
+        with timer.stage("cache_store"):
+            if is_global and global_key is not None:
+                key = global_key
+            response_cache.put(key, response_wire)
+    return response_wire
+
+
+def _start_prefetch(
+    prepared: edns.Prepared,
+    key: tuple,
+    global_key: Optional[tuple],
+    upstream: Optional[str],
+    proxy: Optional[str],
+) -> None:
+    """Refresh the cache entry for ``key`` without making a client wait."""
+    metrics.FORWARD_PREFETCHES.inc()
+    task = asyncio.ensure_future(
+        upstream_flights.do(
+            key,
+            lambda: _lookup_upstream(
+                prepared, key, global_key, upstream, proxy, metrics.StageTimer()
+            ),
+        )
+    )
+    prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_done)
+
+
+def _prefetch_done(task: asyncio.Task) -> None:
+    prefetch_tasks.discard(task)
+    if not task.cancelled():
+        # A failed refresh just lets the entry expire normally.
+        task.exception()
+
+
+def _debug_timings(debug: Optional[bool]) -> bool:
+    return bool(debug) or config.DEBUG_TIMINGS
+
+
+def _client_ip(request: Request) -> Optional[str]:
+    """Address of a DoH client, as used for synthesized ECS options."""
+    if config.ECS_CLIENT_IP_HEADER:
+        forwarded = request.headers.get(config.ECS_CLIENT_IP_HEADER)
+        if forwarded:
+            # X-Forwarded-For style lists start with the original client.
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+
+def _timing_headers(timer: metrics.StageTimer, debug: Optional[bool]) -> dict:
+    if not _debug_timings(debug):
+        return {}
+    return {"Server-Timing": timer.server_timing()}
+
 
 @app.get("/dns-query")
 async def doh_get(
+    request: Request,
     dns: str = Query(..., description="Base64url encoded DNS query"),
     upstream: Optional[str] = Query(None, description="Upstream DNS server"),
     proxy: Optional[str] = Query(None, description="Proxy for DoH upstream"),
+    debug: Optional[bool] = Query(
+        False, description="Report per-stage timings in a Server-Timing header"
+    ),
 ):
     """DoH GET endpoint (RFC 8484)."""
+    _check_servers([upstream] if upstream else None)
+    timer = metrics.StageTimer(metrics.FORWARD_STAGE_DURATION)
     try:
-        padding = 4 - len(dns) % 4
-        if padding != 4:
-            dns += "=" * padding
-        wire_data = base64.urlsafe_b64decode(dns)
+        with timer.stage("decode"):
+            padding = 4 - len(dns) % 4
+            if padding != 4:
+                dns += "=" * padding
+            wire_data = base64.urlsafe_b64decode(dns)
 
-        response_wire = await forward_dns_query(wire_data, upstream, proxy)
+        response_wire = await forward_dns_query(
+            wire_data, upstream, proxy, timer, _client_ip(request)
+        )
 
-        return Response(content=response_wire, media_type="application/dns-message")
+        return Response(
+            content=response_wire,
+            media_type="application/dns-message",
+            headers=_timing_headers(timer, debug),
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid DNS query: {str(e)}")
 
@@ -206,6 +561,9 @@ async def doh_post(
     request: Request,
     upstream: Optional[str] = Query(None, description="Upstream DNS server"),
     proxy: Optional[str] = Query(None, description="Proxy for DoH upstream"),
+    debug: Optional[bool] = Query(
+        False, description="Report per-stage timings in a Server-Timing header"
+    ),
 ):
     """DoH POST endpoint (RFC 8484)."""
     content_type = request.headers.get("content-type", "")
@@ -213,11 +571,20 @@ async def doh_post(
         raise HTTPException(
             status_code=415, detail="Content-Type must be application/dns-message"
         )
+    _check_servers([upstream] if upstream else None)
 
-    wire_data = await request.body()
-    response_wire = await forward_dns_query(wire_data, upstream, proxy)
+    timer = metrics.StageTimer(metrics.FORWARD_STAGE_DURATION)
+    with timer.stage("body"):
+        wire_data = await request.body()
+    response_wire = await forward_dns_query(
+        wire_data, upstream, proxy, timer, _client_ip(request)
+    )
 
-    return Response(content=response_wire, media_type="application/dns-message")
+    return Response(
+        content=response_wire,
+        media_type="application/dns-message",
+        headers=_timing_headers(timer, debug),
+    )
 
 
 @app.get("/api/query")
@@ -229,14 +596,44 @@ async def cli_query_get(
     format: Optional[str] = Query(
         "json", description="Output format: json, text, simple"
     ),
+    samples: Optional[int] = Query(
+        None, description="Benchmark mode: number of timed samples per server"
+    ),
+    warmup: Optional[int] = Query(
+        None, description="Benchmark mode: untimed warm-up queries per server"
+    ),
+    cache_bust: Optional[bool] = Query(
+        False, description="Benchmark mode: query random subdomains"
+    ),
+    dnssec: Optional[bool] = Query(
+        False, description="Set the DO bit and report the AD bit of answers"
+    ),
+    ecs: Optional[str] = Query(
+        None, description="EDNS Client Subnet to send, e.g. 203.0.113.0/24"
+    ),
+    debug: Optional[bool] = Query(False, description="Report per-stage timings"),
 ):
     """CLI-friendly DNS query API (GET)."""
-    return await _perform_query(domain, server, type, proxy, format)
+    return await _perform_query(
+        domain,
+        server,
+        type,
+        proxy,
+        format,
+        samples,
+        warmup,
+        cache_bust,
+        debug,
+        dnssec,
+        ecs,
+    )
 
 
 @app.post("/api/query")
 async def cli_query_post(
-    query_req: QueryRequest, format: Optional[str] = Query("json")
+    query_req: QueryRequest,
+    format: Optional[str] = Query("json"),
+    debug: Optional[bool] = Query(False),
 ):
     """CLI-friendly DNS query API (POST)."""
     return await _perform_query(
@@ -245,47 +642,297 @@ async def cli_query_post(
         query_req.record_type,
         query_req.proxy,
         format,
+        query_req.samples,
+        query_req.warmup,
+        query_req.cache_bust,
+        debug,
+        query_req.dnssec,
+        query_req.ecs,
+    )
+
+
+def _check_server(server: dict) -> None:
+    try:
+        upstreams.check_server(server)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid server: {e}")
+
+
+def _check_servers(servers: Optional[List[str]]) -> None:
+    for server in servers or ():
+        _check_server(parse_server_string(server))
+
+
+def _check_ecs(ecs: Optional[str]) -> None:
+    if not ecs:
+        return
+    try:
+        edns.ClientSubnet.from_text(ecs)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid ECS subnet {ecs!r}")
+
+
+def _check_benchmark_options(samples: Optional[int], warmup: Optional[int]) -> None:
+    limit = config.BENCHMARK_MAX_SAMPLES
+    if samples is not None and not 1 <= samples <= limit:
+        raise HTTPException(
+            status_code=400, detail=f"samples must be between 1 and {limit}"
+        )
+    if warmup is not None and not 0 <= warmup <= limit:
+        raise HTTPException(
+            status_code=400, detail=f"warmup must be between 0 and {limit}"
+        )
+
+
+async def _run_probe(
+    parsed: dict,
+    domain: str,
+    record_type: str,
+    proxy: Optional[str],
+    samples: Optional[int] = None,
+    warmup: Optional[int] = None,
+    cache_bust: Optional[bool] = None,
+    dnssec: bool = False,
+    ecs: Optional[str] = None,
+) -> dict:
+    """Run the dns_tester probe for a parsed server and record its health.
+
+    With ``samples`` set, run a repeated-sample benchmark instead. ``dnssec``
+    and ``ecs`` are passed on to the probe. Every upstream query of the probe
+    (one per record type and sample) takes a slot of the upstream scheduler;
+    when one is refused, an error result is returned and health is left
+    alone.
+    """
+    key = upstreams.upstream_key(parsed)
+
+    def slot():
+        return upstream_scheduler.slot(key, parsed.get("qps"), parsed.get("burst"))
+
+    try:
+        result = await _probe(
+            parsed,
+            domain,
+            record_type,
+            proxy,
+            samples,
+            warmup,
+            cache_bust,
+            dnssec,
+            ecs,
+            slot,
+        )
+    except ratelimit.Overloaded as e:
+        upstream_health.release_probe(key)
+        return {"status": "error", "error": str(e)}
+
+    if parsed["type"] in ("local", "udp", "dot", "doh"):
+        _record_probe(key, result)
+    return result
+
+
+async def _probe(
+    parsed: dict,
+    domain: str,
+    record_type: str,
+    proxy: Optional[str],
+    samples: Optional[int],
+    warmup: Optional[int],
+    cache_bust: Optional[bool],
+    dnssec: bool = False,
+    ecs: Optional[str] = None,
+    slot=None,
+) -> dict:
+    if samples:
+        return await dns_tester.benchmark(
+            parsed["type"],
+            parsed["server"],
+            domain,
+            record_type,
+            proxy,
+            samples=samples,
+            warmup=warmup or 0,
+            cache_bust=bool(cache_bust),
+            dnssec=dnssec,
+            ecs=ecs,
+            slot=slot,
+        )
+    return await dns_tester.run_probe(
+        parsed["type"],
+        parsed["server"],
+        domain,
+        record_type,
+        proxy,
+        dnssec=dnssec,
+        ecs=ecs,
+        slot=slot,
+    )
+
+
+async def _history_probe(check: history.Check) -> tuple[str, Optional[float], bool]:
+    """Run a scheduled check for ``history.run_checks``."""
+    parsed = parse_server_string(check.server)
+    result = await _run_probe(parsed, check.domain, check.rdtype, None)
+    ok = result.get("status") == "success"
+    return upstreams.upstream_key(parsed), result.get("latency_ms"), ok
+
+
+def _record_probe(key: str, result: dict) -> None:
+    """Feed a dns_tester result into the upstream health tracker."""
+    if result.get("status") == "success":
+        # The fastest single round trip, so multi-type probes compare fairly.
+        latencies = (result.get("type_latency_ms") or {}).values()
+        upstream_health.record_success(
+            key, min(latencies, default=result.get("latency_ms", 0))
+        )
+    else:
+        upstream_health.record_failure(key, result.get("error"))
+
+
+def _format_type_latency(result: dict) -> str:
+    return ", ".join(
+        f"{rdtype} {latency} ms"
+        for rdtype, latency in result.get("type_latency_ms", {}).items()
+    )
+
+
+def _format_attempts(result: dict) -> str:
+    return "; ".join(
+        f"{rdtype} "
+        + " -> ".join(
+            f"{a['transport']} {a['latency_ms']} ms"
+            + (" (truncated)" if a.get("truncated") else "")
+            for a in tries
+        )
+        for rdtype, tries in result.get("attempts", {}).items()
     )
 
 
+def _format_samples(result: dict) -> str:
+    return (
+        f"{result['received']}/{result['samples']} received, "
+        f"loss {result['loss'] * 100:.1f}%"
+    )
+
+
+def _format_stats(result: dict) -> str:
+    stats = result["stats"]
+    return (
+        f"min {stats['min_ms']} / mean {stats['mean_ms']} / p95 {stats['p95_ms']} ms, "
+        f"stddev {stats['stddev_ms']} ms, jitter {stats['jitter_ms']} ms"
+    )
+
+
+def _format_edns(result: dict) -> str:
+    parts = []
+    if "authenticated" in result:
+        parts.append("AD set" if result["authenticated"] else "AD not set")
+    if "ecs_scope" in result:
+        parts.append(f"ECS scope /{result['ecs_scope']}")
+    return ", ".join(parts)
+
+
+OUTPUT_FORMATS = ("json", "text", "simple")
+
+
 async def _perform_query(
     domain: str,
     servers: Optional[List[str]],
     record_type: Optional[str],
     proxy: Optional[str],
     output_format: Optional[str],
+    samples: Optional[int] = None,
+    warmup: Optional[int] = None,
+    cache_bust: Optional[bool] = None,
+    debug: Optional[bool] = None,
+    dnssec: Optional[bool] = None,
+    ecs: Optional[str] = None,
+):
+    """Perform DNS query across multiple servers, timing each stage."""
+    timer = metrics.StageTimer()
+    start_time = time.perf_counter()
+    output = await _query_servers(
+        domain,
+        servers,
+        record_type,
+        proxy,
+        output_format,
+        samples,
+        warmup,
+        cache_bust,
+        timer,
+        bool(dnssec),
+        ecs,
+    )
+    elapsed = time.perf_counter() - start_time
+    timer.add("render", max(elapsed - timer.timings.get("probe", 0.0), 0.0))
+    # Unknown formats are answered as JSON; they must not become series.
+    label = output_format or "json"
+    metrics.CLI_QUERIES.inc(format=label if label in OUTPUT_FORMATS else "other")
+    metrics.CLI_QUERY_DURATION.observe(elapsed)
+
+    if not _debug_timings(debug):
+        return output
+    headers = _timing_headers(timer, debug)
+    if isinstance(output, Response):
+        output.headers.update(headers)
+        return output
+    return JSONResponse({**output, "timings_ms": timer.as_ms()}, headers=headers)
+
+
+async def _query_servers(
+    domain: str,
+    servers: Optional[List[str]],
+    record_type: Optional[str],
+    proxy: Optional[str],
+    output_format: Optional[str],
+    samples: Optional[int],
+    warmup: Optional[int],
+    cache_bust: Optional[bool],
+    timer: metrics.StageTimer,
+    dnssec: bool = False,
+    ecs: Optional[str] = None,
 ):
-    """Perform DNS query across multiple servers."""
+    """Probe every server and format the results."""
     if not record_type:
         record_type = "A"
     if not output_format:
         output_format = "json"
+    _check_benchmark_options(samples, warmup)
+    _check_ecs(ecs)
+    _check_servers(servers)
 
+    skip_open_circuits = not servers
     if not servers:
-        servers = [f"{s['type']}://{s['server']}" for s in DEFAULT_SERVERS[:5]]
+        # Their configured rate limits are looked up by this key.
+        servers = [upstreams.upstream_key(s) for s in DEFAULT_SERVERS[:5]]
 
     results = []
 
     async def query_server(server_str: str):
         parsed = parse_server_string(server_str)
         server_type = parsed["type"]
-        server = parsed["server"]
 
-        try:
-            if server_type == "local":
-                result = dns_tester.test_local(domain, record_type)
-            elif server_type == "udp":
-                result = dns_tester.test_udp(server, domain, record_type)
-            elif server_type == "dot":
-                result = dns_tester.test_dot(server, domain, record_type)
-            elif server_type == "doh":
-                result = await dns_tester.test_doh(server, domain, proxy, record_type)
-            else:
-                result = {
-                    "status": "error",
-                    "error": f"Unknown server type: {server_type}",
-                }
+        key = upstreams.upstream_key(parsed)
+        if skip_open_circuits and not upstream_health.allow(key):
+            return {
+                "server": server_str,
+                "type": server_type,
+                "status": "error",
+                "error": "Circuit open: upstream is failing, skipped",
+            }
 
+        try:
+            result = await _run_probe(
+                parsed,
+                domain,
+                record_type,
+                proxy,
+                samples,
+                warmup,
+                cache_bust,
+                dnssec,
+                ecs,
+            )
             return {"server": server_str, "type": server_type, **result}
         except Exception as e:
             return {
@@ -296,7 +943,8 @@ async def _perform_query(
             }
 
     tasks = [query_server(s) for s in servers]
-    results = await asyncio.gather(*tasks)
+    with timer.stage("probe"):
+        results = await asyncio.gather(*tasks)
 
     if output_format == "simple":
         lines = [
@@ -310,7 +958,17 @@ async def _perform_query(
                 f"\n{status_icon} {r.get('server', 'Unknown')} ({r.get('type', '?')})"
             )
             if r.get("status") == "success":
-                lines.append(f"  Latency: {r.get('latency_ms', '-')} ms")
+                connection = f" ({r['connection']})" if r.get("connection") else ""
+                lines.append(f"  Latency: {r.get('latency_ms', '-')} ms{connection}")
+                if len(r.get("type_latency_ms") or {}) > 1:
+                    lines.append(f"  Per type: {_format_type_latency(r)}")
+                if r.get("transport") == "tcp":
+                    lines.append(f"  TCP fallback: {_format_attempts(r)}")
+                if r.get("stats"):
+                    lines.append(f"  Samples: {_format_samples(r)}")
+                    lines.append(f"  Stats: {_format_stats(r)}")
+                if "authenticated" in r or "ecs_scope" in r:
+                    lines.append(f"  EDNS: {_format_edns(r)}")
                 if r.get("answers"):
                     for ans in r["answers"]:
                         lines.append(f"  → {ans}")
@@ -337,9 +995,26 @@ async def _perform_query(
                 + "║"
             )
             if r.get("status") == "success":
+                connection = f" ({r['connection']})" if r.get("connection") else ""
                 lines.append(
-                    f"║   Latency: {r.get('latency_ms', '-')} ms".ljust(61) + "║"
+                    f"║   Latency: {r.get('latency_ms', '-')} ms{connection}".ljust(61)
+                    + "║"
                 )
+                if len(r.get("type_latency_ms") or {}) > 1:
+                    lines.append(
+                        f"║   Per type: {_format_type_latency(r)[:47]}".ljust(61) + "║"
+                    )
+                if r.get("transport") == "tcp":
+                    lines.append(
+                        f"║   TCP fallback: {_format_attempts(r)[:43]}".ljust(61) + "║"
+                    )
+                if r.get("stats"):
+                    lines.append(
+                        f"║   Samples: {_format_samples(r)[:48]}".ljust(61) + "║"
+                    )
+                    lines.append(f"║   Stats: {_format_stats(r)[:50]}".ljust(61) + "║")
+                if "authenticated" in r or "ecs_scope" in r:
+                    lines.append(f"║   EDNS: {_format_edns(r)[:51]}".ljust(61) + "║")
                 if r.get("answers"):
                     for ans in r["answers"]:
                         lines.append(f"║   → {ans[:52]}".ljust(61) + "║")
@@ -356,6 +1031,159 @@ async def _perform_query(
         return {"domain": domain, "record_type": record_type, "results": results}
 
 
+@app.post("/api/batch")
+async def batch_query(batch_req: BatchRequest):
+    """Benchmark many domains against several servers, streaming NDJSON."""
+    return _batch_response(
+        batch_req.domains,
+        batch_req.servers,
+        batch_req.record_type,
+        batch_req.proxy,
+        batch_req.concurrency,
+        batch_req.rate_limit,
+    )
+
+
+@app.post("/api/batch/upload")
+async def batch_query_upload(
+    file: UploadFile = File(..., description="Newline-delimited domain list"),
+    server: Optional[List[str]] = Form(None, description="DNS servers"),
+    record_type: Optional[str] = Form("A"),
+    proxy: Optional[str] = Form(None),
+    concurrency: Optional[int] = Form(None),
+    rate_limit: Optional[float] = Form(None),
+):
+    """Batch benchmark with the domain list uploaded as a file."""
+    content = (await file.read()).decode("utf-8", errors="replace")
+    domains = []
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # Accept ranked lists such as "1,google.com".
+        domains.append(line.rsplit(",", 1)[-1].strip())
+    return _batch_response(domains, server, record_type, proxy, concurrency, rate_limit)
+
+
+def _batch_response(
+    domains: List[str],
+    servers: Optional[List[str]],
+    record_type: Optional[str],
+    proxy: Optional[str],
+    concurrency: Optional[int],
+    rate_limit: Optional[float],
+) -> StreamingResponse:
+    domains = [d.strip() for d in domains if d and d.strip()]
+    if not domains:
+        raise HTTPException(status_code=400, detail="No domains given")
+    if len(domains) > config.BATCH_MAX_DOMAINS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many domains (limit {config.BATCH_MAX_DOMAINS})",
+        )
+    if rate_limit is not None and rate_limit <= 0:
+        raise HTTPException(status_code=400, detail="rate_limit must be positive")
+    _check_servers(servers)
+
+    concurrency = min(
+        max(concurrency or config.BATCH_CONCURRENCY, 1), config.BATCH_MAX_CONCURRENCY
+    )
+    if not servers:
+        # Their configured rate limits are looked up by this key.
+        servers = [upstreams.upstream_key(s) for s in DEFAULT_SERVERS[:5]]
+
+    return StreamingResponse(
+        _stream_batch(
+            domains, servers, record_type or "A", proxy, concurrency, rate_limit
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+async def _stream_batch(
+    domains: List[str],
+    servers: List[str],
+    record_type: str,
+    proxy: Optional[str],
+    concurrency: int,
+    rate_limit: Optional[float],
+):
+    """Yield one NDJSON line per lookup as it completes, then a summary."""
+    parsed_servers = [(s, parse_server_string(s)) for s in servers]
+    buckets = {}
+    if rate_limit:
+        buckets = {s: ratelimit.TokenBucket(rate_limit, rate_limit) for s in servers}
+    stats = {
+        s: {"latencies": [], "queries": 0, "success": 0, "nxdomain": 0} for s in servers
+    }
+
+    jobs = ((d, s, p) for d in domains for s, p in parsed_servers)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        for domain, server_str, parsed in jobs:
+            if server_str in buckets:
+                await buckets[server_str].acquire()
+            try:
+                result = await _run_probe(parsed, domain, record_type, proxy)
+            except Exception as e:
+                result = {"status": "error", "error": str(e)}
+            await results.put(
+                {
+                    **result,
+                    "domain": domain,
+                    "server": server_str,
+                    "type": parsed["type"],
+                }
+            )
+
+    async def run_workers():
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        await results.put(None)
+
+    start_time = time.monotonic()
+    runner = asyncio.create_task(run_workers())
+    try:
+        while (item := await results.get()) is not None:
+            server_stats = stats[item["server"]]
+            server_stats["queries"] += 1
+            if item.get("status") == "success":
+                server_stats["success"] += 1
+                server_stats["latencies"].append(item["latency_ms"])
+                if item.get("rcode") == "NXDOMAIN":
+                    server_stats["nxdomain"] += 1
+            yield json.dumps(item) + "\n"
+
+        summary = []
+        for server_str, server_stats in stats.items():
+            queries = server_stats["queries"]
+            summary.append(
+                {
+                    "server": server_str,
+                    "queries": queries,
+                    "success_rate": (
+                        round(server_stats["success"] / queries, 4) if queries else 0.0
+                    ),
+                    "nxdomain_rate": (
+                        round(server_stats["nxdomain"] / queries, 4) if queries else 0.0
+                    ),
+                    **latency_stats.summarize_percentiles(server_stats["latencies"]),
+                }
+            )
+        yield json.dumps(
+            {
+                "summary": {
+                    "domains": len(domains),
+                    "record_type": record_type,
+                    "duration_ms": round((time.monotonic() - start_time) * 1000, 2),
+                    "servers": summary,
+                }
+            }
+        ) + "\n"
+    finally:
+        runner.cancel()
+
+
 @app.get("/api/servers")
 async def list_servers():
     """List all available default DNS servers."""
@@ -365,6 +1193,164 @@ async def list_servers():
     }
 
 
+@app.get("/api/servers/health")
+async def servers_health():
+    """Upstream health: latency, error rate and circuit breaker state."""
+    entries = []
+    seen = set()
+    for s in DEFAULT_SERVERS:
+        key = upstreams.upstream_key(s)
+        seen.add(key)
+        entries.append(
+            {"name": s["name"], "upstream": key, **upstream_health.snapshot(key)}
+        )
+    for key in upstream_health.keys():
+        if key not in seen:
+            entries.append(
+                {"name": None, "upstream": key, **upstream_health.snapshot(key)}
+            )
+
+    entries.sort(key=lambda e: (e["state"] == upstreams.OPEN, e["score"]))
+    return {
+        "failure_threshold": upstream_health.failure_threshold,
+        "cooldown_seconds": upstream_health.cooldown,
+        "scheduler": upstream_scheduler.stats(),
+        "bootstrap_addresses": bootstrap.addresses.stats(),
+        "servers": entries,
+    }
+
+
+@app.get("/api/history")
+async def latency_history(
+    server: Optional[str] = Query(None, description="Server of a scheduled check"),
+    domain: Optional[str] = Query(None, description="Domain of the check"),
+    type: str = Query("A", description="Record type of the check"),
+    start: Optional[float] = Query(None, description="Unix time, default end - hours"),
+    end: Optional[float] = Query(None, description="Unix time, default now"),
+    hours: float = Query(24, gt=0, description="Range when start is not given"),
+    resolution: str = Query("auto", description="auto, raw, minute or hour"),
+    points: int = Query(500, ge=1, le=5000, description="Maximum points returned"),
+):
+    """Latency history of scheduled checks.
+
+    Without ``server`` and ``domain``, lists the configured checks and the
+    series with stored history.
+    """
+    if history_store is None:
+        raise HTTPException(
+            status_code=404,
+            detail="History is disabled; configure checks with EZDNS_HISTORY_CHECKS",
+        )
+    if not server or not domain:
+        return {
+            "checks": [
+                {
+                    "upstream": upstreams.upstream_key(parse_server_string(c.server)),
+                    "domain": c.domain,
+                    "type": c.rdtype,
+                    "interval_seconds": c.interval,
+                }
+                for c in history_checks
+            ],
+            "series": await history_store.series(),
+        }
+
+    end = time.time() if end is None else end
+    start = end - hours * 3600 if start is None else start
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    parsed = parse_server_string(server)
+    _check_server(parsed)
+    upstream = upstreams.upstream_key(parsed)
+    try:
+        series = await history_store.query(
+            upstream, domain, type, start, end, resolution, points
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "upstream": upstream,
+        "domain": domain,
+        "type": type.upper(),
+        "start": start,
+        "end": end,
+        **series,
+    }
+
+
+def _import_transports() -> None:
+    import dns.asyncresolver  # noqa: F401
+    import httpx  # noqa: F401
+    import httpcore  # noqa: F401
+    import h2.connection  # noqa: F401
+
+
+async def _warm_up() -> dict:
+    """Open pooled connections to the default DoH and DoT upstreams.
+
+    Imports the transport stack, resolves the upstreams' hostnames and
+    completes the TLS handshakes before the first client query needs them.
+    """
+    start_time = time.perf_counter()
+    # Import off the event loop so that queries arriving meanwhile are served.
+    await asyncio.to_thread(_import_transports)
+    wire, _ = dns_wire.make_query(".", dns.rdatatype.NS)
+
+    async def warm(s: dict) -> str:
+        try:
+            await forwarder.forward_wire(
+                wire, s["type"], s["server"], timeout=config.WARMUP_TIMEOUT
+            )
+        except Exception as e:
+            return f"error: {str(e) or type(e).__name__}"
+        return "ok"
+
+    pooled = [s for s in DEFAULT_SERVERS if s["type"] in ("doh", "dot")]
+    results = await asyncio.gather(*(warm(s) for s in pooled))
+    return {
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "upstreams": {upstreams.upstream_key(s): r for s, r in zip(pooled, results)},
+    }
+
+
+@app.get("/api/ready")
+async def readiness():
+    """Readiness probe: 503 until the startup warm-up has finished."""
+    if warm_up_task is None:
+        return {"ready": True}
+    if not warm_up_task.done() or warm_up_task.cancelled():
+        return JSONResponse({"ready": False}, status_code=503)
+    return {"ready": True, "warm_up": warm_up_task.result()}
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    """DoH forwarder response cache statistics."""
+    return {
+        "enabled": config.CACHE_ENABLED,
+        **response_cache.stats(),
+        "upstream_lookups_in_flight": len(upstream_flights),
+        "local_resolver": system_resolver.resolver.stats(),
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics in the text exposition format."""
+    metrics.CACHE_ENTRIES.set(response_cache.stats()["entries"])
+    metrics.SCHEDULER_IN_FLIGHT.set(upstream_scheduler.in_flight)
+    metrics.SCHEDULER_WAITING.set(upstream_scheduler.waiting)
+    # Upstreams named in requests share one series: open if any of them is.
+    circuits = {upstreams.OTHER: 0}
+    for key in upstream_health.keys():
+        label = upstreams.metric_label(key)
+        state = upstream_health.snapshot(key)["state"]
+        circuits[label] = max(circuits.get(label, 0), int(state != upstreams.CLOSED))
+    for label, is_open in circuits.items():
+        metrics.UPSTREAM_CIRCUIT_OPEN.set(is_open, upstream=label)
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/api/help")
 async def api_help():
     """API usage help and examples."""
@@ -377,7 +1363,9 @@ async def api_help():
                     "dns": "(GET only) Base64url encoded DNS query",
                     "upstream": "Upstream DNS server to forward queries to",
                     "proxy": "Proxy for DoH upstream requests",
+                    "debug": "Add a Server-Timing header with per-stage timings",
                 },
+                "notes": "EDNS options and the DO/CD/AD bits are forwarded; EZDNS_ECS_MODE controls the Client Subnet option",
                 "examples": [
                     "curl 'http://localhost:8000/dns-query?dns=AAABAAABAAAAAAAAB2V4YW1wbGUDY29tAAABAAE'",
                     "curl 'http://localhost:8000/dns-query?dns=...&upstream=udp://8.8.8.8'",
@@ -392,25 +1380,82 @@ async def api_help():
                     "type": "Record type: A, AAAA, CNAME, MX, TXT, NS, SOA, BOTH, ALL",
                     "proxy": "Proxy for DoH requests",
                     "format": "Output format: json, text, simple",
+                    "samples": "Benchmark mode: timed samples per server (min/mean/median/p95/stddev/jitter/loss)",
+                    "warmup": "Benchmark mode: untimed warm-up queries per server",
+                    "cache_bust": "Benchmark mode: query random subdomains to bypass resolver caches",
+                    "dnssec": "Set the DO bit and report whether answers have the AD bit (authenticated)",
+                    "ecs": "EDNS Client Subnet to send, e.g. 203.0.113.0/24; the upstream's scope is reported as ecs_scope",
+                    "debug": "Add per-stage timings (timings_ms field and Server-Timing header)",
                 },
                 "examples": [
                     "curl 'http://localhost:8000/api/query?domain=google.com'",
                     "curl 'http://localhost:8000/api/query?domain=google.com&server=udp://8.8.8.8&server=doh://https://dns.google/dns-query'",
                     "curl 'http://localhost:8000/api/query?domain=google.com&format=simple'",
                     "curl 'http://localhost:8000/api/query?domain=google.com&type=AAAA&proxy=http://127.0.0.1:7890'",
+                    "curl 'http://localhost:8000/api/query?domain=google.com&server=udp://8.8.8.8&samples=20&warmup=2&format=simple'",
+                    "curl 'http://localhost:8000/api/query?domain=example.com&server=udp://8.8.8.8&dnssec=true&ecs=203.0.113.0/24'",
+                ],
+            },
+            "/api/batch": {
+                "description": "Batch benchmark - Query many domains against many servers, streaming NDJSON results and a per-server summary",
+                "methods": ["POST"],
+                "parameters": {
+                    "domains": "List of domains (JSON body), or a newline-delimited file via /api/batch/upload",
+                    "servers": "DNS server(s) in format type://server",
+                    "record_type": "Record type",
+                    "concurrency": "Lookups in flight at once",
+                    "rate_limit": "Maximum queries per second per server",
+                },
+                "examples": [
+                    'curl -N -X POST http://localhost:8000/api/batch -H \'Content-Type: application/json\' -d \'{"domains": ["google.com", "github.com"], "servers": ["udp://8.8.8.8"]}\'',
+                    "curl -N -F file=@domains.txt -F server=udp://8.8.8.8 -F concurrency=100 http://localhost:8000/api/batch/upload",
                 ],
             },
             "/api/servers": {
                 "description": "List all available default DNS servers",
                 "methods": ["GET"],
             },
+            "/api/servers/health": {
+                "description": "Upstream health: EWMA latency, error rate and circuit breaker state, best first, plus the upstream scheduler's queue and the pre-resolved DoH/DoT addresses",
+                "methods": ["GET"],
+            },
+            "/api/cache": {
+                "description": "DoH server response cache statistics (entries, hits, misses)",
+                "methods": ["GET"],
+            },
+            "/api/ready": {
+                "description": "Readiness probe: 503 until the connection pools to the default DoH/DoT upstreams are warm, then 200 with the warm-up results",
+                "methods": ["GET"],
+            },
+            "/api/history": {
+                "description": "Downsampled latency history of the scheduled checks (EZDNS_HISTORY_CHECKS); without server and domain, lists the checks",
+                "methods": ["GET"],
+                "parameters": {
+                    "server": "Server of a check, e.g. udp://8.8.8.8",
+                    "domain": "Domain of the check",
+                    "type": "Record type of the check (default: A)",
+                    "start": "Start as Unix time (default: end - hours)",
+                    "end": "End as Unix time (default: now)",
+                    "hours": "Range when start is not given (default: 24)",
+                    "resolution": "auto, raw, minute or hour (default: auto)",
+                    "points": "Maximum points returned (default: 500)",
+                },
+            },
+            "/metrics": {
+                "description": "Prometheus metrics: forwarder QPS, rcodes and stage timings, per-upstream latency histograms, probe counts",
+                "methods": ["GET"],
+            },
             "/api/test": {
-                "description": "Original single server test endpoint (used by Web UI)",
+                "description": "Original single server test endpoint",
+                "methods": ["POST"],
+            },
+            "/api/test/stream": {
+                "description": "Multi-server test used by the Web UI - probes run concurrently and each result is pushed as a Server-Sent Event",
                 "methods": ["POST"],
             },
         },
         "server_format": {
-            "description": "Server string format: type://server",
+            "description": "Server string format: type://server, optionally followed by a rate limit as #qps=..&burst=..",
             "types": {
                 "udp": "UDP DNS (port 53)",
                 "dot": "DNS over TLS (port 853)",
@@ -420,6 +1465,8 @@ async def api_help():
                 "udp://8.8.8.8",
                 "udp://223.5.5.5",
                 "dot://1.1.1.1",
+                "udp://127.0.0.1:5353",
+                "udp://8.8.8.8#qps=20&burst=40",
                 "doh://https://dns.google/dns-query",
                 "doh://https://1.1.1.1/dns-query",
             ],
@@ -428,6 +1475,19 @@ async def api_help():
 
 
 if __name__ == "__main__":
+    import os
+    import tempfile
+
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if config.WORKERS > 1:
+        # Every worker imports the app afresh; point them at one shared store.
+        if not config.SHARED_STATE_PATH:
+            os.environ["EZDNS_SHARED_STATE_PATH"] = os.path.join(
+                tempfile.gettempdir(), f"ezdns-state-{config.PORT}.sqlite"
+            )
+        uvicorn.run(
+            "app:app", host=config.HOST, port=config.PORT, workers=config.WORKERS
+        )
+    else:
+        uvicorn.run(app, host=config.HOST, port=config.PORT)
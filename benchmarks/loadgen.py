@@ -0,0 +1,580 @@
+"""Load generator for the forwarder (``/dns-query``) and ``/api/query``.
+
+Starts the mock upstreams from ``mock_upstreams.py`` and the app itself
+(``uvicorn app:app``), each in a process of its own, drives the chosen
+endpoint at a target rate from ``--clients`` load client processes and
+prints a JSON report: throughput, latency percentiles of the successful
+requests, response codes, sends that fell behind the target rate and the
+app's CPU time and memory (from ``/proc``).
+
+Examples::
+
+    python benchmarks/loadgen.py --endpoint dns-query --transport udp \\
+        --qps 1000 --concurrency 100 --duration 10 --latency-ms 5
+
+    python benchmarks/loadgen.py --endpoint api-query --transport dot \\
+        --qps 0 --concurrency 20 --output after.json --baseline before.json
+
+``--qps 0`` runs closed-loop: ``concurrency`` clients send back to back.
+No request is started after ``--duration``.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+import dns.message
+import dns.rcode
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+import latency_stats  # noqa: E402
+
+
+def _free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def process_stats(pid: int) -> Optional[dict]:
+    """CPU seconds and memory of ``pid`` from ``/proc`` (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the command name; utime and stime are the 14th
+            # and 15th fields of the whole line.
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_kb": int(status["VmRSS"].split()[0]),
+        "peak_rss_kb": int(status["VmHWM"].split()[0]),
+    }
+
+
+def _own_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_app(host: str, port: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app:app",
+            "--host",
+            host,
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        cwd=REPO_ROOT,
+    )
+
+
+class MockProcess:
+    """``mock_upstreams.py`` in a process of its own, so it does not share a
+    CPU (and event loop) with the clients."""
+
+    def __init__(self, host: str, latency_ms: float, loss: float):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(BENCH_DIR, "mock_upstreams.py"),
+                "--host",
+                host,
+                "--latency-ms",
+                str(latency_ms),
+                "--loss",
+                str(loss),
+                "--control",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.servers = {}
+        while len(self.servers) < 3:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError("Mock upstreams did not start")
+            transport, server = line.strip().split(": ", 1)
+            self.servers[transport] = server
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def queries(self) -> int:
+        self.process.stdin.write("\n")
+        self.process.stdin.flush()
+        return int(self.process.stdout.readline().split(":")[1])
+
+    def stop(self) -> None:
+        self.process.stdin.close()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def wait_ready(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    with httpx.Client(base_url=base_url) as client:
+        while True:
+            try:
+                if client.get("/api/servers").status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("App did not start in time")
+            time.sleep(0.1)
+
+
+class HttpError(Exception):
+    pass
+
+
+class HttpClient:
+    """Bare HTTP/1.1 keep-alive client for the timed requests.
+
+    httpx costs more CPU per request than the app itself, which made the
+    load generator the bottleneck; this one only frames requests and reads
+    ``Content-Length`` bodies, which is all the app sends.
+    """
+
+    def __init__(self, base_url: str, timeout: float):
+        url = httpx.URL(base_url)
+        self.host = url.host
+        self.port = url.port or 80
+        self.timeout = timeout
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def _exchange(self, connection, request: bytes) -> tuple[int, bytes]:
+        reader, writer = connection
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, await reader.readexactly(length)
+
+    async def request(
+        self, method: str, target: str, body: bytes = b"", content_type: str = ""
+    ) -> bytes:
+        """The body of a 200 response to ``method target``."""
+        request = (
+            f"{method} {target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            + (f"Content-Type: {content_type}\r\n" if content_type else "")
+            + "\r\n"
+        ).encode() + body
+        if self._idle:
+            connection = self._idle.pop()
+        else:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout
+            )
+        try:
+            status, content = await asyncio.wait_for(
+                self._exchange(connection, request), self.timeout
+            )
+        except BaseException:
+            connection[1].close()
+            raise
+        self._idle.append(connection)
+        if status != 200:
+            raise HttpError(status)
+        return content
+
+    def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        client: HttpClient,
+        args: argparse.Namespace,
+        server,
+        qps: float,
+        concurrency: int,
+    ):
+        self.client = client
+        self.args = args
+        self.server = server
+        self.qps = qps
+        self.concurrency = concurrency
+        self.names = [f"host{i}.bench.example" for i in range(args.names)]
+        self.dns_target = "/dns-query?" + urlencode({"upstream": server})
+        # Built once: the client should spend its CPU on sending, not on
+        # dnspython.
+        self.wires = [
+            dns.message.make_query(name, args.record_type).to_wire()
+            for name in self.names
+        ]
+        self.latencies: list[float] = []
+        self.outcomes: dict[str, int] = {}
+        self.errors = 0
+        self.late = 0
+        self.max_lag_ms = 0.0
+
+    def _record(self, outcome: str) -> None:
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def request(self, record: bool = True) -> None:
+        index = random.randrange(len(self.names))
+        start_time = time.perf_counter()
+        try:
+            if self.args.endpoint == "dns-query":
+                content = await self.client.request(
+                    "POST",
+                    self.dns_target,
+                    self.wires[index],
+                    "application/dns-message",
+                )
+                outcome = dns.rcode.to_text(content[3] & 0xF)
+            else:
+                params = {
+                    "domain": self.names[index],
+                    "server": self.server,
+                    "type": self.args.record_type,
+                }
+                content = await self.client.request(
+                    "GET", "/api/query?" + urlencode(params)
+                )
+                outcome = json.loads(content)["results"][0]["status"]
+        except Exception as e:
+            self.errors += record
+            outcome = f"error:{type(e).__name__}"
+        else:
+            if record:
+                self.latencies.append((time.perf_counter() - start_time) * 1000)
+        if record:
+            self._record(outcome)
+
+    async def open_loop(self, duration: float) -> int:
+        """Start requests at ``qps``, at most ``concurrency`` in flight.
+
+        Nothing is started after ``duration``: sends that fell behind the
+        schedule count as late (more than ``--late-ms`` after their slot),
+        and slots left when the time is up are reported as skipped.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        interval = 1.0 / self.qps
+        tasks = set()
+        sent = 0
+        start_time = time.perf_counter()
+        deadline = start_time + duration
+        while True:
+            target = start_time + sent * interval
+            if target >= deadline:
+                break
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await asyncio.wait_for(
+                    semaphore.acquire(), deadline - time.perf_counter()
+                )
+            except asyncio.TimeoutError:
+                break
+            now = time.perf_counter()
+            if now >= deadline:
+                semaphore.release()
+                break
+            lag_ms = (now - target) * 1000
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms > self.args.late_ms:
+                self.late += 1
+
+            async def run():
+                try:
+                    await self.request()
+                finally:
+                    semaphore.release()
+
+            task = asyncio.ensure_future(run())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+        return sent
+
+    async def closed_loop(self, duration: float) -> int:
+        """``concurrency`` clients sending back to back for ``duration``."""
+        deadline = time.perf_counter() + duration
+        sent = 0
+
+        async def client():
+            nonlocal sent
+            while time.perf_counter() < deadline:
+                sent += 1
+                await self.request()
+
+        await asyncio.gather(*(client() for _ in range(self.concurrency)))
+        return sent
+
+
+async def _client(args, base_url, server, index, barrier) -> dict:
+    qps = args.qps / args.clients
+    concurrency = args.concurrency // args.clients
+    concurrency += index < args.concurrency % args.clients
+    client = HttpClient(base_url, args.timeout)
+    try:
+        generator = LoadGenerator(client, args, server, qps, concurrency)
+        for _ in range(args.warmup // args.clients):
+            await generator.request(record=False)
+        # Every client and the parent start timing together.
+        barrier.wait()
+        cpu = _own_cpu_seconds()
+        start_time = time.perf_counter()
+        if qps > 0:
+            sent = await generator.open_loop(args.duration)
+            skipped = int(args.duration * qps) - sent
+        else:
+            sent = await generator.closed_loop(args.duration)
+            skipped = 0
+        elapsed = time.perf_counter() - start_time
+    finally:
+        client.close()
+    return {
+        "sent": sent,
+        "skipped": skipped,
+        "late": generator.late,
+        "max_lag_ms": generator.max_lag_ms,
+        "errors": generator.errors,
+        "outcomes": generator.outcomes,
+        "latencies": generator.latencies,
+        "elapsed": elapsed,
+        "cpu_seconds": _own_cpu_seconds() - cpu,
+    }
+
+
+def _client_main(args, base_url, server, index, barrier, results) -> None:
+    try:
+        result = asyncio.run(_client(args, base_url, server, index, barrier))
+    except Exception as e:
+        barrier.abort()
+        result = {"failed": f"{type(e).__name__}: {e}"}
+    results.put(result)
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Relative change of the headline numbers against a previous report."""
+    delta = {}
+    for section, key in (
+        ("throughput", "completed_qps"),
+        ("latency", "p50_ms"),
+        ("latency", "p99_ms"),
+        ("app", "cpu_seconds_per_1k_requests"),
+        ("app", "peak_rss_kb"),
+    ):
+        new = (report.get(section) or {}).get(key)
+        old = (baseline.get(section) or {}).get(key)
+        if new is not None and old:
+            delta[f"{section}.{key}"] = round((new - old) / old, 4)
+    return delta
+
+
+def run(args: argparse.Namespace) -> dict:
+    args.clients = max(1, min(args.clients, args.concurrency))
+    mock = MockProcess(args.mock_host, args.latency_ms, args.loss)
+    process = None
+    clients = []
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            port = _free_port("127.0.0.1")
+            process = start_app("127.0.0.1", port)
+            base_url = f"http://127.0.0.1:{port}"
+        wait_ready(base_url)
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(args.clients + 1)
+        results = context.Queue()
+        server = mock.servers[args.transport]
+        for index in range(args.clients):
+            client = context.Process(
+                target=_client_main,
+                args=(args, base_url, server, index, barrier, results),
+            )
+            client.start()
+            clients.append(client)
+
+        pid = process.pid if process is not None else args.pid
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        before = process_stats(pid) if pid else None
+        mock_before = process_stats(mock.pid)
+        upstream_queries = mock.queries()
+        start_time = time.perf_counter()
+        # Warmup is done; a client that is still running after this has hung.
+        limit = args.duration + args.timeout + 30
+        outputs = [results.get(timeout=limit) for _ in clients]
+        elapsed = time.perf_counter() - start_time
+        upstream_queries = mock.queries() - upstream_queries
+        after = process_stats(pid) if pid else None
+        mock_after = process_stats(mock.pid)
+    finally:
+        for client in clients:
+            client.join(10)
+            if client.is_alive():
+                client.kill()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        mock.stop()
+
+    failed = [o["failed"] for o in outputs if "failed" in o]
+    if failed:
+        raise RuntimeError(f"Load client failed: {failed[0]}")
+    latencies = [ms for o in outputs for ms in o["latencies"]]
+    outcomes: dict[str, int] = {}
+    for output in outputs:
+        for outcome, count in output["outcomes"].items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + count
+    sent = sum(o["sent"] for o in outputs)
+    report = {
+        "config": {
+            "endpoint": args.endpoint,
+            "transport": args.transport,
+            "record_type": args.record_type,
+            "target_qps": args.qps,
+            "concurrency": args.concurrency,
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "names": args.names,
+            "upstream_latency_ms": args.latency_ms,
+            "upstream_loss": args.loss,
+        },
+        "throughput": {
+            "sent": sent,
+            "completed": len(latencies),
+            "errors": sum(o["errors"] for o in outputs),
+            "elapsed_s": round(elapsed, 3),
+            "completed_qps": round(len(latencies) / elapsed, 2),
+            "upstream_queries": upstream_queries,
+        },
+        "schedule": None,
+        "latency": {
+            **latency_stats.summarize(latencies),
+            **latency_stats.summarize_percentiles(latencies),
+            "max_ms": round(max(latencies), 2) if latencies else None,
+        },
+        "outcomes": outcomes,
+        "app": None,
+        "mock": None,
+        # Busiest load client; near 100% means the numbers are limited by
+        # the clients rather than the app, so add ``--clients``.
+        "client_cpu_percent": round(
+            max(o["cpu_seconds"] / o["elapsed"] for o in outputs) * 100, 1
+        ),
+    }
+    if args.qps > 0:
+        # Open loop only: sends that could not keep to the target rate.
+        report["schedule"] = {
+            "late": sum(o["late"] for o in outputs),
+            "skipped": sum(o["skipped"] for o in outputs),
+            "max_lag_ms": round(max(o["max_lag_ms"] for o in outputs), 2),
+        }
+    if before and after:
+        cpu = after["cpu_seconds"] - before["cpu_seconds"]
+        report["app"] = {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(cpu / elapsed * 100, 1),
+            "cpu_seconds_per_1k_requests": (
+                round(cpu / sent * 1000, 4) if sent else None
+            ),
+            "rss_kb": after["rss_kb"],
+            "peak_rss_kb": after["peak_rss_kb"],
+        }
+    if mock_before and mock_after:
+        cpu = mock_after["cpu_seconds"] - mock_before["cpu_seconds"]
+        report["mock"] = {"cpu_percent": round(cpu / elapsed * 100, 1)}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline_delta"] = compare(report, json.load(f))
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--endpoint", choices=("dns-query", "api-query"), default="dns-query"
+    )
+    parser.add_argument("--transport", choices=("udp", "dot", "doh"), default="udp")
+    parser.add_argument("--record-type", default="A")
+    parser.add_argument("--qps", type=float, default=500, help="0 = closed loop")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="load client processes sharing qps and concurrency",
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed requests")
+    parser.add_argument(
+        "--names", type=int, default=1000, help="distinct names (cache hit ratio)"
+    )
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mock delay")
+    parser.add_argument("--loss", type=float, default=0.0, help="mock UDP drop ratio")
+    parser.add_argument("--mock-host", default="127.0.0.1")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument(
+        "--late-ms", type=float, default=10.0, help="lag before a send counts as late"
+    )
+    parser.add_argument("--url", help="benchmark an already running app instead")
+    parser.add_argument("--pid", type=int, help="app PID for CPU/RSS with --url")
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Local stand-in DNS upstreams for benchmarks: UDP/TCP, DoT and DoH.
+
+Every upstream answers after a configurable delay; UDP queries can also be
+dropped at random to simulate packet loss. A and AAAA questions get a
+documentation address, names starting with ``nx`` get NXDOMAIN and anything
+else an empty NOERROR answer, both with an SOA for negative caching.
+
+Run standalone to point the app at them by hand::
+
+    python benchmarks/mock_upstreams.py --latency-ms 5 --loss 0.01
+
+With ``--control`` it answers every line on stdin with the number of
+queries seen so far and exits at the end of stdin; ``loadgen.py`` runs it
+that way in a process of its own.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import uvicorn
+
+
+def make_self_signed_cert(directory: str, host: str = "127.0.0.1") -> tuple[str, str]:
+    """Create a throwaway certificate for ``host`` with openssl."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            f"subjectAltName=IP:{host},DNS:localhost",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+class MockUpstreams:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        latency: float = 0.0,
+        loss: float = 0.0,
+        ttl: int = 300,
+    ):
+        self.host = host
+        self.latency = latency
+        self.loss = loss
+        self.ttl = ttl
+        self.queries = 0
+        self.udp_port: Optional[int] = None
+        self.dot_port: Optional[int] = None
+        self.doh_port: Optional[int] = None
+        self._udp_transport = None
+        self._servers: list[asyncio.AbstractServer] = []
+        self._doh_server: Optional[uvicorn.Server] = None
+        self._doh_task: Optional[asyncio.Task] = None
+        self._tempdir: Optional[tempfile.TemporaryDirectory] = None
+
+    def answer(self, wire: bytes) -> bytes:
+        self.queries += 1
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        question = query.question[0]
+        name = question.name
+        soa = dns.rrset.from_text(
+            name.parent() if len(name) > 1 else name,
+            self.ttl,
+            "IN",
+            "SOA",
+            "ns.invalid. hostmaster.invalid. 1 3600 600 86400 60",
+        )
+        if name.labels[0].startswith(b"nx"):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(soa)
+        elif question.rdtype == dns.rdatatype.A:
+            response.answer.append(
+                dns.rrset.from_text(name, self.ttl, "IN", "A", "192.0.2.1")
+            )
+        elif question.rdtype == dns.rdatatype.AAAA:
+            response.answer.append(
+                dns.rrset.from_text(name, self.ttl, "IN", "AAAA", "2001:db8::1")
+            )
+        else:
+            response.authority.append(soa)
+        return response.to_wire()
+
+    async def _delay(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # UDP and TCP share one port, like a real nameserver.
+
+    def _udp_protocol(self):
+        mock = self
+
+        class Protocol(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                if mock.loss and random.random() < mock.loss:
+                    return
+                asyncio.ensure_future(self._reply(data, addr))
+
+            async def _reply(self, data, addr):
+                await mock._delay()
+                try:
+                    self.transport.sendto(mock.answer(data), addr)
+                except Exception:
+                    pass
+
+        return Protocol()
+
+    async def _handle_stream(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        async def reply(data: bytes) -> None:
+            await self._delay()
+            response = self.answer(data)
+            writer.write(struct.pack("!H", len(response)) + response)
+
+        tasks = set()
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                task = asyncio.ensure_future(reply(await reader.readexactly(length)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _doh_app(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        if scope["method"] == "GET":
+            params = dict(
+                p.split("=", 1) for p in scope["query_string"].decode().split("&") if p
+            )
+            encoded = params.get("dns", "")
+            body = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+
+        await self._delay()
+        response = self.answer(body)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/dns-message")],
+            }
+        )
+        await send({"type": "http.response.body", "body": response})
+
+    async def _start_udp_tcp(self) -> None:
+        loop = asyncio.get_running_loop()
+        # Find a port free for both UDP and TCP.
+        for _ in range(20):
+            transport, _ = await loop.create_datagram_endpoint(
+                self._udp_protocol, local_addr=(self.host, 0)
+            )
+            port = transport.get_extra_info("sockname")[1]
+            try:
+                server = await asyncio.start_server(
+                    self._handle_stream, self.host, port
+                )
+            except OSError:
+                transport.close()
+                continue
+            self._udp_transport = transport
+            self._servers.append(server)
+            self.udp_port = port
+            return
+        raise OSError("No free port for the UDP/TCP mock")
+
+    async def start(self) -> None:
+        await self._start_udp_tcp()
+
+        self._tempdir = tempfile.TemporaryDirectory()
+        certfile, keyfile = make_self_signed_cert(self._tempdir.name, self.host)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+        dot_server = await asyncio.start_server(
+            self._handle_stream, self.host, 0, ssl=context
+        )
+        self._servers.append(dot_server)
+        self.dot_port = dot_server.sockets[0].getsockname()[1]
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, 0))
+        self.doh_port = sock.getsockname()[1]
+        self._doh_server = uvicorn.Server(
+            uvicorn.Config(
+                self._doh_app,
+                ssl_certfile=certfile,
+                ssl_keyfile=keyfile,
+                interface="asgi3",
+                lifespan="off",
+                log_level="warning",
+                access_log=False,
+            )
+        )
+        self._doh_task = asyncio.create_task(self._doh_server.serve(sockets=[sock]))
+        while not self._doh_server.started:
+            if self._doh_task.done():
+                self._doh_task.result()
+            await asyncio.sleep(0.01)
+
+    async def stop(self) -> None:
+        if self._doh_server is not None:
+            self._doh_server.should_exit = True
+            await self._doh_task
+        for server in self._servers:
+            server.close()
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+
+    def servers(self) -> dict[str, str]:
+        """Server strings for the app, by transport."""
+        return {
+            "udp": f"udp://{self.host}:{self.udp_port}",
+            "dot": f"dot://{self.host}:{self.dot_port}",
+            "doh": f"doh://https://{self.host}:{self.doh_port}/dns-query",
+        }
+
+
+async def _main(args: argparse.Namespace) -> None:
+    mock = MockUpstreams(args.host, args.latency_ms / 1000, args.loss, args.ttl)
+    await mock.start()
+    for transport, server in mock.servers().items():
+        print(f"{transport}: {server}", flush=True)
+    try:
+        if args.control:
+            loop = asyncio.get_running_loop()
+            while await loop.run_in_executor(None, sys.stdin.readline):
+                print(f"queries: {mock.queries}", flush=True)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await mock.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0, help="UDP drop ratio")
+    parser.add_argument("--ttl", type=int, default=300)
+    parser.add_argument(
+        "--control", action="store_true", help="report query counts on stdin lines"
+    )
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
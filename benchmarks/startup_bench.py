@@ -0,0 +1,175 @@
+"""Startup cost of the app: import time and time to first answer.
+
+Measures, each over several fresh processes:
+
+- ``import``: wall time of ``import app`` and which heavy modules it loaded;
+- ``serve``: from spawning ``uvicorn app:app`` until the first ``/dns-query``
+  answer (forwarded to a local mock upstream) and until ``/api/ready``
+  reports ready.
+
+Example::
+
+    python benchmarks/startup_bench.py --runs 5 --output before.json
+    # ...change something, then compare:
+    python benchmarks/startup_bench.py --runs 5 --baseline before.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import dns.message
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+from loadgen import _free_port, start_app  # noqa: E402
+from mock_upstreams import MockUpstreams  # noqa: E402
+
+# Modules worth keeping off the import path of the app.
+HEAVY_MODULES = ("httpx", "httpcore", "h2", "certifi", "trio", "dns.resolver")
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+loaded = [m for m in %r if m in sys.modules and m not in before]
+print(json.dumps({"ms": elapsed * 1000, "loaded": loaded}))
+"""
+
+
+def measure_import() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT % (HEAVY_MODULES,)],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+async def _poll(client: httpx.AsyncClient, request, deadline: float) -> bool:
+    """Repeat ``request`` until it succeeds; False on timeout or 404."""
+    while time.monotonic() < deadline:
+        try:
+            status = (await request(client)).status_code
+            if status in (200, 404):
+                return status == 200
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.005)
+    return False
+
+
+async def measure_serve(upstream: str, timeout: float) -> dict:
+    """Milliseconds from spawn to the first answer and to readiness."""
+    query = dns.message.make_query("startup.bench.example.", "A").to_wire()
+    params = {
+        "dns": base64.urlsafe_b64encode(query).rstrip(b"=").decode(),
+        "upstream": upstream,
+    }
+    port = _free_port("127.0.0.1")
+    started = time.monotonic()
+    process = start_app("127.0.0.1", port)
+    deadline = started + timeout
+    result: dict[str, Optional[float]] = {"first_answer_ms": None, "ready_ms": None}
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", timeout=timeout
+        ) as client:
+            if await _poll(
+                client, lambda c: c.get("/dns-query", params=params), deadline
+            ):
+                result["first_answer_ms"] = (time.monotonic() - started) * 1000
+            if await _poll(client, lambda c: c.get("/api/ready"), deadline):
+                result["ready_ms"] = (time.monotonic() - started) * 1000
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def _summary(values: list) -> Optional[dict]:
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        "median_ms": round(statistics.median(values), 1),
+        "min_ms": round(min(values), 1),
+        "max_ms": round(max(values), 1),
+    }
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Relative change of the median times against a previous report."""
+    delta = {}
+    for key in ("import", "first_answer", "ready"):
+        new = (report.get(key) or {}).get("median_ms")
+        old = (baseline.get(key) or {}).get("median_ms")
+        if new is not None and old:
+            delta[key] = round((new - old) / old, 4)
+    return delta
+
+
+async def run(args: argparse.Namespace) -> dict:
+    imports = [measure_import() for _ in range(args.runs)]
+
+    mock = MockUpstreams(args.mock_host)
+    await mock.start()
+    try:
+        serves = [
+            await measure_serve(mock.servers()["udp"], args.timeout)
+            for _ in range(args.runs)
+        ]
+    finally:
+        await mock.stop()
+
+    report = {
+        "config": {"runs": args.runs, "python": sys.version.split()[0]},
+        "import": {
+            **_summary([i["ms"] for i in imports]),
+            "heavy_modules_loaded": imports[-1]["loaded"],
+        },
+        "first_answer": _summary([s["first_answer_ms"] for s in serves]),
+        "ready": _summary([s["ready_ms"] for s in serves]),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline_delta"] = compare(report, json.load(f))
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mock-host", default="127.0.0.1")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per process")
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""CPU cost of the per-query DNS message work, before and after ``dns_wire``.
+
+Each step of the probe and forwarder hot paths is timed twice: the way it
+used to be done with full ``dns.message`` objects ("before") and with the
+wire-level helpers now used by the app ("after"). The JSON report gives
+the CPU microseconds per query of each and the speedup.
+
+Example::
+
+    python benchmarks/wire_bench.py --iterations 20000 --answers 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import dns_cache  # noqa: E402
+import dns_wire  # noqa: E402
+
+QNAME = "www.bench.example."
+
+
+def make_response(answers: int) -> bytes:
+    """A NOERROR answer (ID 0, EDNS) with a CNAME and ``answers`` A records."""
+    query = dns.message.make_query(QNAME, "A", use_edns=0, payload=1232)
+    query.id = 0
+    response = dns.message.make_response(query)
+    response.answer.append(
+        dns.rrset.from_text(QNAME, 300, "IN", "CNAME", "edge.bench.example.")
+    )
+    response.answer.append(
+        dns.rrset.from_text(
+            "edge.bench.example.",
+            60,
+            "IN",
+            "A",
+            *(f"192.0.2.{i + 1}" for i in range(answers)),
+        )
+    )
+    return response.to_wire()
+
+
+def cpu_us(function, iterations: int) -> float:
+    """CPU microseconds per call of ``function``."""
+    start_time = time.process_time()
+    for _ in range(iterations):
+        function()
+    return (time.process_time() - start_time) / iterations * 1e6
+
+
+def cases(response_wire: bytes) -> dict:
+    """Name -> (before, after) callables for each hot-path step."""
+    query_wire = dns.message.make_query(QNAME, "A").to_wire()
+
+    # Probe: build the query, then format the answers of the reply.
+    def query_before():
+        return dns.message.make_query(QNAME, dns.rdatatype.A).to_wire()
+
+    def query_after():
+        return dns_wire.make_query(QNAME, dns.rdatatype.A)
+
+    def answers_before():
+        response = dns.message.from_wire(response_wire)
+        answers = []
+        ttl = None
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.A:
+                ttl = rrset.ttl if ttl is None else min(ttl, rrset.ttl)
+                for rr in rrset:
+                    answers.append(f"[A] {str(rr)}")
+        return answers, ttl, response.rcode()
+
+    def answers_after():
+        response = dns_wire.parse_response(response_wire, 0)
+        return (*response.answers(dns.rdatatype.A), response.rcode())
+
+    # Forwarder: key the incoming query, then answer from the cache.
+    def parse_before():
+        query = dns.message.from_wire(query_wire)
+        question = query.question[0]
+        return query.id, (question.name.to_text().lower(), question.rdtype)
+
+    def parse_after():
+        return dns_wire.parse_query(query_wire)
+
+    def cache_hit_before():
+        response = dns.message.from_wire(response_wire)
+        response.id = 1234
+        for section in (response.answer, response.authority, response.additional):
+            for rrset in section:
+                rrset.ttl = max(rrset.ttl - 5, 0)
+        return response.to_wire()
+
+    cache = dns_cache.DNSCache()
+    key = cache.make_key(dns_wire.parse_query(query_wire)[1], None)
+    cache.put(key, response_wire)
+    # Five seconds into the TTL, so every record's TTL gets rewritten.
+    cache._entries[key].stored_at -= 5
+
+    def cache_hit_after():
+        return cache.get(key, 1234)
+
+    def cache_store_before():
+        response = dns.message.from_wire(response_wire)
+        ttl = min(rrset.ttl for rrset in response.answer)
+        return response.to_wire(), ttl
+
+    def cache_store_after():
+        cache.put(key, response_wire)
+
+    return {
+        "probe_build_query": (query_before, query_after),
+        "probe_read_answers": (answers_before, answers_after),
+        "forward_parse_query": (parse_before, parse_after),
+        "forward_cache_hit": (cache_hit_before, cache_hit_after),
+        "forward_cache_store": (cache_store_before, cache_store_after),
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    response_wire = make_response(args.answers)
+    results = {}
+    for name, (before, after) in cases(response_wire).items():
+        for function in (before, after):
+            cpu_us(function, max(args.iterations // 10, 1))
+        before_us = cpu_us(before, args.iterations)
+        after_us = cpu_us(after, args.iterations)
+        results[name] = {
+            "before_us": round(before_us, 2),
+            "after_us": round(after_us, 2),
+            "speedup": round(before_us / after_us, 2) if after_us else None,
+        }
+
+    # One probe lookup and one cache-hit forward, end to end.
+    totals = {}
+    for path, steps in (
+        ("probe", ("probe_build_query", "probe_read_answers")),
+        ("forward_cache_hit", ("forward_parse_query", "forward_cache_hit")),
+    ):
+        before_us = sum(results[s]["before_us"] for s in steps)
+        after_us = sum(results[s]["after_us"] for s in steps)
+        totals[path] = {
+            "before_us": round(before_us, 2),
+            "after_us": round(after_us, 2),
+            "speedup": round(before_us / after_us, 2) if after_us else None,
+        }
+
+    return {
+        "config": {
+            "iterations": args.iterations,
+            "answers": args.answers,
+            "response_bytes": len(response_wire),
+            "python": sys.version.split()[0],
+        },
+        "per_query": totals,
+        "steps": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument(
+        "--answers", type=int, default=4, help="A records in the test response"
+    )
+    parser.add_argument("--output", help="also write the JSON report here")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
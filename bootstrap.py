@@ -0,0 +1,320 @@
+"""Pre-resolved addresses of DoH and DoT upstreams given by hostname.
+
+A hostname's A and AAAA records are looked up in parallel through the
+shared system resolver and refreshed in the background before they expire,
+so opening a connection never waits for a lookup once the name is known.
+Connections then race the addresses Happy Eyeballs style (RFC 8305): IPv6
+and IPv4 addresses are interleaved, a new attempt starts every
+``attempt_delay`` seconds or as soon as the previous one fails, and the
+first to connect wins. The winning address is pinned and tried first next
+time.
+"""
+
+import asyncio
+import inspect
+import ipaddress
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from urllib.parse import urlsplit
+
+import dns.rdatatype
+
+import config
+import singleflight
+import system_resolver
+import upstreams
+
+T = TypeVar("T")
+
+
+class BootstrapError(OSError):
+    """Raised when an upstream hostname has no usable address."""
+
+
+def is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def upstream_host(server_type: str, server: str) -> Optional[str]:
+    """Hostname a DoH or DoT upstream connects to, or None for an IP."""
+    if server_type == "doh":
+        host = urlsplit(server).hostname
+    elif server_type == "dot":
+        host = upstreams.split_host_port(server, 853)[0]
+    else:
+        return None
+    return host if host and not is_ip(host) else None
+
+
+def _interleave(*families: list[str]) -> list[str]:
+    merged = []
+    for i in range(max(map(len, families))):
+        merged.extend(family[i] for family in families if i < len(family))
+    return merged
+
+
+class _Host:
+    __slots__ = ("addresses", "pinned", "resolved_at", "expires_at", "error")
+
+    def __init__(self):
+        self.addresses: list[str] = []
+        self.pinned: Optional[str] = None
+        self.resolved_at = 0.0
+        self.expires_at = 0.0
+        self.error: Optional[str] = None
+
+
+class AddressBook:
+    """Bootstrap addresses of upstream hostnames, keyed by hostname.
+
+    Refresh times follow the records' TTL, bounded by ``min_refresh`` and
+    ``refresh_interval``. If a refresh fails, the previous addresses are
+    kept and the lookup is retried after ``min_refresh`` seconds.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = 300.0,
+        min_refresh: float = 30.0,
+        attempt_delay: float = 0.25,
+        timeout: float = 5.0,
+        max_hosts: int = 1024,
+    ):
+        self.refresh_interval = refresh_interval
+        self.min_refresh = min(min_refresh, refresh_interval)
+        self.attempt_delay = attempt_delay
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self._hosts: "OrderedDict[str, _Host]" = OrderedDict()
+        self._lookups = singleflight.SingleFlight()
+        self.network_backend = _PinnedBackend(self)
+
+    def _entry(self, host: str) -> _Host:
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = _Host()
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        return entry
+
+    async def _resolve_family(self, host: str, rdtype: int) -> tuple[list[str], int]:
+        import dns.resolver
+
+        try:
+            answer = await system_resolver.resolver.resolve(host, rdtype, self.timeout)
+        except dns.resolver.NoAnswer:
+            return [], self.refresh_interval
+        return [rr.address for rr in answer], answer.rrset.ttl
+
+    async def _lookup(self, host: str) -> None:
+        entry = self._entry(host)
+        results = await asyncio.gather(
+            self._resolve_family(host, dns.rdatatype.AAAA),
+            self._resolve_family(host, dns.rdatatype.A),
+            return_exceptions=True,
+        )
+        # IPv6 first, then alternating families (RFC 8305 section 4).
+        found = [r for r in results if not isinstance(r, BaseException) and r[0]]
+        now = time.monotonic()
+        if not found:
+            errors = [r for r in results if isinstance(r, BaseException)]
+            entry.error = str(errors[0]) if errors else "No A or AAAA records"
+            entry.expires_at = now + self.min_refresh
+            return
+
+        entry.addresses = _interleave(*(addresses for addresses, _ in found))
+        ttl = min(ttl for _, ttl in found)
+        if entry.pinned not in entry.addresses:
+            entry.pinned = None
+        entry.error = None
+        entry.resolved_at = now
+        entry.expires_at = now + min(max(ttl, self.min_refresh), self.refresh_interval)
+
+    async def refresh(self, host: str) -> None:
+        """Look ``host`` up again, sharing a lookup already in progress."""
+        await self._lookups.do(host, lambda: self._lookup(host))
+
+    async def addresses(self, host: str) -> list[str]:
+        """Addresses to try for ``host``, pinned address first.
+
+        Only a host seen for the first time waits for a lookup; expired
+        addresses are returned as they are while a refresh runs.
+        """
+        if is_ip(host):
+            return [host]
+        entry = self._entry(host)
+        if not entry.addresses:
+            await self.refresh(host)
+            if not entry.addresses:
+                raise BootstrapError(f"Cannot resolve {host}: {entry.error}")
+        elif time.monotonic() >= entry.expires_at:
+            asyncio.ensure_future(self.refresh(host))
+        if entry.pinned is None:
+            return list(entry.addresses)
+        return [entry.pinned] + [a for a in entry.addresses if a != entry.pinned]
+
+    async def connect(
+        self,
+        host: str,
+        attempt: Callable[[str], Awaitable[T]],
+        close: Callable[[T], Any],
+    ) -> T:
+        """Race ``attempt(address)`` over the addresses of ``host``.
+
+        The first attempt to succeed is returned and its address pinned;
+        ``close`` is called on any other attempt that still connects.
+        """
+        addresses = await self.addresses(host)
+        address, result = await self._race(addresses, attempt, close)
+        if not is_ip(host) and host in self._hosts:
+            self._hosts[host].pinned = address
+        return result
+
+    async def _race(
+        self,
+        addresses: list[str],
+        attempt: Callable[[str], Awaitable[T]],
+        close: Callable[[T], Any],
+    ) -> tuple[str, T]:
+        started: dict[asyncio.Future, str] = {}
+        pending: set[asyncio.Future] = set()
+        winner: Optional[asyncio.Future] = None
+        last_error: BaseException = BootstrapError("No addresses to connect to")
+        remaining = iter(addresses)
+        try:
+            while winner is None:
+                address = next(remaining, None)
+                if address is not None:
+                    task = asyncio.ensure_future(attempt(address))
+                    started[task] = address
+                    pending.add(task)
+                if not pending:
+                    raise last_error
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.attempt_delay if address is not None else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif winner is None:
+                        winner = task
+            return started[winner], winner.result()
+        finally:
+            for task in started:
+                if task is not winner:
+                    task.add_done_callback(lambda t: _close_result(t, close))
+                    task.cancel()
+
+    async def open_connection(
+        self, host: str, port: int
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """``asyncio.open_connection`` to ``host`` over its raced addresses."""
+        return await self.connect(
+            host,
+            lambda address: asyncio.open_connection(address, port),
+            lambda streams: streams[1].close(),
+        )
+
+    async def run(self, hosts: list[str]) -> None:
+        """Resolve ``hosts`` now, then keep every known host refreshed."""
+        for host in hosts:
+            self._entry(host)
+        while True:
+            now = time.monotonic()
+            due = [host for host, e in self._hosts.items() if e.expires_at <= now]
+            await asyncio.gather(*(self.refresh(host) for host in due))
+            next_due = min(
+                (e.expires_at for e in self._hosts.values()),
+                default=now + self.refresh_interval,
+            )
+            delay = min(next_due - time.monotonic(), self.min_refresh)
+            await asyncio.sleep(max(delay, 1.0))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            host: {
+                "addresses": e.addresses,
+                "pinned": e.pinned,
+                "age_seconds": round(now - e.resolved_at, 1) if e.addresses else None,
+                "error": e.error,
+            }
+            for host, e in self._hosts.items()
+        }
+
+
+def _close_result(task: asyncio.Future, close: Callable[[Any], Any]) -> None:
+    if task.cancelled() or task.exception() is not None:
+        return
+    closing = close(task.result())
+    if inspect.isawaitable(closing):
+        asyncio.ensure_future(closing)
+
+
+class _PinnedBackend:
+    """httpcore network backend connecting through an ``AddressBook``.
+
+    TLS still uses the URL's hostname for SNI and certificate checks; only
+    the TCP connection goes to the raced address. httpcore only calls the
+    backend's methods, so this need not subclass (and import) it until a
+    DoH client is actually created.
+    """
+
+    def __init__(self, book: AddressBook):
+        self._book = book
+        self._default_backend = None
+
+    @property
+    def _backend(self):
+        if self._default_backend is None:
+            import httpcore
+
+            self._default_backend = httpcore.AnyIOBackend()
+        return self._default_backend
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float] = None,
+        local_address: Optional[str] = None,
+        socket_options=None,
+    ):
+        import httpcore
+
+        try:
+            return await asyncio.wait_for(
+                self._book.connect(
+                    host,
+                    lambda address: self._backend.connect_tcp(
+                        address, port, timeout, local_address, socket_options
+                    ),
+                    lambda stream: stream.aclose(),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError as e:
+            raise httpcore.ConnectTimeout(f"Timed out connecting to {host}") from e
+        except BootstrapError as e:
+            raise httpcore.ConnectError(str(e)) from e
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+addresses = AddressBook(
+    refresh_interval=config.BOOTSTRAP_REFRESH,
+    attempt_delay=config.HAPPY_EYEBALLS_DELAY,
+)
@@ -0,0 +1,131 @@
+"""Runtime settings, overridable through ``EZDNS_*`` environment variables."""
+
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Server started by ``python app.py``. With more than one worker process,
+# the response cache and upstream health are shared through a SQLite file
+# (a temporary file unless EZDNS_SHARED_STATE_PATH is set)
+HOST = os.environ.get("EZDNS_HOST") or "0.0.0.0"
+PORT = _env_int("EZDNS_PORT", 8000)
+WORKERS = _env_int("EZDNS_WORKERS", 1)
+SHARED_STATE_PATH = os.environ.get("EZDNS_SHARED_STATE_PATH") or ""
+# Seconds between reloads of the other workers' upstream health records
+SHARED_HEALTH_REFRESH = _env_float("EZDNS_SHARED_HEALTH_REFRESH", 0.5)
+
+# DoH forwarder response cache
+CACHE_ENABLED = _env_bool("EZDNS_CACHE_ENABLED", True)
+CACHE_MAX_ENTRIES = _env_int("EZDNS_CACHE_MAX_ENTRIES", 4096)
+CACHE_MAX_TTL = _env_int("EZDNS_CACHE_MAX_TTL", 86400)
+CACHE_MAX_NEGATIVE_TTL = _env_int("EZDNS_CACHE_MAX_NEGATIVE_TTL", 3600)
+# Serve expired answers for this long when every upstream fails (0 disables)
+CACHE_STALE_TTL = _env_int("EZDNS_CACHE_STALE_TTL", 86400)
+CACHE_STALE_ANSWER_TTL = _env_int("EZDNS_CACHE_STALE_ANSWER_TTL", 30)
+# Refresh entries hit this often (0 disables) once this fraction of TTL is left
+PREFETCH_MIN_HITS = _env_int("EZDNS_PREFETCH_MIN_HITS", 3)
+PREFETCH_WINDOW = _env_float("EZDNS_PREFETCH_WINDOW", 0.1)
+
+# EDNS Client Subnet of forwarded queries: passthrough, strip or synthesize
+# (add the client's subnet, with these prefix lengths, when it sent none).
+# DoH clients' addresses come from this header when set (e.g. X-Real-IP
+# behind a reverse proxy), otherwise from the connection
+ECS_MODE = (os.environ.get("EZDNS_ECS_MODE") or "passthrough").strip().lower()
+ECS_PREFIX_V4 = _env_int("EZDNS_ECS_PREFIX_V4", 24)
+ECS_PREFIX_V6 = _env_int("EZDNS_ECS_PREFIX_V6", 56)
+ECS_CLIENT_IP_HEADER = os.environ.get("EZDNS_ECS_CLIENT_IP_HEADER") or ""
+
+# Pooled DoH upstream clients
+DOH_HTTP2 = _env_bool("EZDNS_DOH_HTTP2", True)
+DOH_MAX_CONNECTIONS = _env_int("EZDNS_DOH_MAX_CONNECTIONS", 10)
+DOH_MAX_KEEPALIVE = _env_int("EZDNS_DOH_MAX_KEEPALIVE", 10)
+DOH_KEEPALIVE_EXPIRY = _env_float("EZDNS_DOH_KEEPALIVE_EXPIRY", 60.0)
+DOH_MAX_CLIENTS = _env_int("EZDNS_DOH_MAX_CLIENTS", 64)
+
+# Persistent DoT upstream connections
+DOT_IDLE_TIMEOUT = _env_float("EZDNS_DOT_IDLE_TIMEOUT", 30.0)
+
+# UDP transport: advertised EDNS(0) buffer (0 = no EDNS) and the pooled TCP
+# connections used when a UDP answer is truncated
+UDP_EDNS_BUFFER = _env_int("EZDNS_UDP_EDNS_BUFFER", 1232)
+TCP_IDLE_TIMEOUT = _env_float("EZDNS_TCP_IDLE_TIMEOUT", 10.0)
+
+# Addresses of DoH/DoT upstreams given by hostname: refreshed at least this
+# often (seconds), and raced IPv6/IPv4 with this delay between attempts
+BOOTSTRAP_REFRESH = _env_float("EZDNS_BOOTSTRAP_REFRESH", 300.0)
+HAPPY_EYEBALLS_DELAY = _env_float("EZDNS_HAPPY_EYEBALLS_DELAY", 0.25)
+
+# Upstream selection and health tracking
+RACE_FANOUT = _env_int("EZDNS_RACE_FANOUT", 2)
+HEDGE_DELAY = _env_float("EZDNS_HEDGE_DELAY", 0.2)
+LATENCY_EWMA_ALPHA = _env_float("EZDNS_LATENCY_EWMA_ALPHA", 0.3)
+BREAKER_FAILURE_THRESHOLD = _env_int("EZDNS_BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_COOLDOWN = _env_float("EZDNS_BREAKER_COOLDOWN", 30.0)
+
+# Upstream query scheduler: cap on queries in flight (0 = unlimited), queue
+# for queries over a limit, and the default per-upstream rate (0 = none; a
+# burst of 0 means the same as the rate). DEFAULT_SERVERS entries and
+# ``type://server#qps=..&burst=..`` strings override the rate.
+MAX_IN_FLIGHT = _env_int("EZDNS_MAX_IN_FLIGHT", 256)
+MAX_BACKLOG = _env_int("EZDNS_MAX_BACKLOG", 1024)
+MAX_QUEUE_WAIT = _env_float("EZDNS_MAX_QUEUE_WAIT", 2.0)
+UPSTREAM_QPS = _env_float("EZDNS_UPSTREAM_QPS", 0.0)
+UPSTREAM_BURST = _env_float("EZDNS_UPSTREAM_BURST", 0.0)
+
+# Answers cached by the shared system resolver behind the ``local`` upstream
+# (0 disables, so ``local`` probes always measure a round trip)
+LOCAL_RESOLVER_CACHE_SIZE = _env_int("EZDNS_LOCAL_RESOLVER_CACHE_SIZE", 0)
+
+# Open connections to the default DoH/DoT upstreams at startup; /api/ready
+# reports ready once this is done (or after the timeout, in seconds)
+WARMUP = _env_bool("EZDNS_WARMUP", True)
+WARMUP_TIMEOUT = _env_float("EZDNS_WARMUP_TIMEOUT", 5.0)
+
+# Plain DNS (UDP/TCP) listener in front of the forwarder
+DNS_LISTEN = _env_bool("EZDNS_DNS_LISTEN", False)
+DNS_LISTEN_HOST = os.environ.get("EZDNS_DNS_LISTEN_HOST") or "0.0.0.0"
+DNS_LISTEN_PORT = _env_int("EZDNS_DNS_LISTEN_PORT", 53)
+# TCP connections are closed after this many seconds without a query,
+# further connections are refused while this many are open, and each
+# connection answers at most this many pipelined queries at a time
+DNS_LISTEN_IDLE_TIMEOUT = _env_float("EZDNS_DNS_LISTEN_IDLE_TIMEOUT", 10.0)
+DNS_LISTEN_MAX_CONNECTIONS = _env_int("EZDNS_DNS_LISTEN_MAX_CONNECTIONS", 512)
+DNS_LISTEN_MAX_PIPELINED = _env_int("EZDNS_DNS_LISTEN_MAX_PIPELINED", 16)
+
+# Scheduled probes kept as latency history: ``server domain [type] [interval]``
+# entries separated by ``;`` (none = disabled), the database they are written
+# to, and how many days raw samples and minute/hour rollups are kept
+HISTORY_CHECKS = os.environ.get("EZDNS_HISTORY_CHECKS") or ""
+HISTORY_INTERVAL = _env_float("EZDNS_HISTORY_INTERVAL", 60.0)
+HISTORY_PATH = os.environ.get("EZDNS_HISTORY_PATH") or "ezdns-history.sqlite"
+HISTORY_RAW_DAYS = _env_float("EZDNS_HISTORY_RAW_DAYS", 2.0)
+HISTORY_MINUTE_DAYS = _env_float("EZDNS_HISTORY_MINUTE_DAYS", 14.0)
+HISTORY_HOUR_DAYS = _env_float("EZDNS_HISTORY_HOUR_DAYS", 400.0)
+
+# Batch benchmark endpoint
+BATCH_MAX_DOMAINS = _env_int("EZDNS_BATCH_MAX_DOMAINS", 100000)
+BATCH_CONCURRENCY = _env_int("EZDNS_BATCH_CONCURRENCY", 50)
+BATCH_MAX_CONCURRENCY = _env_int("EZDNS_BATCH_MAX_CONCURRENCY", 500)
+
+# Repeated-sample benchmark mode of /api/test and /api/query
+BENCHMARK_MAX_SAMPLES = _env_int("EZDNS_BENCHMARK_MAX_SAMPLES", 100)
+
+# Echo per-stage timings in every /dns-query and /api/query response, as if
+# ``debug=true`` had been passed
+DEBUG_TIMINGS = _env_bool("EZDNS_DEBUG_TIMINGS", False)
@@ -0,0 +1,294 @@
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import dns.edns
+import dns.message
+import dns.rcode
+import dns.rdatatype
+
+import dns_wire
+import shared_state
+
+
+class _Entry:
+    __slots__ = (
+        "wire",
+        "ttl_offsets",
+        "stored_at",
+        "expires_at",
+        "hits",
+        "prefetching",
+    )
+
+    def __init__(
+        self, wire: bytes, ttl_offsets: list[int], stored_at: float, expires_at: float
+    ):
+        self.wire = wire
+        self.ttl_offsets = ttl_offsets
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.hits = 0
+        self.prefetching = False
+
+
+class DNSCache:
+    """TTL-aware LRU cache of upstream DNS responses.
+
+    Entries are keyed by (qname, qtype, qclass, upstream, partition), the
+    partition telling apart answers to queries with different EDNS, DO/CD/AD
+    bits or client subnet (see ``edns.EcsPolicy``). Positive answers
+    live for the smallest TTL in the answer section, negative answers
+    (NXDOMAIN / NODATA) for the SOA minimum as described in RFC 2308.
+
+    Expired entries are kept for another ``stale_ttl`` seconds so they can
+    be served when every upstream fails (RFC 8767). Entries hit at least
+    ``prefetch_min_hits`` times are flagged for refresh once less than
+    ``prefetch_window`` of their TTL remains.
+
+    With a ``shared`` store, responses are written through to it and looked
+    up there when the local entry is missing or expired, so the worker
+    processes of one deployment share their answers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        max_ttl: int = 86400,
+        max_negative_ttl: int = 3600,
+        stale_ttl: int = 86400,
+        stale_answer_ttl: int = 30,
+        prefetch_min_hits: int = 3,
+        prefetch_window: float = 0.1,
+        shared: Optional[shared_state.SharedStore] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.stale_ttl = stale_ttl
+        self.stale_answer_ttl = stale_answer_ttl
+        self.prefetch_min_hits = prefetch_min_hits
+        self.prefetch_window = prefetch_window
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.shared_loads = 0
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+
+    @staticmethod
+    def make_key(
+        question: tuple, upstream: Optional[str], partition: tuple = ()
+    ) -> tuple:
+        """Key for a ``dns_wire.parse_query`` question sent to ``upstream``."""
+        return (*question, upstream or "", partition)
+
+    def _lookup(self, key: tuple, now: float) -> Optional[_Entry]:
+        """The entry for ``key``, dropping it once past its stale window."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at + self.stale_ttl <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def _find(self, key: tuple, now: float) -> Optional[_Entry]:
+        """``_lookup``, falling back to the shared store for a fresher entry."""
+        entry = self._lookup(key, now)
+        if self.shared is None or (entry is not None and entry.expires_at > now):
+            return entry
+        row = self.shared.cache_get(key)
+        if row is None:
+            return entry
+
+        wire, stored_at, expires_at = row
+        # Move the stored wall-clock times onto this process's monotonic clock.
+        shift = now - time.time()
+        expires_at += shift
+        if expires_at + self.stale_ttl <= now or (
+            entry is not None and expires_at <= entry.expires_at
+        ):
+            return entry
+        entry = _Entry(
+            wire,
+            dns_wire.WireMessage(wire).ttl_offsets(),
+            stored_at + shift,
+            expires_at,
+        )
+        self._store(key, entry)
+        self.shared_loads += 1
+        return entry
+
+    def _store(self, key: tuple, entry: _Entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(
+        self,
+        key: tuple,
+        query_id: int,
+        fallback: Optional[tuple] = None,
+        qname: Optional[bytes] = None,
+    ) -> Optional[bytes]:
+        """Return the cached response for ``key`` re-stamped with ``query_id``.
+
+        Without a fresh entry for ``key``, the one for ``fallback`` is used.
+        The ID, the asker's spelling of the name (``qname``, see
+        ``dns_wire.restore_qname``) and the elapsed TTLs are patched straight
+        into a copy of the stored wire; the message is never decoded.
+        """
+        now = time.monotonic()
+        entry = self._find(key, now)
+        if (entry is None or entry.expires_at <= now) and fallback is not None:
+            key, entry = fallback, self._find(fallback, now)
+        if entry is None or entry.expires_at <= now:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+
+        wire = bytearray(entry.wire)
+        struct.pack_into("!H", wire, 0, query_id)
+        if qname is not None:
+            dns_wire.restore_qname(wire, qname)
+        elapsed = int(now - entry.stored_at)
+        if elapsed:
+            for offset in entry.ttl_offsets:
+                (ttl,) = struct.unpack_from("!I", wire, offset)
+                struct.pack_into("!I", wire, offset, max(ttl - elapsed, 0))
+        return bytes(wire)
+
+    def get_stale(
+        self,
+        key: tuple,
+        query_id: int,
+        fallback: Optional[tuple] = None,
+        qname: Optional[bytes] = None,
+    ) -> Optional[bytes]:
+        """Return an expired response for ``key`` still inside its stale window.
+
+        TTLs are capped at ``stale_answer_ttl`` and, for EDNS responses, a
+        "Stale Answer" extended DNS error (RFC 8914) is attached.
+        """
+        now = time.monotonic()
+        entry = self._find(key, now)
+        if entry is None and fallback is not None:
+            entry = self._find(fallback, now)
+        if entry is None or not self.stale_ttl:
+            return None
+
+        self.stale_hits += 1
+        response = dns.message.from_wire(entry.wire)
+        response.id = query_id
+        for section in (response.answer, response.authority, response.additional):
+            for rrset in section:
+                rrset.ttl = min(rrset.ttl, self.stale_answer_ttl)
+        if response.edns >= 0:
+            response.use_edns(
+                response.edns,
+                response.ednsflags,
+                response.payload,
+                options=[
+                    *response.options,
+                    dns.edns.EDEOption(dns.edns.EDECode.STALE_ANSWER),
+                ],
+            )
+        wire = bytearray(response.to_wire())
+        if qname is not None:
+            dns_wire.restore_qname(wire, qname)
+        return bytes(wire)
+
+    def should_prefetch(self, key: tuple) -> bool:
+        """Whether a popular entry is close enough to expiry to refresh now.
+
+        Returns true at most once per stored response.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry.prefetching or not self.prefetch_min_hits:
+            return False
+        if entry.hits < self.prefetch_min_hits:
+            return False
+        ttl = entry.expires_at - entry.stored_at
+        if entry.expires_at - time.monotonic() > ttl * self.prefetch_window:
+            return False
+        entry.prefetching = True
+        self.prefetches += 1
+        return True
+
+    def put(self, key: tuple, wire: bytes) -> None:
+        """Store the wire-format response ``wire`` if it is cacheable."""
+        response = dns_wire.WireMessage(wire)
+        ttl = self._response_ttl(response)
+        if not ttl:
+            return
+
+        now = time.monotonic()
+        self._store(key, _Entry(wire, response.ttl_offsets(), now, now + ttl))
+        if self.shared is not None:
+            wall_now = time.time()
+            self.shared.cache_put(
+                key,
+                wire,
+                wall_now,
+                wall_now + ttl,
+                keep_for=self.stale_ttl,
+                max_entries=self.max_entries,
+            )
+
+    def clear(self) -> None:
+        self._entries.clear()
+        if self.shared is not None:
+            self.shared.cache_clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "prefetches": self.prefetches,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+        if self.shared is not None:
+            stats["shared_entries"] = self.shared.cache_size()
+            stats["shared_loads"] = self.shared_loads
+        return stats
+
+    def _response_ttl(self, response: dns_wire.WireMessage) -> int:
+        if response.truncated:
+            return 0
+
+        rcode = response.rcode()
+        if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            return 0
+
+        answer_ttl = None
+        negative_ttl = None
+        for section, rdtype, _, ttl, offset, length in response.records():
+            if section == dns_wire.ANSWER:
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+            elif section == dns_wire.AUTHORITY and rdtype == dns.rdatatype.SOA:
+                # MINIMUM is the last field of the SOA rdata.
+                (minimum,) = struct.unpack_from(
+                    "!I", response.wire, offset + length - 4
+                )
+                negative_ttl = min(ttl, minimum)
+                break
+            elif section == dns_wire.ADDITIONAL:
+                break
+
+        if rcode == dns.rcode.NOERROR and answer_ttl is not None:
+            return min(answer_ttl, self.max_ttl)
+        if negative_ttl is not None:
+            return min(negative_ttl, self.max_negative_ttl)
+        return 0
@@ -0,0 +1,187 @@
+"""Plain DNS (port 53 style) UDP/TCP listener in front of the forwarder.
+
+The listener only handles framing; every packet is passed to the same
+``handler(wire, client_ip) -> wire`` coroutine that backs ``/dns-query``.
+"""
+
+import asyncio
+import struct
+from typing import Awaitable, Callable, Optional
+
+import dns_wire
+
+Handler = Callable[[bytes, Optional[str]], Awaitable[bytes]]
+
+# Largest UDP response a client without EDNS can receive (RFC 1035).
+CLASSIC_UDP_SIZE = 512
+# Queries of one TCP connection answered at a time; the connection is not
+# read while this many are in flight.
+MAX_PIPELINED = 16
+
+
+def _udp_payload_limit(query_wire: bytes) -> int:
+    try:
+        payload = dns_wire.WireMessage(query_wire).edns_payload()
+    except dns_wire.WireError:
+        return CLASSIC_UDP_SIZE
+    if payload is not None:
+        return max(payload, CLASSIC_UDP_SIZE)
+    return CLASSIC_UDP_SIZE
+
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, handler: Handler):
+        self.handler = handler
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Strong references, so the loop does not drop running responses.
+        self.tasks: set[asyncio.Future] = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(self._respond(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _respond(self, data: bytes, addr) -> None:
+        try:
+            response = await self.handler(data, addr[0])
+            if len(response) > _udp_payload_limit(data):
+                # The client then retries over TCP (RFC 7766).
+                response = dns_wire.truncate(response)
+        except Exception:
+            # Unparseable packets get no answer, like most resolvers.
+            return
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+
+async def _handle_tcp(
+    handler: Handler,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    idle_timeout: Optional[float] = None,
+    max_pipelined: int = MAX_PIPELINED,
+) -> None:
+    lock = asyncio.Lock()
+    slots = asyncio.Semaphore(max_pipelined)
+    tasks = set()
+    peer = writer.get_extra_info("peername")
+    client_ip = peer[0] if peer else None
+
+    async def respond(data: bytes) -> None:
+        try:
+            response = await handler(data, client_ip)
+            async with lock:
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except Exception:
+            pass
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            await slots.acquire()
+            # Idle or slow clients must not hold a connection forever.
+            (length,) = struct.unpack(
+                "!H", await asyncio.wait_for(reader.readexactly(2), idle_timeout)
+            )
+            data = await asyncio.wait_for(reader.readexactly(length), idle_timeout)
+            # Queries on one connection are answered as they complete.
+            task = asyncio.ensure_future(respond(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+
+class DNSListener:
+    """UDP and TCP DNS servers bound to the same address and port.
+
+    With ``reuse_port``, several worker processes can each run a listener
+    on the same port and the kernel spreads the queries between them.
+
+    TCP connections are closed after ``idle_timeout`` seconds without a
+    complete query, and new ones are closed straight away while
+    ``max_connections`` are open. Each answers at most ``max_pipelined``
+    queries at a time.
+    """
+
+    def __init__(
+        self,
+        handler: Handler,
+        host: str = "0.0.0.0",
+        port: int = 53,
+        reuse_port: bool = False,
+        idle_timeout: Optional[float] = 10.0,
+        max_connections: int = 512,
+        max_pipelined: int = MAX_PIPELINED,
+    ):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.max_pipelined = max_pipelined
+        self._udp_transport: Optional[asyncio.DatagramTransport] = None
+        self._udp_protocol: Optional[UDPServerProtocol] = None
+        self._tcp_server: Optional[asyncio.AbstractServer] = None
+        # Open TCP connections and the tasks serving them.
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    async def _accept(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        if len(self._connections) >= self.max_connections:
+            writer.close()
+            return
+        self._connections[writer] = asyncio.current_task()
+        try:
+            await _handle_tcp(
+                self.handler, reader, writer, self.idle_timeout, self.max_pipelined
+            )
+        finally:
+            self._connections.pop(writer, None)
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._udp_transport, self._udp_protocol = await loop.create_datagram_endpoint(
+            lambda: UDPServerProtocol(self.handler),
+            local_addr=(self.host, self.port),
+            reuse_port=self.reuse_port,
+        )
+        self._tcp_server = await asyncio.start_server(
+            self._accept,
+            self.host,
+            self.port,
+            reuse_port=self.reuse_port,
+        )
+
+    async def stop(self) -> None:
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+            self._udp_transport = None
+        if self._udp_protocol is not None:
+            tasks = list(self._udp_protocol.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._udp_protocol = None
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+            # Open connections end at their next read instead of idling on.
+            connections = list(self._connections.items())
+            for writer, _ in connections:
+                writer.close()
+            await asyncio.gather(
+                *(task for _, task in connections), return_exceptions=True
+            )
+            await self._tcp_server.wait_closed()
+            self._tcp_server = None
@@ -1,118 +1,246 @@
-import dns.message
-import dns.query
+import asyncio
+import contextlib
+import config
+import secrets
+import dns.rcode
 import dns.rdatatype
-import dns.resolver
-import httpx
+import dns_wire
+import edns
+import doh_pool
+import dot_pool
+import forwarder
+import latency_stats
+import metrics
+import ratelimit
+import system_resolver
+import upstreams
 import time
-import ssl
 
-
-def test_udp(
-    server_ip: str, domain: str, record_type: str = "ALL", timeout: float = 5.0
+TYPE_MAP = {
+    "A": [dns.rdatatype.A],
+    "AAAA": [dns.rdatatype.AAAA],
+    "CNAME": [dns.rdatatype.CNAME],
+    "MX": [dns.rdatatype.MX],
+    "TXT": [dns.rdatatype.TXT],
+    "NS": [dns.rdatatype.NS],
+    "SOA": [dns.rdatatype.SOA],
+    "BOTH": [dns.rdatatype.A, dns.rdatatype.AAAA],
+    "ALL": [
+        dns.rdatatype.A,
+        dns.rdatatype.AAAA,
+        dns.rdatatype.CNAME,
+        dns.rdatatype.MX,
+        dns.rdatatype.TXT,
+        dns.rdatatype.NS,
+    ],
+}
+
+
+def _collect_answers(response: dns_wire.WireMessage, rdtype, record_type: str):
+    """Format the answer records relevant to ``rdtype``; return (answers, ttl)."""
+    return response.answers(rdtype, any_type=record_type == "ALL")
+
+
+def _ecs_option(ecs: str | None) -> bytes | None:
+    """ECS option data for a probe's ``address/prefix`` subnet."""
+    return edns.ClientSubnet.from_text(ecs).to_option() if ecs else None
+
+
+def _note_edns(response: dns_wire.WireMessage, details: dict) -> None:
+    """Record the AD bit and ECS scope of a probe answer in ``details``.
+
+    A multi-type probe is ``authenticated`` only if every answer was, and
+    reports the most specific scope any answer had.
+    """
+    details["authenticated"] = (
+        details.get("authenticated", True) and response.authenticated
+    )
+    for code, data in response.edns_options():
+        if code == dns_wire.OPTION_ECS:
+            scope = edns.ClientSubnet.from_option(data)[1]
+            details["ecs_scope"] = max(details.get("ecs_scope", 0), scope)
+
+
+async def _query_types(record_type: str, query_type, slot=None) -> dict:
+    """Run ``query_type(rdtype)`` for every rdtype of ``record_type`` at once.
+
+    Each ``query_type`` call runs inside ``slot()`` when given, e.g. an
+    ``UpstreamScheduler`` slot, so every upstream query is rate limited; the
+    wait for it is not part of the per-type latency.
+
+    ``query_type`` returns ``(answers, ttl, connection, rcode)``. The merged
+    result reports the wall-clock latency of the whole lookup in
+    ``latency_ms``, the latency of each rdtype in ``type_latency_ms`` and the
+    first non-NOERROR rcode seen (e.g. NXDOMAIN) in ``rcode``.
+    """
+    rdtypes = TYPE_MAP.get(record_type, [dns.rdatatype.A])
+
+    async def timed(rdtype):
+        async with slot() if slot is not None else contextlib.nullcontext():
+            start_time = time.perf_counter()
+            result = await query_type(rdtype)
+            return result, (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(timed(rdtype) for rdtype in rdtypes), return_exceptions=True
+    )
+    wall_duration = (time.perf_counter() - start_time) * 1000
+
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+
+    answers = []
+    ttl = None
+    connection = None
+    rcode = dns.rcode.NOERROR
+    type_latency = {}
+    for rdtype, (
+        (type_answers, type_ttl, type_connection, type_rcode),
+        duration,
+    ) in zip(rdtypes, outcomes):
+        answers.extend(type_answers)
+        if type_ttl is not None:
+            ttl = type_ttl if ttl is None else min(ttl, type_ttl)
+        if type_connection and connection in (None, "warm"):
+            connection = type_connection
+        if rcode == dns.rcode.NOERROR:
+            rcode = type_rcode
+        type_latency[dns.rdatatype.to_text(rdtype)] = round(duration, 2)
+
+    result = {
+        "status": "success",
+        "latency_ms": round(wall_duration, 2),
+        "type_latency_ms": type_latency,
+        "answers": answers,
+        "ttl": ttl,
+        "rcode": dns.rcode.to_text(rcode),
+    }
+    if connection:
+        result["connection"] = connection
+    return result
+
+
+async def test_udp(
+    server_ip: str,
+    domain: str,
+    record_type: str = "ALL",
+    timeout: float = 5.0,
+    dnssec: bool = False,
+    ecs: str | None = None,
+    slot=None,
 ):
-    """Test DNS resolution via UDP."""
-    try:
-        answers = []
-        total_duration = 0
-
-        type_map = {
-            "A": [dns.rdatatype.A],
-            "AAAA": [dns.rdatatype.AAAA],
-            "CNAME": [dns.rdatatype.CNAME],
-            "MX": [dns.rdatatype.MX],
-            "TXT": [dns.rdatatype.TXT],
-            "NS": [dns.rdatatype.NS],
-            "SOA": [dns.rdatatype.SOA],
-            "BOTH": [dns.rdatatype.A, dns.rdatatype.AAAA],
-            "ALL": [
-                dns.rdatatype.A,
-                dns.rdatatype.AAAA,
-                dns.rdatatype.CNAME,
-                dns.rdatatype.MX,
-                dns.rdatatype.TXT,
-                dns.rdatatype.NS,
-            ],
-        }
-
-        rdtypes = type_map.get(record_type, [dns.rdatatype.A])
-
-        for rdtype in rdtypes:
-            start_time = time.time()
-            query = dns.message.make_query(domain, rdtype)
-            response = dns.query.udp(query, server_ip, timeout=timeout)
-            duration = (time.time() - start_time) * 1000
-            total_duration += duration
+    """Test DNS resolution via UDP.
+
+    Queries advertise an EDNS(0) buffer of ``config.UDP_EDNS_BUFFER`` bytes.
+    A truncated answer is retried over a pooled TCP connection; the result's
+    ``transport`` says which one finally answered and ``attempts`` lists
+    the cost of each try per record type.
+
+    With ``dnssec`` the query sets the DO bit and the result reports the
+    answer's AD bit as ``authenticated``; with an ``ecs`` subnet such as
+    ``203.0.113.0/24`` it carries that Client Subnet and the result reports
+    the upstream's ``ecs_scope``. The DoT and DoH probes take the same
+    options. ``slot`` is passed to ``_query_types``; every probe takes it and
+    lets a refused slot's ``ratelimit.Overloaded`` propagate.
+    """
+    attempts = {}
+    details = {}
+
+    async def query_type(rdtype):
+        wire, message_id = dns_wire.make_query(
+            domain, rdtype, config.UDP_EDNS_BUFFER, dnssec, _ecs_option(ecs)
+        )
+        type_attempts = attempts[dns.rdatatype.to_text(rdtype)] = []
+
+        start_time = time.perf_counter()
+        content = await forwarder.udp_exchange(wire, host, port, timeout)
+        response = dns_wire.parse_response(content, message_id)
+        truncated = response.truncated
+        type_attempts.append(
+            {
+                "transport": "udp",
+                "latency_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                "truncated": truncated,
+            }
+        )
+        if not truncated:
+            if dnssec or ecs:
+                _note_edns(response, details)
+            return (
+                *_collect_answers(response, rdtype, record_type),
+                None,
+                response.rcode(),
+            )
 
-            for rrset in response.answer:
-                actual_type = dns.rdatatype.to_text(rrset.rdtype)
-                if rrset.rdtype == rdtype or record_type == "ALL":
-                    for rr in rrset:
-                        answers.append(f"[{actual_type}] {str(rr)}")
+        start_time = time.perf_counter()
+        content, state = await dot_pool.tcp_pool.query(host, wire, port, timeout)
+        response = dns_wire.parse_response(content, message_id)
+        type_attempts.append(
+            {
+                "transport": "tcp",
+                "latency_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                "connection": state,
+            }
+        )
+        if dnssec or ecs:
+            _note_edns(response, details)
+        return (
+            *_collect_answers(response, rdtype, record_type),
+            state,
+            response.rcode(),
+        )
 
+    try:
+        host, port = upstreams.split_host_port(server_ip, 53)
+        result = await _query_types(record_type, query_type, slot)
+        fell_back = any(len(a) > 1 for a in attempts.values())
         return {
-            "status": "success",
-            "latency_ms": round(total_duration, 2),
-            "answers": answers,
+            **result,
+            **details,
+            "transport": "tcp" if fell_back else "udp",
+            "attempts": attempts,
             "server": server_ip,
         }
+    except ratelimit.Overloaded:
+        raise
     except Exception as e:
         return {"status": "error", "error": str(e), "server": server_ip}
 
 
-def test_dot(
-    server_ip: str, domain: str, record_type: str = "ALL", timeout: float = 5.0
+async def test_dot(
+    server_ip: str,
+    domain: str,
+    record_type: str = "ALL",
+    timeout: float = 5.0,
+    dnssec: bool = False,
+    ecs: str | None = None,
+    slot=None,
 ):
     """Test DNS resolution via DoT (DNS over TLS)."""
-    try:
-        answers = []
-        total_duration = 0
-
-        type_map = {
-            "A": [dns.rdatatype.A],
-            "AAAA": [dns.rdatatype.AAAA],
-            "CNAME": [dns.rdatatype.CNAME],
-            "MX": [dns.rdatatype.MX],
-            "TXT": [dns.rdatatype.TXT],
-            "NS": [dns.rdatatype.NS],
-            "SOA": [dns.rdatatype.SOA],
-            "BOTH": [dns.rdatatype.A, dns.rdatatype.AAAA],
-            "ALL": [
-                dns.rdatatype.A,
-                dns.rdatatype.AAAA,
-                dns.rdatatype.CNAME,
-                dns.rdatatype.MX,
-                dns.rdatatype.TXT,
-                dns.rdatatype.NS,
-            ],
-        }
-
-        rdtypes = type_map.get(record_type, [dns.rdatatype.A])
-
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
+    details = {}
+
+    async def query_type(rdtype):
+        wire, message_id = dns_wire.make_query(
+            domain, rdtype, dnssec=dnssec, ecs=_ecs_option(ecs)
+        )
+        content, state = await dot_pool.pool.query(host, wire, port, timeout)
+        response = dns_wire.parse_response(content, message_id)
+        if dnssec or ecs:
+            _note_edns(response, details)
+        return (
+            *_collect_answers(response, rdtype, record_type),
+            state,
+            response.rcode(),
+        )
 
-        for rdtype in rdtypes:
-            start_time = time.time()
-            query = dns.message.make_query(domain, rdtype)
-            response = dns.query.tls(
-                query, server_ip, timeout=timeout, ssl_context=context
-            )
-            duration = (time.time() - start_time) * 1000
-            total_duration += duration
-
-            for rrset in response.answer:
-                actual_type = dns.rdatatype.to_text(rrset.rdtype)
-                if rrset.rdtype == rdtype or record_type == "ALL":
-                    for rr in rrset:
-                        answers.append(f"[{actual_type}] {str(rr)}")
-
-        return {
-            "status": "success",
-            "latency_ms": round(total_duration, 2),
-            "answers": answers,
-            "server": server_ip,
-        }
+    try:
+        host, port = upstreams.split_host_port(server_ip, 853)
+        result = await _query_types(record_type, query_type, slot)
+        return {**result, **details, "server": server_ip}
+    except ratelimit.Overloaded:
+        raise
     except Exception as e:
         return {"status": "error", "error": str(e), "server": server_ip}
 
@@ -123,123 +251,184 @@ async def test_doh(
     proxy: str | None = None,
     record_type: str = "ALL",
     timeout: float = 5.0,
+    dnssec: bool = False,
+    ecs: str | None = None,
+    slot=None,
 ):
     """Test DNS resolution via DoH (DNS over HTTPS)."""
-    try:
-        answers = []
-        total_duration = 0
-
-        type_map = {
-            "A": [dns.rdatatype.A],
-            "AAAA": [dns.rdatatype.AAAA],
-            "CNAME": [dns.rdatatype.CNAME],
-            "MX": [dns.rdatatype.MX],
-            "TXT": [dns.rdatatype.TXT],
-            "NS": [dns.rdatatype.NS],
-            "SOA": [dns.rdatatype.SOA],
-            "BOTH": [dns.rdatatype.A, dns.rdatatype.AAAA],
-            "ALL": [
-                dns.rdatatype.A,
-                dns.rdatatype.AAAA,
-                dns.rdatatype.CNAME,
-                dns.rdatatype.MX,
-                dns.rdatatype.TXT,
-                dns.rdatatype.NS,
-            ],
-        }
-
-        rdtypes = type_map.get(record_type, [dns.rdatatype.A])
+    details = {}
+
+    async def query_type(rdtype):
+        wire, message_id = dns_wire.make_query(
+            domain, rdtype, dnssec=dnssec, ecs=_ecs_option(ecs)
+        )
+        content, state = await doh_pool.pool.query(url, wire, proxy, timeout)
+        response = dns_wire.parse_response(content, message_id)
+        if dnssec or ecs:
+            _note_edns(response, details)
+        return (
+            *_collect_answers(response, rdtype, record_type),
+            state,
+            response.rcode(),
+        )
 
-        headers = {
-            "Content-Type": "application/dns-message",
-            "Accept": "application/dns-message",
-        }
-
-        client_kwargs = {"verify": False, "timeout": timeout}
-        if proxy:
-            client_kwargs["proxy"] = proxy
-
-        async with httpx.AsyncClient(**client_kwargs) as client:
-            for rdtype in rdtypes:
-                start_time = time.time()
-
-                query = dns.message.make_query(domain, rdtype)
-                wire_data = query.to_wire()
-
-                resp = await client.post(url, content=wire_data, headers=headers)
-                resp.raise_for_status()
+    try:
+        result = await _query_types(record_type, query_type, slot)
+        return {**result, **details, "server": url}
+    except ratelimit.Overloaded:
+        raise
+    except Exception as e:
+        return {"status": "error", "error": str(e), "server": url}
 
-                response = dns.message.from_wire(resp.content)
-                duration = (time.time() - start_time) * 1000
-                total_duration += duration
 
-                for rrset in response.answer:
-                    actual_type = dns.rdatatype.to_text(rrset.rdtype)
-                    if rrset.rdtype == rdtype or record_type == "ALL":
-                        for rr in rrset:
-                            answers.append(f"[{actual_type}] {str(rr)}")
+async def test_local(
+    domain: str, record_type: str = "ALL", timeout: float = 5.0, slot=None
+):
+    """Test DNS resolution via system default resolver.
 
-        return {
-            "status": "success",
-            "latency_ms": round(total_duration, 2),
-            "answers": answers,
-            "server": url,
-        }
-    except Exception as e:
-        return {"status": "error", "error": str(e), "server": url}
+    The system resolver sends its own EDNS options, so the ``dnssec`` and
+    ``ecs`` probe options do not apply here.
+    """
+    import dns.resolver
 
+    async def query_type(rdtype):
+        try:
+            response = await system_resolver.resolver.resolve(domain, rdtype, timeout)
+        except dns.resolver.NoAnswer:
+            return [], None, None, dns.rcode.NOERROR
+        except dns.resolver.NXDOMAIN:
+            return [], None, None, dns.rcode.NXDOMAIN
 
-def test_local(domain: str, record_type: str = "ALL", timeout: float = 5.0):
-    """Test DNS resolution via system default resolver."""
-    try:
         answers = []
-        total_duration = 0
-
-        type_map = {
-            "A": [dns.rdatatype.A],
-            "AAAA": [dns.rdatatype.AAAA],
-            "CNAME": [dns.rdatatype.CNAME],
-            "MX": [dns.rdatatype.MX],
-            "TXT": [dns.rdatatype.TXT],
-            "NS": [dns.rdatatype.NS],
-            "SOA": [dns.rdatatype.SOA],
-            "BOTH": [dns.rdatatype.A, dns.rdatatype.AAAA],
-            "ALL": [
-                dns.rdatatype.A,
-                dns.rdatatype.AAAA,
-                dns.rdatatype.CNAME,
-                dns.rdatatype.MX,
-                dns.rdatatype.TXT,
-                dns.rdatatype.NS,
-            ],
-        }
+        ttl = None
+        actual_type = dns.rdatatype.to_text(response.rdtype)
+        if response.rdtype == rdtype or record_type == "ALL":
+            ttl = response.rrset.ttl
+            for rr in response:
+                answers.append(f"[{actual_type}] {str(rr)}")
+        return answers, ttl, None, dns.rcode.NOERROR
 
-        rdtypes = type_map.get(record_type, [dns.rdatatype.A])
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = timeout
-        resolver.lifetime = timeout
-
-        for rdtype in rdtypes:
-            try:
-                start_time = time.time()
-                response = resolver.resolve(domain, dns.rdatatype.to_text(rdtype))
-                duration = (time.time() - start_time) * 1000
-                total_duration += duration
-
-                actual_type = dns.rdatatype.to_text(response.rdtype)
-                if response.rdtype == rdtype or record_type == "ALL":
-                    for rr in response:
-                        answers.append(f"[{actual_type}] {str(rr)}")
-            except dns.resolver.NoAnswer:
-                continue
-            except dns.resolver.NXDOMAIN:
-                continue
-
-        return {
-            "status": "success",
-            "latency_ms": round(total_duration, 2),
-            "answers": answers,
-            "server": "local",
-        }
+    try:
+        result = await _query_types(record_type, query_type, slot)
+        return {**result, "server": "local"}
+    except ratelimit.Overloaded:
+        raise
     except Exception as e:
         return {"status": "error", "error": str(e), "server": "local"}
+
+
+async def run_probe(
+    server_type: str,
+    server: str,
+    domain: str,
+    record_type: str = "A",
+    proxy: str | None = None,
+    timeout: float = 5.0,
+    dnssec: bool = False,
+    ecs: str | None = None,
+    slot=None,
+):
+    """Dispatch to the probe for ``server_type``."""
+    start_time = time.perf_counter()
+    if server_type == "local":
+        result = await test_local(domain, record_type, timeout, slot)
+    elif server_type == "udp":
+        result = await test_udp(server, domain, record_type, timeout, dnssec, ecs, slot)
+    elif server_type == "dot":
+        result = await test_dot(server, domain, record_type, timeout, dnssec, ecs, slot)
+    elif server_type == "doh":
+        result = await test_doh(
+            server, domain, proxy, record_type, timeout, dnssec, ecs, slot
+        )
+    else:
+        return {"status": "error", "error": f"Unknown server type: {server_type}"}
+
+    status = result.get("status", "error")
+    metrics.PROBES.inc(transport=server_type, status=status)
+    metrics.PROBE_DURATION.observe(
+        time.perf_counter() - start_time, transport=server_type, status=status
+    )
+    return result
+
+
+async def benchmark(
+    server_type: str,
+    server: str,
+    domain: str,
+    record_type: str = "A",
+    proxy: str | None = None,
+    samples: int = 5,
+    warmup: int = 0,
+    cache_bust: bool = False,
+    timeout: float = 5.0,
+    dnssec: bool = False,
+    ecs: str | None = None,
+    slot=None,
+):
+    """Probe a server ``samples`` times in a row and report latency statistics.
+
+    ``warmup`` extra probes run first and are discarded, so connection and
+    handshake setup do not skew the numbers. With ``cache_bust`` every probe
+    asks for a random subdomain, forcing the resolver past its cache.
+    """
+
+    def sample_domain():
+        if cache_bust:
+            return f"{secrets.token_hex(6)}.{domain}"
+        return domain
+
+    for _ in range(warmup):
+        await run_probe(
+            server_type,
+            server,
+            sample_domain(),
+            record_type,
+            proxy,
+            timeout,
+            dnssec,
+            ecs,
+            slot,
+        )
+
+    latencies = []
+    last_success = None
+    last_error = None
+    for _ in range(samples):
+        result = await run_probe(
+            server_type,
+            server,
+            sample_domain(),
+            record_type,
+            proxy,
+            timeout,
+            dnssec,
+            ecs,
+            slot,
+        )
+        if result.get("status") == "success":
+            latencies.append(result["latency_ms"])
+            last_success = result
+        else:
+            last_error = result.get("error")
+
+    stats = latency_stats.summarize(latencies)
+    benchmark_result = {
+        "status": "success" if latencies else "error",
+        "latency_ms": stats["median_ms"],
+        "samples": samples,
+        "warmup": warmup,
+        "received": len(latencies),
+        "loss": round(1 - len(latencies) / samples, 4) if samples else 0.0,
+        "stats": stats,
+        "sample_latencies_ms": latencies,
+        "server": server,
+    }
+    if last_success is not None:
+        benchmark_result["answers"] = last_success.get("answers", [])
+        benchmark_result["rcode"] = last_success.get("rcode")
+        for detail in ("authenticated", "ecs_scope"):
+            if detail in last_success:
+                benchmark_result[detail] = last_success[detail]
+    if last_error is not None:
+        benchmark_result["error"] = last_error
+    return benchmark_result
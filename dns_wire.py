@@ -0,0 +1,350 @@
+"""Allocation-light reading and writing of wire-format DNS messages.
+
+The probes and the forwarder mostly need a few header fields, the question
+and the answer data, so instead of building ``dns.message.Message`` objects
+these helpers work on the wire buffer directly. Queries are built once per
+(qname, qtype) and cached as templates with only the message ID patched in;
+records of a received message are located and formatted on demand.
+"""
+
+import functools
+import secrets
+import socket
+import struct
+from typing import Iterator, Optional
+
+import dns.edns
+import dns.message
+import dns.rdata
+import dns.rdatatype
+
+ANSWER = 0
+AUTHORITY = 1
+ADDITIONAL = 2
+
+_HEADER = struct.Struct("!HHHHHH")
+# Type, class, TTL and rdata length following a record's owner name.
+_RECORD = struct.Struct("!HHIH")
+
+_QR = 0x8000
+_TC = 0x0200
+_AD = 0x0020
+_CD = 0x0010
+# DNSSEC OK bit of the OPT record's TTL field.
+EDNS_DO = 0x8000
+# EDNS Client Subnet option code (RFC 7871).
+OPTION_ECS = 8
+_OPTION = struct.Struct("!HH")
+
+
+class WireError(ValueError):
+    """Raised for a malformed or truncated DNS message."""
+
+
+@functools.lru_cache(maxsize=4096)
+def _query_template(
+    qname: str, rdtype: int, payload: int, dnssec: bool, ecs: Optional[bytes]
+) -> bytes:
+    query = dns.message.make_query(qname, rdtype)
+    if payload or dnssec or ecs:
+        options = [dns.edns.GenericOption(OPTION_ECS, ecs)] if ecs else []
+        query.use_edns(0, EDNS_DO if dnssec else 0, payload or 1232, options=options)
+    if dnssec:
+        # Ask for the AD bit in the answer (RFC 6840 section 5.7).
+        query.flags |= _AD
+    query.id = 0
+    return query.to_wire()
+
+
+def make_query(
+    qname: str,
+    rdtype: int,
+    payload: int = 0,
+    dnssec: bool = False,
+    ecs: Optional[bytes] = None,
+) -> tuple[bytes, int]:
+    """Wire-format query with a random ID; returns ``(wire, message_id)``.
+
+    With ``payload`` set, the query advertises that EDNS(0) buffer size.
+    ``dnssec`` sets the DO and AD bits and ``ecs`` adds that Client Subnet
+    option data (see ``edns.ClientSubnet.to_option``).
+    """
+    message_id = secrets.randbits(16)
+    template = _query_template(qname, rdtype, payload, dnssec, ecs)
+    return struct.pack("!H", message_id) + template[2:], message_id
+
+
+def build_opt(payload: int, ttl: int, options: list[tuple[int, bytes]]) -> bytes:
+    """Wire-format OPT record (owned by the root name) with ``options``."""
+    rdata = b"".join(_OPTION.pack(code, len(data)) + data for code, data in options)
+    return b"\x00" + _RECORD.pack(dns.rdatatype.OPT, payload, ttl, len(rdata)) + rdata
+
+
+def replace_opt(wire: bytes, opt: Optional[bytes]) -> bytes:
+    """``wire`` with its OPT record replaced by ``opt`` (removed if None).
+
+    A message without OPT gets ``opt`` appended to the additional section.
+    """
+    message = WireMessage(wire)
+    located = message.opt_record()
+    arcount = message.arcount
+    if located is not None:
+        start, end = located
+        wire = wire[:start] + (opt or b"") + wire[end:]
+        arcount -= opt is None
+    elif opt is not None:
+        wire += opt
+        arcount += 1
+    else:
+        return wire
+    return wire[:10] + struct.pack("!H", arcount) + wire[12:]
+
+
+def truncate(wire: bytes) -> bytes:
+    """Header and question of a response with TC set and no records but OPT.
+
+    The OPT record is kept (RFC 6891) so an EDNS client still learns the
+    server's payload size and the extended rcode.
+    """
+    message = WireMessage(wire)
+    located = message.opt_record()
+    header = _HEADER.pack(
+        message.id,
+        message.flags | _TC,
+        message.qdcount,
+        0,
+        0,
+        0 if located is None else 1,
+    )
+    body = wire[12 : message._first_record()]
+    if located is not None:
+        body += wire[located[0] : located[1]]
+    return header + body
+
+
+def _skip_name(wire: bytes, offset: int) -> int:
+    """Offset just past the (possibly compressed) name at ``offset``."""
+    while True:
+        if offset >= len(wire):
+            raise WireError("Truncated DNS name")
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise WireError("Unknown DNS label type")
+        offset += length + 1
+
+
+def parse_query(wire: bytes) -> tuple[int, tuple[bytes, int, int]]:
+    """Message ID and question of a single-question query.
+
+    The question is ``(qname, rdtype, rdclass)`` with the name in lower-cased
+    wire format, which is enough to compare and key questions.
+    """
+    if len(wire) < 12:
+        raise WireError("Short DNS message")
+    message_id, _, qdcount = struct.unpack_from("!HHH", wire)
+    if qdcount != 1:
+        raise WireError("Expected exactly one question")
+    end = _skip_name(wire, 12)
+    if end + 4 > len(wire):
+        raise WireError("Truncated DNS question")
+    rdtype, rdclass = struct.unpack_from("!HH", wire, end)
+    return message_id, (wire[12:end].lower(), rdtype, rdclass)
+
+
+def restore_qname(wire: bytearray, qname: bytes) -> None:
+    """Write the asker's ``qname`` over the question name of a response.
+
+    Cached and coalesced answers carry the name as spelled by whoever asked
+    first; clients that randomize its case (0x20 encoding) check for their
+    own spelling. ``qname`` is the raw wire name from ``parse_query``'s
+    offsets, and only a response asking the same name is changed.
+    """
+    end = 12 + len(qname)
+    if wire[12:end].lower() == qname.lower():
+        wire[12:end] = qname
+
+
+def parse_response(wire: bytes, message_id: int) -> "WireMessage":
+    """A ``WireMessage`` view of the reply to the query ``message_id``."""
+    message = WireMessage(wire)
+    if not message.flags & _QR:
+        raise WireError("Reply is not a DNS response")
+    if message.id != message_id:
+        raise WireError("DNS response ID mismatch")
+    return message
+
+
+class WireMessage:
+    """Read-only view of a wire-format DNS message.
+
+    Only the header is decoded up front. Records are walked when asked for,
+    and their data is only turned into text by ``answers``.
+    """
+
+    __slots__ = (
+        "wire",
+        "id",
+        "flags",
+        "qdcount",
+        "ancount",
+        "nscount",
+        "arcount",
+        "_records_offset",
+        "_opt_span",
+    )
+
+    def __init__(self, wire: bytes):
+        if len(wire) < 12:
+            raise WireError("Short DNS message")
+        (
+            self.id,
+            self.flags,
+            self.qdcount,
+            self.ancount,
+            self.nscount,
+            self.arcount,
+        ) = _HEADER.unpack_from(wire)
+        self.wire = wire
+        self._records_offset: Optional[int] = None
+        # (start, end) of the OPT record once looked for, () if there is none.
+        self._opt_span: Optional[tuple] = None
+
+    @property
+    def truncated(self) -> bool:
+        return bool(self.flags & _TC)
+
+    @property
+    def authenticated(self) -> bool:
+        """The AD bit: the resolver validated the answer with DNSSEC."""
+        return bool(self.flags & _AD)
+
+    @property
+    def checking_disabled(self) -> bool:
+        return bool(self.flags & _CD)
+
+    def _first_record(self) -> int:
+        if self._records_offset is None:
+            offset = 12
+            for _ in range(self.qdcount):
+                offset = _skip_name(self.wire, offset) + 4
+            self._records_offset = offset
+        return self._records_offset
+
+    def records(self) -> Iterator[tuple[int, int, int, int, int, int]]:
+        """Yield ``(section, rdtype, rdclass, ttl, rdata_offset, rdlength)``.
+
+        The record's TTL is stored at ``rdata_offset - 6``.
+        """
+        wire = self.wire
+        offset = self._first_record()
+        for section, count in enumerate((self.ancount, self.nscount, self.arcount)):
+            for _ in range(count):
+                offset = _skip_name(wire, offset)
+                if offset + 10 > len(wire):
+                    raise WireError("Truncated DNS record")
+                rdtype, rdclass, ttl, rdlength = _RECORD.unpack_from(wire, offset)
+                offset += 10
+                if offset + rdlength > len(wire):
+                    raise WireError("Truncated DNS record data")
+                yield section, rdtype, rdclass, ttl, offset, rdlength
+                offset += rdlength
+
+    def _opt(self) -> Optional[tuple[int, int]]:
+        """``(payload, ttl field)`` of the OPT record, if any."""
+        located = self.opt_record()
+        if located is None:
+            return None
+        return struct.unpack_from("!HI", self.wire, located[0] + 3)
+
+    def opt_record(self) -> Optional[tuple[int, int]]:
+        """``(start, end)`` offsets of the OPT record, if any."""
+        if self._opt_span is not None:
+            return self._opt_span or None
+        self._opt_span = ()
+        if not self.arcount:
+            return None
+        for section, rdtype, _, _, offset, length in self.records():
+            if section == ADDITIONAL and rdtype == dns.rdatatype.OPT:
+                # The owner of an OPT record is always the root name.
+                start = offset - 11
+                if self.wire[start] != 0:
+                    raise WireError("OPT record not owned by the root name")
+                self._opt_span = (start, offset + length)
+                break
+        return self._opt_span or None
+
+    def edns_flags(self) -> Optional[int]:
+        """TTL field of the OPT record (extended rcode, version, DO), or None."""
+        opt = self._opt()
+        return opt[1] if opt is not None else None
+
+    def edns_options(self) -> list[tuple[int, bytes]]:
+        """``(code, data)`` of every EDNS option, in order."""
+        located = self.opt_record()
+        if located is None:
+            return []
+        start, end = located
+        wire = self.wire
+        options = []
+        offset = start + 11
+        while offset < end:
+            if offset + 4 > end:
+                raise WireError("Truncated EDNS option")
+            code, length = _OPTION.unpack_from(wire, offset)
+            offset += 4
+            if offset + length > end:
+                raise WireError("Truncated EDNS option data")
+            options.append((code, wire[offset : offset + length]))
+            offset += length
+        return options
+
+    def rcode(self) -> int:
+        """Rcode including the EDNS extended bits, like ``Message.rcode()``."""
+        rcode = self.flags & 0x000F
+        opt = self._opt()
+        if opt is not None:
+            rcode |= (opt[1] >> 24) << 4
+        return rcode
+
+    def edns_payload(self) -> Optional[int]:
+        """Advertised EDNS(0) buffer size, or None without EDNS."""
+        opt = self._opt()
+        return opt[0] if opt is not None else None
+
+    def ttl_offsets(self) -> list[int]:
+        """Offsets of the TTL of every record except OPT."""
+        return [
+            offset - 6
+            for _, rdtype, _, _, offset, _ in self.records()
+            if rdtype != dns.rdatatype.OPT
+        ]
+
+    def rdata_text(self, rdtype: int, rdclass: int, offset: int, length: int) -> str:
+        wire = self.wire
+        if rdtype == dns.rdatatype.A and length == 4:
+            return socket.inet_ntop(socket.AF_INET, wire[offset : offset + 4])
+        if rdtype == dns.rdatatype.AAAA and length == 16:
+            return socket.inet_ntop(socket.AF_INET6, wire[offset : offset + 16])
+        return dns.rdata.from_wire(rdclass, rdtype, wire, offset, length).to_text()
+
+    def answers(
+        self, rdtype: int, any_type: bool = False
+    ) -> tuple[list[str], Optional[int]]:
+        """Answers of ``rdtype`` as ``"[TYPE] data"`` strings, and their min TTL.
+
+        With ``any_type`` every record in the answer section is included.
+        """
+        answers = []
+        ttl = None
+        for section, record_type, rdclass, record_ttl, offset, length in self.records():
+            if section != ANSWER:
+                break
+            if record_type == rdtype or any_type:
+                ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+                text = self.rdata_text(record_type, rdclass, offset, length)
+                answers.append(f"[{dns.rdatatype.to_text(record_type)}] {text}")
+        return answers, ttl
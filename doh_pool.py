@@ -0,0 +1,156 @@
+import asyncio
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+import bootstrap
+import config
+
+if TYPE_CHECKING:
+    import httpx
+
+DOH_HEADERS = {
+    "Content-Type": "application/dns-message",
+    "Accept": "application/dns-message",
+}
+
+# httpcore trace events that mean the request had to open a new connection.
+_CONNECT_EVENTS = ("connection.connect_tcp.started", "connection.start_tls.started")
+
+
+class DoHClientPool:
+    """Long-lived ``httpx.AsyncClient`` instances keyed by (upstream URL, proxy).
+
+    Clients speak HTTP/2 when the upstream supports it, so concurrent queries
+    to the same upstream are multiplexed over one keep-alive connection.
+    httpx (with httpcore and h2) is only imported when the first client is
+    created, keeping it off the app's startup path.
+    """
+
+    def __init__(
+        self,
+        http2: bool = True,
+        max_connections: int = 10,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        max_clients: int = 64,
+    ):
+        self.http2 = http2
+        self.limits = {
+            "max_connections": max_connections,
+            "max_keepalive_connections": max_keepalive_connections,
+            "keepalive_expiry": keepalive_expiry,
+        }
+        self.max_clients = max_clients
+        self._clients: "OrderedDict[tuple, httpx.AsyncClient]" = OrderedDict()
+        # Requests in flight per client; an evicted client is only closed
+        # once it has none, so eviction never aborts a running query.
+        self._active: "dict[httpx.AsyncClient, int]" = {}
+        self._closing: set[asyncio.Future] = set()
+
+    def get(self, url: str, proxy: Optional[str] = None) -> "httpx.AsyncClient":
+        """Return the pooled client for ``(url, proxy)``, creating it if needed."""
+        key = (url, proxy)
+        client = self._clients.get(key)
+        if client is not None and not client.is_closed:
+            self._clients.move_to_end(key)
+            return client
+
+        import httpx
+
+        limits = httpx.Limits(**self.limits)
+        if proxy:
+            client = httpx.AsyncClient(
+                verify=False, http2=self.http2, limits=limits, proxy=proxy
+            )
+        else:
+            import doh_transport
+
+            # Connect to pre-resolved, raced addresses instead of resolving
+            # the URL's host every time.
+            transport = doh_transport.BackendTransport(
+                bootstrap.addresses.network_backend,
+                limits,
+                verify=False,
+                http2=self.http2,
+            )
+            client = httpx.AsyncClient(transport=transport)
+        self._clients[key] = client
+        while len(self._clients) > self.max_clients:
+            _, evicted = self._clients.popitem(last=False)
+            if evicted not in self._active:
+                self._close(evicted)
+        return client
+
+    def _close(self, client: "httpx.AsyncClient") -> None:
+        task = asyncio.ensure_future(client.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _release(self, client: "httpx.AsyncClient") -> None:
+        count = self._active.pop(client, 0) - 1
+        if count > 0:
+            self._active[client] = count
+        elif client not in self._clients.values() and not client.is_closed:
+            self._close(client)
+
+    async def query(
+        self,
+        url: str,
+        wire: bytes,
+        proxy: Optional[str] = None,
+        timeout: float = 5.0,
+    ) -> tuple[bytes, str]:
+        """POST ``wire`` to ``url``.
+
+        Returns the response body and ``"cold"`` if a new connection had to
+        be opened for it, ``"warm"`` if an existing one was reused.
+        """
+        state = "warm"
+
+        async def trace(event_name: str, info: dict):
+            nonlocal state
+            if event_name in _CONNECT_EVENTS:
+                state = "cold"
+
+        client = self.get(url, proxy)
+        self._active[client] = self._active.get(client, 0) + 1
+        try:
+            resp = await client.post(
+                url,
+                content=wire,
+                headers=DOH_HEADERS,
+                timeout=timeout,
+                extensions={"trace": trace},
+            )
+        finally:
+            self._release(client)
+        resp.raise_for_status()
+        return resp.content, state
+
+    async def aclose(self) -> None:
+        clients = set(self._clients.values()) | set(self._active)
+        self._clients.clear()
+        self._active.clear()
+        await asyncio.gather(
+            *(client.aclose() for client in clients),
+            *self._closing,
+            return_exceptions=True,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "http2": self.http2,
+            "upstreams": [
+                {"url": url, "proxy": proxy} for url, proxy in self._clients.keys()
+            ],
+        }
+
+
+pool = DoHClientPool(
+    http2=config.DOH_HTTP2,
+    max_connections=config.DOH_MAX_CONNECTIONS,
+    max_keepalive_connections=config.DOH_MAX_KEEPALIVE,
+    keepalive_expiry=config.DOH_KEEPALIVE_EXPIRY,
+    max_clients=config.DOH_MAX_CLIENTS,
+)
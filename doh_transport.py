@@ -0,0 +1,83 @@
+"""httpx transport over an httpcore pool with a caller-chosen network backend.
+
+``httpx.AsyncHTTPTransport`` always opens connections with httpcore's
+default backend. This transport hands the requests to an
+``httpcore.AsyncConnectionPool`` built with ``network_backend`` instead, and
+maps httpcore's errors to httpx's like httpx's own transport does.
+"""
+
+import contextlib
+import typing
+
+import httpcore
+import httpx
+
+
+@contextlib.contextmanager
+def _httpx_errors(request: httpx.Request):
+    try:
+        yield
+    except Exception as e:
+        # httpx defines an exception of the same name for each of httpcore's.
+        mapped = getattr(httpx, type(e).__name__, None)
+        if not type(e).__module__.startswith("httpcore") or mapped is None:
+            raise
+        raise mapped(str(e), request=request) from e
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream: typing.AsyncIterable[bytes], request: httpx.Request):
+        self._stream = stream
+        self._request = request
+
+    async def __aiter__(self) -> typing.AsyncIterator[bytes]:
+        with _httpx_errors(self._request):
+            async for part in self._stream:
+                yield part
+
+    async def aclose(self) -> None:
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+class BackendTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        network_backend,
+        limits: httpx.Limits,
+        verify: bool = True,
+        http2: bool = False,
+    ):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify=verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http2=http2,
+            network_backend=network_backend,
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _httpx_errors(request):
+            response = await self._pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_ResponseStream(response.stream, request),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
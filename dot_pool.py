@@ -0,0 +1,296 @@
+"""Persistent, pipelined DNS-over-TLS and DNS-over-TCP connections.
+
+Each upstream gets one long-lived connection. Queries are written
+back-to-back without waiting for earlier answers and responses are matched
+by message ID, so they may arrive out of order (RFC 7766). TLS sessions are
+remembered per upstream and offered again on reconnect, turning later
+handshakes into abbreviated resumptions.
+"""
+
+import asyncio
+import functools
+import secrets
+import ssl
+import struct
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import bootstrap
+import config
+
+
+class StreamConnection:
+    """A pipelined connection to a DoT upstream (plain TCP without ``context``).
+
+    TLS runs over ``ssl.MemoryBIO`` on top of a plain asyncio stream because
+    asyncio's own TLS transport cannot offer a saved session for resumption.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        context: Optional[ssl.SSLContext] = None,
+        session: Optional[ssl.SSLSession] = None,
+        idle_timeout: float = 30.0,
+        on_close: Optional[Callable[["StreamConnection"], None]] = None,
+    ):
+        self.host = host
+        self.label = "DoT" if context is not None else "TCP"
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.resumed = False
+        self.closed = False
+        self._context = context
+        self._session = session
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self._ssl: Optional[ssl.SSLObject] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._buffer = b""
+        self._pending: dict[int, asyncio.Future] = {}
+        self._read_task: Optional[asyncio.Task] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._on_close = on_close
+
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        return self._ssl.session if self._ssl is not None else None
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await bootstrap.addresses.open_connection(
+            self.host, self.port
+        )
+        if self._context is None:
+            self._read_task = asyncio.create_task(self._read_loop())
+            return
+
+        self._ssl = self._context.wrap_bio(
+            self._incoming,
+            self._outgoing,
+            server_hostname=self.host,
+            session=self._session,
+        )
+        while True:
+            try:
+                self._ssl.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                self._flush()
+                await self._writer.drain()
+                await self._fill()
+        self._flush()
+        await self._writer.drain()
+
+        self.resumed = self._ssl.session_reused
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def query(self, wire: bytes, timeout: float) -> bytes:
+        """Send ``wire`` and wait for the response with the same message ID."""
+        if self.closed:
+            raise ConnectionError(f"{self.label} connection is closed")
+
+        message_id = secrets.randbits(16)
+        while message_id in self._pending:
+            message_id = secrets.randbits(16)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message_id] = future
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+        try:
+            payload = struct.pack("!H", message_id) + wire[2:]
+            frame = struct.pack("!H", len(payload)) + payload
+            if self._ssl is None:
+                self._writer.write(frame)
+            else:
+                self._ssl.write(frame)
+                self._flush()
+            await self._writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(message_id, None)
+            if not self._pending and not self.closed:
+                self._idle_handle = asyncio.get_running_loop().call_later(
+                    self.idle_timeout, self.close
+                )
+
+        return wire[:2] + response[2:]
+
+    def close(self, exc: Optional[BaseException] = None) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        if (
+            self._read_task is not None
+            and self._read_task is not asyncio.current_task()
+        ):
+            self._read_task.cancel()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(
+                    exc or ConnectionError(f"{self.label} connection closed")
+                )
+        self._pending.clear()
+        if self._writer is not None:
+            self._writer.close()
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _flush(self) -> None:
+        data = self._outgoing.read()
+        if data:
+            self._writer.write(data)
+
+    async def _fill(self) -> None:
+        data = await self._reader.read(65536)
+        if not data:
+            raise ConnectionError(f"{self.label} upstream closed the connection")
+        self._incoming.write(data)
+
+    async def _read_exactly(self, size: int) -> bytes:
+        if self._ssl is None:
+            try:
+                return await self._reader.readexactly(size)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError(f"{self.label} upstream closed the connection")
+
+        while len(self._buffer) < size:
+            try:
+                chunk = self._ssl.read(65536)
+            except ssl.SSLWantReadError:
+                self._flush()
+                await self._fill()
+                continue
+            if not chunk:
+                raise ConnectionError(f"{self.label} upstream closed the connection")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await self._read_exactly(2))
+                response = await self._read_exactly(length)
+                future = self._pending.get(struct.unpack("!H", response[:2])[0])
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.close(ConnectionError(f"{self.label} connection lost: {e!r}"))
+
+
+class StreamConnectionPool:
+    """One pipelined :class:`StreamConnection` per (host, port) upstream.
+
+    With ``tls`` false the connections are plain DNS over TCP. Closed
+    connections are dropped from the pool, and TLS sessions are kept for
+    the ``max_sessions`` most recently used upstreams.
+    """
+
+    def __init__(
+        self, idle_timeout: float = 30.0, tls: bool = True, max_sessions: int = 256
+    ):
+        self.idle_timeout = idle_timeout
+        self.tls = tls
+        self.max_sessions = max_sessions
+        self._context: Optional[ssl.SSLContext] = None
+        self._connections: dict[tuple, StreamConnection] = {}
+        self._sessions: "OrderedDict[tuple, ssl.SSLSession]" = OrderedDict()
+        # Only held while a connection for the key is being opened.
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        self._lock_users: dict[tuple, int] = {}
+
+    @property
+    def context(self) -> ssl.SSLContext:
+        if self._context is None:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            self._context = context
+        return self._context
+
+    def _forget(self, key: tuple, conn: StreamConnection) -> None:
+        if self._connections.get(key) is conn:
+            del self._connections[key]
+
+    async def _connection(self, key: tuple, timeout: float) -> tuple:
+        conn = self._connections.get(key)
+        if conn is not None and not conn.closed:
+            return conn, "warm"
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                return await self._open(key, timeout)
+        finally:
+            self._lock_users[key] -= 1
+            if not self._lock_users[key]:
+                del self._lock_users[key]
+                del self._locks[key]
+
+    async def _open(self, key: tuple, timeout: float) -> tuple:
+        conn = self._connections.get(key)
+        if conn is not None and not conn.closed:
+            return conn, "warm"
+
+        conn = StreamConnection(
+            key[0],
+            key[1],
+            self.context if self.tls else None,
+            session=self._sessions.get(key),
+            idle_timeout=self.idle_timeout,
+            on_close=functools.partial(self._forget, key),
+        )
+        try:
+            await asyncio.wait_for(conn.connect(), timeout)
+        except BaseException:
+            conn.close()
+            raise
+        self._connections[key] = conn
+        return conn, "resumed" if conn.resumed else "cold"
+
+    async def query(
+        self, host: str, wire: bytes, port: int = 853, timeout: float = 5.0
+    ) -> tuple[bytes, str]:
+        """Send ``wire`` to an upstream over its shared connection.
+
+        Returns the response (carrying the ID of ``wire``) and how the
+        connection was obtained: ``"cold"`` (new connection, full TLS
+        handshake), ``"resumed"`` (TLS session resumption) or ``"warm"``
+        (already open).
+        """
+        key = (host, port)
+        conn, state = await self._connection(key, timeout)
+        try:
+            response = await conn.query(wire, timeout)
+        except ConnectionError:
+            if state != "warm":
+                raise
+            # The upstream may have dropped an idle connection; retry once.
+            conn, state = await self._connection(key, timeout)
+            response = await conn.query(wire, timeout)
+
+        if conn.session is not None:
+            self._sessions[key] = conn.session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return response, state
+
+    async def aclose(self) -> None:
+        for conn in list(self._connections.values()):
+            conn.close()
+        self._connections.clear()
+
+
+pool = StreamConnectionPool(idle_timeout=config.DOT_IDLE_TIMEOUT)
+tcp_pool = StreamConnectionPool(idle_timeout=config.TCP_IDLE_TIMEOUT, tls=False)
@@ -0,0 +1,210 @@
+"""EDNS Client Subnet (RFC 7871) handling and cache partitions of queries.
+
+Forwarded queries keep their EDNS options and DO/CD/AD bits, but answers
+may differ with them: a DNSSEC-validating client needs the signatures, and
+CDN names are answered for the subnet in the ECS option. ``EcsPolicy``
+decides what subnet (if any) to send upstream and returns the partition the
+answer has to be cached and coalesced under, so one client's answer is never
+served to another that asked a different question.
+
+Answers to a synthesized subnet whose scope is 0 (the upstream did not tailor
+them) go into a partition shared by every synthesized subnet, which keeps
+the hit rate of names that are not geo-dependent.
+"""
+
+import functools
+import ipaddress
+import socket
+import struct
+from typing import NamedTuple, Optional
+
+import dns_wire
+
+PASSTHROUGH = "passthrough"
+STRIP = "strip"
+SYNTHESIZE = "synthesize"
+MODES = (PASSTHROUGH, STRIP, SYNTHESIZE)
+
+# ECS part of the partition for answers valid for every client subnet.
+GLOBAL = "0/0"
+
+_FAMILIES = {1: (socket.AF_INET, 4), 2: (socket.AF_INET6, 16)}
+
+
+class ClientSubnet(NamedTuple):
+    """Source subnet of an ECS option; ``address`` is masked and truncated."""
+
+    family: int
+    prefix: int
+    address: bytes
+
+    @classmethod
+    def from_ip(cls, ip: str, prefix: int) -> "ClientSubnet":
+        network = ipaddress.ip_network(f"{ip}/{prefix}", strict=False)
+        family = 1 if network.version == 4 else 2
+        packed = network.network_address.packed
+        return cls(family, prefix, packed[: (prefix + 7) // 8])
+
+    @classmethod
+    def from_text(cls, text: str) -> "ClientSubnet":
+        """Parse ``address/prefix``, e.g. ``203.0.113.0/24``."""
+        network = ipaddress.ip_network(text.strip(), strict=False)
+        return cls.from_ip(str(network.network_address), network.prefixlen)
+
+    @classmethod
+    def from_option(cls, data: bytes) -> tuple["ClientSubnet", int]:
+        """Subnet and scope prefix of ECS option data."""
+        if len(data) < 4:
+            raise dns_wire.WireError("Short ECS option")
+        family, prefix, scope = struct.unpack_from("!HBB", data)
+        if family not in _FAMILIES or prefix > _FAMILIES[family][1] * 8:
+            raise dns_wire.WireError("Invalid ECS option")
+        return cls(family, prefix, bytes(data[4:])), scope
+
+    def to_option(self, scope: int = 0) -> bytes:
+        return struct.pack("!HBB", self.family, self.prefix, scope) + self.address
+
+    def __str__(self) -> str:
+        af, size = _FAMILIES.get(self.family, (None, 0))
+        if af is None:
+            return f"family{self.family}/{self.prefix}"
+        address = self.address[:size].ljust(size, b"\0")
+        return f"{socket.inet_ntop(af, address)}/{self.prefix}"
+
+
+@functools.lru_cache(maxsize=4096)
+def subnet_for_ip(
+    ip: Optional[str], ipv4_prefix: int = 24, ipv6_prefix: int = 56
+) -> Optional[ClientSubnet]:
+    """The subnet to announce for a client, or None for a non-public address.
+
+    Private, loopback and other special-use addresses say nothing about
+    where the client is, so queries from them get no ECS option.
+    """
+    if not ip:
+        return None
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    mapped = getattr(address, "ipv4_mapped", None)
+    if mapped is not None:
+        address = mapped
+    if not address.is_global:
+        return None
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return ClientSubnet.from_ip(str(address), prefix)
+
+
+class Prepared(NamedTuple):
+    """A query ready to forward, and where its answer belongs."""
+
+    # The query to send upstream.
+    wire: bytes
+    # ``(edns, do, cd, ad, ecs)`` - cache and coalescing partition of the answer.
+    partition: tuple
+    # Partition answers also land in when the upstream reports ECS scope 0.
+    shared_partition: Optional[tuple] = None
+    # The ECS option was added by us and is removed from the answer.
+    synthesized: bool = False
+    # ... and so was the whole OPT record.
+    added_opt: bool = False
+
+
+class EcsPolicy:
+    """What to do with the ECS option of forwarded queries.
+
+    - ``passthrough``: forward the client's option (or none) unchanged;
+    - ``strip``: remove it, so upstreams answer for this server's location;
+    - ``synthesize``: forward a client's own option, otherwise add one for
+      the client's address truncated to ``ipv4_prefix``/``ipv6_prefix`` bits.
+    """
+
+    def __init__(
+        self,
+        mode: str = PASSTHROUGH,
+        ipv4_prefix: int = 24,
+        ipv6_prefix: int = 56,
+        payload: int = 1232,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown ECS mode {mode!r}, expected one of {MODES}")
+        if not 0 <= ipv4_prefix <= 32 or not 0 <= ipv6_prefix <= 128:
+            raise ValueError("Invalid ECS prefix length")
+        self.mode = mode
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.payload = payload
+
+    def prepare(self, wire: bytes, client_ip: Optional[str] = None) -> Prepared:
+        """Rewrite the query ``wire`` of a client at ``client_ip`` for forwarding."""
+        message = dns_wire.WireMessage(wire)
+        cd = message.checking_disabled
+        # A query with AD set asks whether the answer was validated (RFC
+        # 6840); its answer carries the resolver's AD bit.
+        ad = message.authenticated
+        ednsflags = message.edns_flags()
+        if ednsflags is None:
+            if self.mode == SYNTHESIZE:
+                subnet = subnet_for_ip(client_ip, self.ipv4_prefix, self.ipv6_prefix)
+                if subnet is not None:
+                    opt = dns_wire.build_opt(
+                        self.payload, 0, [(dns_wire.OPTION_ECS, subnet.to_option())]
+                    )
+                    return Prepared(
+                        dns_wire.replace_opt(wire, opt),
+                        (False, False, cd, ad, str(subnet)),
+                        (False, False, cd, ad, GLOBAL),
+                        synthesized=True,
+                        added_opt=True,
+                    )
+            return Prepared(wire, (False, False, cd, ad, None))
+
+        do = bool(ednsflags & dns_wire.EDNS_DO)
+        options = message.edns_options()
+        ecs = [data for code, data in options if code == dns_wire.OPTION_ECS]
+        if ecs and self.mode != STRIP:
+            # The client chose its own subnet; its answer is for it alone.
+            subnet, _ = ClientSubnet.from_option(ecs[0])
+            return Prepared(wire, (True, do, cd, ad, ("client", str(subnet))))
+        if ecs:
+            kept = [(c, d) for c, d in options if c != dns_wire.OPTION_ECS]
+            opt = dns_wire.build_opt(message.edns_payload(), ednsflags, kept)
+            return Prepared(dns_wire.replace_opt(wire, opt), (True, do, cd, ad, None))
+        if self.mode == SYNTHESIZE:
+            subnet = subnet_for_ip(client_ip, self.ipv4_prefix, self.ipv6_prefix)
+            if subnet is not None:
+                options.append((dns_wire.OPTION_ECS, subnet.to_option()))
+                opt = dns_wire.build_opt(message.edns_payload(), ednsflags, options)
+                return Prepared(
+                    dns_wire.replace_opt(wire, opt),
+                    (True, do, cd, ad, str(subnet)),
+                    (True, do, cd, ad, GLOBAL),
+                    synthesized=True,
+                )
+        return Prepared(wire, (True, do, cd, ad, None))
+
+    @staticmethod
+    def finish(response: bytes, prepared: Prepared) -> tuple[bytes, bool]:
+        """The client's view of an upstream ``response``, and whether it is global.
+
+        An option (or OPT record) added by ``prepare`` is removed again, and
+        the answer counts as global when the upstream's scope prefix is 0 or
+        it ignored the option.
+        """
+        if not prepared.synthesized:
+            return response, False
+        message = dns_wire.WireMessage(response)
+        options = message.edns_options()
+        scope = 0
+        for code, data in options:
+            if code == dns_wire.OPTION_ECS:
+                scope = ClientSubnet.from_option(data)[1]
+        if prepared.added_opt:
+            return dns_wire.replace_opt(response, None), scope == 0
+        ednsflags = message.edns_flags()
+        if ednsflags is None:
+            return response, scope == 0
+        kept = [(c, d) for c, d in options if c != dns_wire.OPTION_ECS]
+        opt = dns_wire.build_opt(message.edns_payload(), ednsflags, kept)
+        return dns_wire.replace_opt(response, opt), scope == 0
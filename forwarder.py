@@ -0,0 +1,334 @@
+"""Wire-level forwarding of DNS queries to upstream servers.
+
+Unlike the probes in ``dns_tester``, these helpers never decode the answer:
+the client's query is sent upstream as-is (only the message ID is replaced)
+and the upstream response is handed back byte for byte, so TTLs, the
+authority/additional sections, EDNS, flags and rcode survive the trip.
+"""
+
+import asyncio
+import secrets
+import struct
+import time
+from typing import Optional
+
+import dns.exception
+import dns.rcode
+
+import doh_pool
+import dot_pool
+import metrics
+import ratelimit
+import system_resolver
+import upstreams
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream returns no usable DNS response."""
+
+
+def with_id(wire: bytes, message_id: int) -> bytes:
+    """Copy of a wire-format message with its ID replaced."""
+    return struct.pack("!H", message_id) + wire[2:]
+
+
+def _check_response(wire: bytes, message_id: int) -> bytes:
+    if len(wire) < 12:
+        raise UpstreamError("Short DNS response from upstream")
+    if not wire[2] & 0x80:
+        raise UpstreamError("Upstream reply is not a DNS response")
+    if struct.unpack("!H", wire[:2])[0] != message_id:
+        raise UpstreamError("Upstream response ID mismatch")
+    return wire
+
+
+def is_truncated(wire: bytes) -> bool:
+    return bool(wire[2] & 0x02)
+
+
+def response_rcode(wire: bytes) -> int:
+    """Header rcode of a response (without the EDNS extended bits)."""
+    return wire[3] & 0x0F
+
+
+class _UDPExchange(asyncio.DatagramProtocol):
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.response: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        # Ignore stray datagrams that do not answer our query.
+        if len(data) >= 2 and struct.unpack("!H", data[:2])[0] == self.message_id:
+            if not self.response.done():
+                self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if not self.response.done():
+            self.response.set_exception(
+                exc or UpstreamError("UDP socket closed before a response arrived")
+            )
+
+
+async def udp_exchange(
+    wire: bytes, server_ip: str, port: int = 53, timeout: float = 5.0
+) -> bytes:
+    """Send ``wire`` in one datagram and return the reply with the same ID."""
+    message_id = struct.unpack("!H", wire[:2])[0]
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _UDPExchange(message_id), remote_addr=(server_ip, port)
+    )
+    try:
+        transport.sendto(wire)
+        return await asyncio.wait_for(protocol.response, timeout)
+    except asyncio.TimeoutError:
+        raise dns.exception.Timeout(timeout=timeout) from None
+    finally:
+        transport.close()
+
+
+async def forward_udp(
+    wire: bytes, server_ip: str, timeout: float = 5.0, port: int = 53
+) -> bytes:
+    """Forward over UDP, retrying over TCP when the answer is truncated."""
+    message_id = secrets.randbits(16)
+    response = await udp_exchange(with_id(wire, message_id), server_ip, port, timeout)
+    response = _check_response(response, message_id)
+    if is_truncated(response):
+        return await forward_tcp(wire, server_ip, timeout, port)
+    return with_id(response, struct.unpack("!H", wire[:2])[0])
+
+
+async def forward_tcp(
+    wire: bytes, server_ip: str, timeout: float = 5.0, port: int = 53
+) -> bytes:
+    """Forward over a pooled, pipelined plain TCP connection (RFC 7766)."""
+    response, _ = await dot_pool.tcp_pool.query(server_ip, wire, port, timeout)
+    return _check_response(response, struct.unpack("!H", wire[:2])[0])
+
+
+async def forward_dot(
+    wire: bytes, server_ip: str, timeout: float = 5.0, port: int = 853
+) -> bytes:
+    """Forward over a pooled, pipelined DNS over TLS connection."""
+    response, _ = await dot_pool.pool.query(server_ip, wire, port, timeout)
+    return _check_response(response, struct.unpack("!H", wire[:2])[0])
+
+
+async def forward_doh(
+    wire: bytes, url: str, proxy: Optional[str] = None, timeout: float = 5.0
+) -> bytes:
+    """Forward over DNS over HTTPS (RFC 8484 POST)."""
+    # RFC 8484 recommends ID 0 so that HTTP caches can share responses.
+    content, _ = await doh_pool.pool.query(url, with_id(wire, 0), proxy, timeout)
+    response = _check_response(content, 0)
+    return with_id(response, struct.unpack("!H", wire[:2])[0])
+
+
+async def forward_local(wire: bytes, timeout: float = 5.0) -> bytes:
+    """Forward to the nameservers configured for the system resolver."""
+    last_error: Exception = UpstreamError("No system nameservers configured")
+    for host, port in system_resolver.resolver.nameservers():
+        try:
+            return await forward_udp(wire, host, timeout, port)
+        except Exception as e:
+            last_error = e
+    raise last_error
+
+
+async def forward_wire(
+    wire: bytes,
+    server_type: str,
+    server: str,
+    proxy: Optional[str] = None,
+    timeout: float = 5.0,
+) -> bytes:
+    """Forward ``wire`` to a parsed ``type://server`` upstream."""
+    if server_type == "local":
+        return await forward_local(wire, timeout)
+    elif server_type == "udp":
+        host, port = upstreams.split_host_port(server, 53)
+        return await forward_udp(wire, host, timeout, port)
+    elif server_type == "dot":
+        host, port = upstreams.split_host_port(server, 853)
+        return await forward_dot(wire, host, timeout, port)
+    elif server_type == "doh":
+        return await forward_doh(wire, server, proxy, timeout)
+    else:
+        raise ValueError(f"Unknown server type: {server_type}")
+
+
+# An answer with one of these rcodes ends a race; anything else (SERVFAIL,
+# REFUSED, ...) counts as a failure of that upstream.
+ACCEPTED_RCODES = (dns.rcode.NOERROR, dns.rcode.NXDOMAIN)
+
+
+async def forward_tracked(
+    wire: bytes,
+    server: dict,
+    proxy: Optional[str] = None,
+    timeout: float = 5.0,
+    health: Optional[upstreams.UpstreamHealth] = None,
+    scheduler: Optional[ratelimit.UpstreamScheduler] = None,
+) -> bytes:
+    """``forward_wire`` to a server entry, recording the outcome in ``health``.
+
+    With a ``scheduler``, the exchange first waits for a slot under the
+    server's ``qps``/``burst`` limits; a refusal raises
+    ``ratelimit.Overloaded`` and does not count against the upstream.
+    Every exchange is also counted and timed in the ``ezdns_upstream_*``
+    metrics.
+
+    Responses whose rcode is not in ``ACCEPTED_RCODES`` are still returned
+    but count as failures of the upstream.
+    """
+    if scheduler is None:
+        return await _forward_observed(wire, server, proxy, timeout, health)
+    key = upstreams.upstream_key(server)
+    try:
+        async with scheduler.slot(key, server.get("qps"), server.get("burst")):
+            return await _forward_observed(wire, server, proxy, timeout, health)
+    except (ratelimit.Overloaded, asyncio.CancelledError):
+        # Nothing was recorded if the query never left the queue, so hand
+        # back a half-open probe slot claimed by ``health.allow``.
+        if health is not None:
+            health.release_probe(key)
+        raise
+
+
+async def _forward_observed(
+    wire: bytes,
+    server: dict,
+    proxy: Optional[str],
+    timeout: float,
+    health: Optional[upstreams.UpstreamHealth],
+) -> bytes:
+    key = upstreams.upstream_key(server)
+    # Requests may name any upstream; only configured ones get series.
+    label = upstreams.metric_label(key)
+    start_time = time.monotonic()
+
+    def observe(outcome: str) -> float:
+        elapsed = time.monotonic() - start_time
+        metrics.UPSTREAM_REQUESTS.inc(upstream=label, outcome=outcome)
+        metrics.UPSTREAM_DURATION.observe(elapsed, upstream=label, outcome=outcome)
+        return elapsed * 1000
+
+    try:
+        response = await forward_wire(
+            wire, server["type"], server["server"], proxy, timeout
+        )
+    except asyncio.CancelledError:
+        elapsed_ms = observe("cancelled")
+        if health is not None:
+            health.record_cancelled(key, elapsed_ms)
+        raise
+    except Exception as e:
+        observe("error")
+        if health is not None:
+            health.record_failure(key, str(e) or type(e).__name__)
+        raise
+
+    rcode = response_rcode(response)
+    if rcode in ACCEPTED_RCODES:
+        elapsed_ms = observe("success")
+        if health is not None:
+            health.record_success(key, elapsed_ms)
+    else:
+        observe("rejected")
+        if health is not None:
+            health.record_failure(key, f"Upstream answered {dns.rcode.to_text(rcode)}")
+    return response
+
+
+async def _race_attempt(
+    wire: bytes,
+    server: dict,
+    proxy: Optional[str],
+    timeout: float,
+    health: Optional[upstreams.UpstreamHealth],
+    scheduler: Optional[ratelimit.UpstreamScheduler],
+) -> bytes:
+    response = await forward_tracked(wire, server, proxy, timeout, health, scheduler)
+    rcode = response_rcode(response)
+    if rcode not in ACCEPTED_RCODES:
+        raise UpstreamError(
+            f"{upstreams.upstream_key(server)} answered {dns.rcode.to_text(rcode)}"
+        )
+    return response
+
+
+async def race(
+    wire: bytes,
+    servers: list[dict],
+    proxy: Optional[str] = None,
+    fanout: int = 2,
+    hedge_delay: float = 0.2,
+    health: Optional[upstreams.UpstreamHealth] = None,
+    timeout: float = 5.0,
+    scheduler: Optional[ratelimit.UpstreamScheduler] = None,
+) -> bytes:
+    """Forward to several upstreams and return the first acceptable answer.
+
+    The best ``fanout`` servers (by ``health`` score) are queried at once.
+    Every ``hedge_delay`` seconds without an answer, and whenever an attempt
+    fails, the next server joins the race. Servers whose circuit is open
+    are skipped unless every circuit is open. An attempt refused by the
+    ``scheduler`` fails like any other and the next server joins.
+    Outstanding attempts are cancelled as soon as one succeeds.
+    """
+    remaining = list(servers)
+    check_circuits = False
+    if health is not None:
+        remaining = health.ordered(remaining)
+        check_circuits = any(
+            health.is_available(upstreams.upstream_key(s)) for s in remaining
+        )
+    pending: set[asyncio.Task] = set()
+    attempts = 0
+
+    def launch() -> None:
+        nonlocal attempts
+        while remaining:
+            server = remaining.pop(0)
+            if check_circuits and not health.allow(upstreams.upstream_key(server)):
+                continue
+            pending.add(
+                asyncio.create_task(
+                    _race_attempt(wire, server, proxy, timeout, health, scheduler)
+                )
+            )
+            attempts += 1
+            return
+
+    for _ in range(max(fanout, 1)):
+        launch()
+
+    last_error: Exception = UpstreamError("No upstream servers available")
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                launch()
+                continue
+
+            for task in done:
+                pending.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+                launch()
+
+        raise last_error
+    finally:
+        for task in pending:
+            task.cancel()
+        metrics.RACE_ATTEMPTS.observe(attempts)
@@ -0,0 +1,436 @@
+"""Scheduled probes and their latency history.
+
+Configured checks (server, domain, record type, interval) are probed in
+the background and every result is kept in a SQLite database: raw samples
+for a short while, plus per-minute and per-hour rollups (count, errors,
+latency sum/min/max) that are updated as samples are inserted. Queries
+read the rollup matching the requested range, so charting weeks of data
+touches a few hundred rows per check rather than every sample.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, NamedTuple, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RAW = "raw"
+MINUTE = "minute"
+HOUR = "hour"
+
+# Rollup tables and their bucket width in seconds.
+_ROLLUPS = {MINUTE: 60, HOUR: 3600}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    upstream TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    rdtype TEXT NOT NULL,
+    ts REAL NOT NULL,
+    latency_ms REAL,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_check ON samples (upstream, domain, rdtype, ts);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+CREATE TABLE IF NOT EXISTS lease (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    upstream TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    rdtype TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    latency_sum REAL NOT NULL,
+    latency_min REAL,
+    latency_max REAL,
+    PRIMARY KEY (upstream, domain, rdtype, bucket)
+) WITHOUT ROWID;
+"""
+
+_ROLLUP_UPSERT = """
+INSERT INTO {table} VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)
+ON CONFLICT (upstream, domain, rdtype, bucket) DO UPDATE SET
+    count = count + 1,
+    errors = errors + excluded.errors,
+    latency_sum = latency_sum + excluded.latency_sum,
+    latency_min = min(coalesce(latency_min, excluded.latency_min),
+                      coalesce(excluded.latency_min, latency_min)),
+    latency_max = max(coalesce(latency_max, excluded.latency_max),
+                      coalesce(excluded.latency_max, latency_max))
+"""
+
+
+class Check(NamedTuple):
+    """A probe run every ``interval`` seconds."""
+
+    server: str
+    domain: str
+    rdtype: str = "A"
+    interval: float = 60.0
+
+
+def parse_checks(text: str, default_interval: float = 60.0) -> list[Check]:
+    """Checks from ``server domain [type] [interval]`` entries.
+
+    Entries are separated by ``;`` or newlines, e.g.
+    ``udp://8.8.8.8 example.com A 30; doh://https://dns.google/dns-query example.com``.
+    """
+    checks = []
+    for entry in text.replace("\n", ";").split(";"):
+        fields = entry.split()
+        if not fields:
+            continue
+        if len(fields) < 2 or len(fields) > 4:
+            raise ValueError(f"Invalid check {entry.strip()!r}")
+        rdtype = fields[2].upper() if len(fields) > 2 else "A"
+        interval = float(fields[3]) if len(fields) > 3 else default_interval
+        if interval <= 0:
+            raise ValueError(f"Invalid interval in check {entry.strip()!r}")
+        checks.append(Check(fields[0], fields[1], rdtype, interval))
+    return checks
+
+
+class HistoryStore:
+    """Probe results with minute and hour rollups, in one database.
+
+    Samples are buffered in memory and written in batches by ``flush``.
+    Raw samples are kept for ``raw_retention`` seconds, minute rollups for
+    ``minute_retention`` and hour rollups for ``hour_retention``.
+
+    Nothing touches the database on the event loop: writes (and the lease)
+    run on a writer thread, where they may wait for another worker's
+    transaction, and reads on a reader thread with its own connection.
+    """
+
+    # Old rows are purged every this many flushes.
+    PRUNE_EVERY = 60
+    # Unwritten samples kept while the database keeps failing.
+    MAX_PENDING = 100_000
+
+    def __init__(
+        self,
+        path: str,
+        raw_retention: float = 2 * 86400,
+        minute_retention: float = 14 * 86400,
+        hour_retention: float = 400 * 86400,
+        timeout: float = 5.0,
+    ):
+        self.path = path
+        self.timeout = timeout
+        self.retention = {
+            RAW: raw_retention,
+            MINUTE: minute_retention,
+            HOUR: hour_retention,
+        }
+        self._writer_db = self._connect()
+        self._writer_db.executescript(
+            _SCHEMA + "".join(_ROLLUP_SCHEMA.format(table=t) for t in _ROLLUPS)
+        )
+        self._reader_db = self._connect()
+        # One thread each, so every connection is only used by one thread.
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="history-writer")
+        self._reader = ThreadPoolExecutor(1, thread_name_prefix="history-reader")
+        self._pending: list[tuple] = []
+        self._flushes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    async def _write(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.wrap_future(self._writer.submit(fn, *args))
+
+    async def _read(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.wrap_future(self._reader.submit(fn, *args))
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            self._writer.shutdown(wait=True)
+            self._reader.shutdown(wait=True)
+            self._writer_db.close()
+            self._reader_db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._writer_db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def record(
+        self,
+        check: Check,
+        upstream: str,
+        latency_ms: Optional[float],
+        ok: bool,
+        ts: Optional[float] = None,
+    ) -> None:
+        """Buffer one probe result until the next ``flush``."""
+        ts = time.time() if ts is None else ts
+        self._pending.append(
+            (upstream, check.domain, check.rdtype, ts, latency_ms, int(ok))
+        )
+
+    async def flush(self) -> int:
+        """Write buffered samples and update the rollups; returns the count.
+
+        If the write fails, the samples are kept for the next flush.
+        """
+        rows, self._pending = self._pending, []
+        if not rows:
+            return 0
+        future = self._writer.submit(self._flush, rows)
+        try:
+            await asyncio.wrap_future(future)
+        except BaseException:
+            # A write already running when the flush was cancelled still
+            # completes on the writer thread.
+            if future.cancelled() or future.done() and future.exception():
+                self._pending = (rows + self._pending)[-self.MAX_PENDING :]
+            raise
+        return len(rows)
+
+    def _flush(self, rows: list[tuple]) -> None:
+        with self._transaction() as db:
+            db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)", rows)
+            for table, width in _ROLLUPS.items():
+                db.executemany(
+                    _ROLLUP_UPSERT.format(table=table),
+                    [
+                        (
+                            upstream,
+                            domain,
+                            rdtype,
+                            int(ts // width * width),
+                            1 - ok,
+                            latency_ms or 0.0,
+                            latency_ms,
+                            latency_ms,
+                        )
+                        for upstream, domain, rdtype, ts, latency_ms, ok in rows
+                    ],
+                )
+        self._flushes += 1
+        if self._flushes % self.PRUNE_EVERY == 0:
+            self._prune(time.time())
+
+    async def prune(self, now: Optional[float] = None) -> None:
+        await self._write(self._prune, time.time() if now is None else now)
+
+    def _prune(self, now: float) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM samples WHERE ts < ?", (now - self.retention[RAW],))
+            for table in _ROLLUPS:
+                db.execute(
+                    f"DELETE FROM {table} WHERE bucket < ?",
+                    (now - self.retention[table],),
+                )
+
+    async def acquire_lease(self, owner: str, ttl: float) -> bool:
+        """Claim (or renew) the right to run the checks for ``ttl`` seconds.
+
+        With several worker processes sharing the database, only the holder
+        of the lease probes, so every check runs once per interval.
+        """
+        return await self._write(self._acquire_lease, owner, ttl)
+
+    def _acquire_lease(self, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT owner, expires_at FROM lease WHERE id = 0"
+            ).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO lease VALUES (0, ?, ?)", (owner, now + ttl)
+            )
+        return True
+
+    async def series(self) -> list[dict]:
+        """Every (upstream, domain, type) with history, and its time range."""
+        return await self._read(self._series)
+
+    def _series(self) -> list[dict]:
+        rows = self._reader_db.execute(
+            f"SELECT upstream, domain, rdtype, min(bucket), max(bucket) + 3600"
+            f" FROM {HOUR} GROUP BY upstream, domain, rdtype"
+        )
+        return [
+            {
+                "upstream": upstream,
+                "domain": domain,
+                "type": rdtype,
+                "start": start,
+                "end": end,
+            }
+            for upstream, domain, rdtype, start, end in rows
+        ]
+
+    async def query(
+        self,
+        upstream: str,
+        domain: str,
+        rdtype: str,
+        start: float,
+        end: float,
+        resolution: str = "auto",
+        max_points: int = 500,
+    ) -> dict:
+        """Downsampled latency series of one check between ``start`` and ``end``.
+
+        ``resolution`` picks the source (``raw``, ``minute`` or ``hour``);
+        ``auto`` takes the finest one that covers the range within its
+        retention and needs no more than ``max_points * 10`` rows. Points are
+        then merged into steps of whole source buckets, at most
+        ``max_points`` of them.
+        """
+        return await self._read(
+            self._query, upstream, domain, rdtype, start, end, resolution, max_points
+        )
+
+    def _query(
+        self,
+        upstream: str,
+        domain: str,
+        rdtype: str,
+        start: float,
+        end: float,
+        resolution: str,
+        max_points: int,
+    ) -> dict:
+        span = max(end - start, 1.0)
+        if resolution == "auto":
+            resolution = HOUR
+            for candidate, width in ((MINUTE, 60), (HOUR, 3600)):
+                if (
+                    start >= time.time() - self.retention[candidate]
+                    and span / width <= max_points * 10
+                ):
+                    resolution = candidate
+                    break
+        if resolution != RAW and resolution not in _ROLLUPS:
+            raise ValueError(f"Unknown resolution {resolution!r}")
+
+        width = _ROLLUPS.get(resolution, 1)
+        step = max(width, math.ceil(span / max_points / width) * width)
+        if resolution == RAW:
+            sql = (
+                "SELECT CAST(ts / ? AS INTEGER) * ?, count(*),"
+                " sum(1 - ok), sum(coalesce(latency_ms, 0)),"
+                " min(latency_ms), max(latency_ms)"
+                " FROM samples WHERE upstream = ? AND domain = ? AND rdtype = ?"
+                " AND ts >= ? AND ts < ? GROUP BY 1 ORDER BY 1"
+            )
+        else:
+            sql = (
+                "SELECT bucket / ? * ?, sum(count), sum(errors), sum(latency_sum),"
+                " min(latency_min), max(latency_max)"
+                f" FROM {resolution} WHERE upstream = ? AND domain = ?"
+                " AND rdtype = ? AND bucket >= ? AND bucket < ?"
+                " GROUP BY 1 ORDER BY 1"
+            )
+            start = start // width * width
+
+        rows = self._reader_db.execute(
+            sql, (step, step, upstream, domain, rdtype.upper(), start, end)
+        )
+        points = []
+        for bucket, count, errors, latency_sum, latency_min, latency_max in rows:
+            successes = count - errors
+            points.append(
+                {
+                    "t": bucket,
+                    "count": count,
+                    "errors": errors,
+                    "avg_ms": round(latency_sum / successes, 2) if successes else None,
+                    "min_ms": latency_min,
+                    "max_ms": latency_max,
+                }
+            )
+        return {"resolution": resolution, "step_seconds": step, "points": points}
+
+
+async def run_checks(
+    store: HistoryStore,
+    checks: list[Check],
+    probe: Callable[[Check], Awaitable[tuple[str, Optional[float], bool]]],
+    flush_interval: float = 5.0,
+) -> None:
+    """Run ``checks`` on their intervals for as long as this worker holds the lease.
+
+    ``probe(check)`` returns ``(upstream key, latency_ms, ok)``; if it raises,
+    the error is logged and a failed sample is recorded under the key it
+    last returned (or ``check.server``). Buffered results are written every
+    ``flush_interval`` seconds; database errors are logged and retried.
+    """
+    owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+    lease_ttl = max(flush_interval * 3, 15.0)
+
+    async def run(check: Check) -> None:
+        # Spread the first runs so checks with the same interval don't align.
+        await asyncio.sleep(random.uniform(0, min(check.interval, flush_interval)))
+        upstream = check.server
+        while True:
+            started = time.monotonic()
+            try:
+                upstream, latency_ms, ok = await probe(check)
+            except Exception as e:
+                logger.warning(
+                    "History check %s %s %s failed: %r",
+                    check.server,
+                    check.domain,
+                    check.rdtype,
+                    e,
+                )
+                latency_ms, ok = None, False
+            store.record(check, upstream, latency_ms if ok else None, ok)
+            await asyncio.sleep(max(check.interval - (time.monotonic() - started), 0))
+
+    tasks: list[asyncio.Task] = []
+    try:
+        while True:
+            try:
+                leader = await store.acquire_lease(owner, lease_ttl)
+                if leader and not tasks:
+                    tasks = [asyncio.create_task(run(check)) for check in checks]
+                elif not leader and tasks:
+                    for task in tasks:
+                        task.cancel()
+                    tasks = []
+                await store.flush()
+            except Exception as e:
+                logger.warning("History database update failed: %r", e)
+            await asyncio.sleep(flush_interval)
+    finally:
+        for task in tasks:
+            task.cancel()
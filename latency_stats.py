@@ -0,0 +1,58 @@
+"""Small latency statistics helpers (no numpy dependency)."""
+
+import statistics
+from typing import Optional, Sequence
+
+
+def percentile(values: Sequence[float], pct: float) -> Optional[float]:
+    """Linear-interpolated percentile of ``values`` (``pct`` in 0-100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize_percentiles(values: Sequence[float]) -> dict:
+    """p50/p90/p99 of ``values``, rounded to two decimals."""
+    summary = {}
+    for pct in (50, 90, 99):
+        value = percentile(values, pct)
+        summary[f"p{pct}_ms"] = round(value, 2) if value is not None else None
+    return summary
+
+
+def summarize(values: Sequence[float]) -> dict:
+    """min/mean/median/p95/stddev/jitter of latency samples in milliseconds.
+
+    Jitter is the mean absolute difference between consecutive samples
+    (the inter-arrival jitter idea of RFC 3550, without smoothing).
+    """
+
+    def rounded(value: Optional[float]) -> Optional[float]:
+        return round(value, 2) if value is not None else None
+
+    if not values:
+        return {
+            key: None
+            for key in (
+                "min_ms",
+                "mean_ms",
+                "median_ms",
+                "p95_ms",
+                "stddev_ms",
+                "jitter_ms",
+            )
+        }
+
+    diffs = [abs(b - a) for a, b in zip(values, values[1:])]
+    return {
+        "min_ms": rounded(min(values)),
+        "mean_ms": rounded(statistics.fmean(values)),
+        "median_ms": rounded(statistics.median(values)),
+        "p95_ms": rounded(percentile(values, 95)),
+        "stddev_ms": rounded(statistics.stdev(values)) if len(values) > 1 else 0.0,
+        "jitter_ms": rounded(statistics.fmean(diffs)) if diffs else 0.0,
+    }
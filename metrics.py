@@ -0,0 +1,312 @@
+"""In-process Prometheus metrics, rendered in the text exposition format.
+
+Only counters, gauges and histograms are implemented, which is all the app
+needs; every metric defined here is exported by ``/metrics``.
+"""
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; DNS round trips range from sub-millisecond cache hits to timeouts.
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts (the last slot is +Inf), sum, count.
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _samples(self) -> list[str]:
+        lines = []
+        bucket_labels = self.labelnames + ("le",)
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(bucket_labels, key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Time the stages of one request.
+
+    Each stage is observed in ``histogram`` (labelled ``stage``) and kept in
+    ``timings`` so it can be echoed back, e.g. as a ``Server-Timing`` header.
+    """
+
+    def __init__(self, histogram: Optional[Histogram] = None):
+        self.histogram = histogram
+        self.timings: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=name)
+
+    def as_ms(self) -> dict[str, float]:
+        return {name: round(s * 1000, 3) for name, s in self.timings.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.as_ms().items())
+
+
+registry = Registry()
+
+# DoH forwarder (/dns-query and the plain DNS listener)
+FORWARD_QUERIES = registry.register(
+    Counter(
+        "ezdns_forward_queries_total",
+        "Queries answered by the forwarder, by response rcode.",
+        ("rcode",),
+    )
+)
+FORWARD_CACHE = registry.register(
+    Counter(
+        "ezdns_forward_cache_lookups_total",
+        "Forwarder response cache lookups.",
+        ("result",),
+    )
+)
+FORWARD_DURATION = registry.register(
+    Histogram(
+        "ezdns_forward_duration_seconds",
+        "Time to answer a forwarded query, cache hits included.",
+    )
+)
+FORWARD_STAGE_DURATION = registry.register(
+    Histogram(
+        "ezdns_forward_stage_duration_seconds",
+        "Time spent in each stage of a forwarded query.",
+        ("stage",),
+    )
+)
+FORWARD_COALESCED = registry.register(
+    Counter(
+        "ezdns_forward_coalesced_total",
+        "Queries that joined an identical upstream lookup already in flight.",
+    )
+)
+FORWARD_STALE = registry.register(
+    Counter(
+        "ezdns_forward_stale_answers_total",
+        "Expired cached answers served because the upstream lookup failed.",
+    )
+)
+FORWARD_PREFETCHES = registry.register(
+    Counter(
+        "ezdns_forward_prefetches_total",
+        "Background refreshes of popular cache entries about to expire.",
+    )
+)
+RACE_ATTEMPTS = registry.register(
+    Histogram(
+        "ezdns_race_attempts",
+        "Upstreams queried per raced lookup (fallback depth).",
+        buckets=(1, 2, 3, 4, 5, 6, 8, 10, 12),
+    )
+)
+
+# Upstream exchanges made by the forwarder
+UPSTREAM_REQUESTS = registry.register(
+    Counter(
+        "ezdns_upstream_requests_total",
+        "Forwarder exchanges with an upstream, by outcome.",
+        ("upstream", "outcome"),
+    )
+)
+UPSTREAM_DURATION = registry.register(
+    Histogram(
+        "ezdns_upstream_duration_seconds",
+        "Forwarder upstream round trip time, by outcome.",
+        ("upstream", "outcome"),
+    )
+)
+UPSTREAM_CIRCUIT_OPEN = registry.register(
+    Gauge(
+        "ezdns_upstream_circuit_open",
+        "1 while an upstream's circuit breaker is open or half-open.",
+        ("upstream",),
+    )
+)
+
+# Upstream query scheduler (rate limits and in-flight cap)
+SCHEDULER_REFUSED = registry.register(
+    Counter(
+        "ezdns_scheduler_refused_total",
+        "Upstream queries refused by the scheduler: backlog full or waited too long.",
+        ("reason",),
+    )
+)
+SCHEDULER_WAIT = registry.register(
+    Histogram(
+        "ezdns_scheduler_wait_seconds",
+        "Time queued upstream queries waited for a rate limit token and a slot.",
+    )
+)
+SCHEDULER_IN_FLIGHT = registry.register(
+    Gauge("ezdns_scheduler_in_flight", "Upstream queries currently in flight.")
+)
+SCHEDULER_WAITING = registry.register(
+    Gauge("ezdns_scheduler_waiting", "Upstream queries queued in the backlog.")
+)
+
+# dns_tester probes (/api/test, /api/query, /api/batch)
+PROBES = registry.register(
+    Counter(
+        "ezdns_probes_total",
+        "Probes run against a DNS server, by transport and status.",
+        ("transport", "status"),
+    )
+)
+PROBE_DURATION = registry.register(
+    Histogram(
+        "ezdns_probe_duration_seconds",
+        "Probe duration, by transport and status.",
+        ("transport", "status"),
+    )
+)
+CLI_QUERIES = registry.register(
+    Counter(
+        "ezdns_cli_queries_total",
+        "Requests served by /api/query, by output format.",
+        ("format",),
+    )
+)
+CLI_QUERY_DURATION = registry.register(
+    Histogram(
+        "ezdns_cli_query_duration_seconds",
+        "Time to answer an /api/query request.",
+    )
+)
+
+# Forwarder response cache
+CACHE_ENTRIES = registry.register(
+    Gauge("ezdns_cache_entries", "Entries in the forwarder response cache.")
+)
@@ -0,0 +1,210 @@
+"""Asyncio rate limiting primitives."""
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import metrics
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, up to ``burst``."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def refund(self) -> None:
+        """Give back a token taken by ``try_acquire``."""
+        self._tokens = min(self.burst, self._tokens + 1)
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available and nobody is waiting for it."""
+        if self._lock.locked():
+            return False
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        # The lock keeps waiters in FIFO order.
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class Overloaded(Exception):
+    """Raised when the scheduler refuses a query instead of queueing it."""
+
+
+class UpstreamScheduler:
+    """Admission control for queries sent to upstream servers.
+
+    At most ``max_in_flight`` queries run at once (0 = unlimited), and an
+    upstream with a rate limit gets a token bucket of ``qps`` tokens per
+    second up to ``burst``. An upstream's limit is set once with
+    ``configure``, falling back to ``default_qps``/``default_burst``; a
+    ``qps`` of 0 means no rate limit. Limits passed with a query can only
+    tighten that: they get a bucket of their own that the query has to pass
+    as well, so they never replace or lift the upstream's limit. A query
+    that cannot start straight away waits
+    in a backlog of at most ``max_backlog`` queries for up to ``max_wait``
+    seconds; past either limit it is refused with ``Overloaded``.
+    """
+
+    # Buckets kept for upstreams seen recently; the oldest is dropped first.
+    MAX_BUCKETS = 1024
+
+    def __init__(
+        self,
+        max_in_flight: int = 256,
+        max_backlog: int = 1024,
+        max_wait: float = 2.0,
+        default_qps: float = 0.0,
+        default_burst: float = 0.0,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_backlog = max_backlog
+        self.max_wait = max_wait
+        self.default_qps = default_qps
+        self.default_burst = default_burst
+        self.in_flight = 0
+        self.waiting = 0
+        self.refused = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+        # Limits set with ``configure``; their buckets are never evicted.
+        self._limits: dict[str, tuple[float, float]] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        # Buckets of default-limited upstreams and of per-query limits.
+        self._other_buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+
+    def configure(
+        self, key: str, qps: Optional[float], burst: Optional[float] = None
+    ) -> None:
+        """Set the rate limit of upstream ``key`` (a ``qps`` of 0 = none)."""
+        qps = qps or 0.0
+        self._limits[key] = (qps, burst or qps)
+        self._buckets.pop(key, None)
+        if qps > 0:
+            self._buckets[key] = TokenBucket(qps, burst or qps)
+
+    def _other_bucket(self, bucket_key: tuple, qps: float, burst: float) -> TokenBucket:
+        bucket = self._other_buckets.get(bucket_key)
+        if bucket is None:
+            if len(self._other_buckets) >= self.MAX_BUCKETS:
+                self._other_buckets.popitem(last=False)
+            bucket = self._other_buckets[bucket_key] = TokenBucket(qps, burst)
+        else:
+            self._other_buckets.move_to_end(bucket_key)
+        return bucket
+
+    def _bucket_chain(
+        self, key: str, qps: Optional[float], burst: Optional[float]
+    ) -> list[TokenBucket]:
+        """Buckets a query to ``key`` with the given limits has to pass."""
+        if key in self._limits:
+            base_qps, base_burst = self._limits[key]
+            base = self._buckets.get(key)
+        else:
+            base_qps, base_burst = (
+                self.default_qps,
+                self.default_burst or self.default_qps,
+            )
+            base = None
+            if base_qps > 0:
+                base = self._other_bucket((key,), base_qps, base_burst)
+        buckets = [base] if base is not None else []
+
+        if qps and qps > 0:
+            burst = burst or qps
+            if base is None or qps < base_qps or burst < base_burst:
+                buckets.append(self._other_bucket((key, qps, burst), qps, burst))
+        return buckets
+
+    async def _try_start(self, buckets: list[TokenBucket]) -> bool:
+        if self._semaphore is not None and self._semaphore.locked():
+            return False
+        taken = []
+        for bucket in buckets:
+            if not bucket.try_acquire():
+                for previous in taken:
+                    previous.refund()
+                return False
+            taken.append(bucket)
+        if self._semaphore is not None:
+            # Not locked, so this returns without waiting.
+            await self._semaphore.acquire()
+        return True
+
+    async def _start(self, buckets: list[TokenBucket]) -> None:
+        for bucket in buckets:
+            await bucket.acquire()
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+
+    def _refuse(self, reason: str, message: str) -> Overloaded:
+        self.refused += 1
+        metrics.SCHEDULER_REFUSED.inc(reason=reason)
+        return Overloaded(message)
+
+    @asynccontextmanager
+    async def slot(
+        self, key: str, qps: Optional[float] = None, burst: Optional[float] = None
+    ):
+        """Hold a slot for one query to upstream ``key`` while in the block.
+
+        ``qps``/``burst`` only apply where they are stricter than the
+        upstream's own limit.
+        """
+        buckets = self._bucket_chain(key, qps, burst)
+        if not await self._try_start(buckets):
+            if self.waiting >= self.max_backlog:
+                raise self._refuse(
+                    "backlog", f"Too many queued upstream queries, refused {key}"
+                )
+            self.waiting += 1
+            start_time = time.monotonic()
+            try:
+                await asyncio.wait_for(self._start(buckets), self.max_wait or None)
+            except asyncio.TimeoutError:
+                raise self._refuse(
+                    "timeout", f"Waited over {self.max_wait}s to query {key}"
+                ) from None
+            finally:
+                self.waiting -= 1
+                metrics.SCHEDULER_WAIT.observe(time.monotonic() - start_time)
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "refused": self.refused,
+            "max_in_flight": self.max_in_flight,
+            "max_backlog": self.max_backlog,
+            "max_wait_seconds": self.max_wait,
+            "rate_limited_upstreams": len(self._buckets) + len(self._other_buckets),
+        }
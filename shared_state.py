@@ -0,0 +1,201 @@
+"""SQLite store for state shared by the worker processes of one deployment.
+
+With several workers (``EZDNS_WORKERS``), each process still keeps its own
+in-memory response cache and upstream health, but writes both through to
+this store and falls back to it on a local miss, so a name resolved by one
+worker is a cache hit in the others and every worker sees the same circuit
+breakers. The database lives in a local file (ideally on tmpfs) in WAL
+mode.
+
+Only reads run on the caller's (event loop) thread: in WAL mode they never
+wait for the write lock. Every write goes to a single writer thread with its
+own connection, so a worker busy committing never stalls the others' loops.
+"""
+
+import json
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key BLOB PRIMARY KEY,
+    wire BLOB NOT NULL,
+    stored_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+CREATE TABLE IF NOT EXISTS health (
+    key TEXT PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+"""
+
+
+def _cache_key(key: tuple) -> bytes:
+    return repr(key).encode()
+
+
+class SharedStore:
+    """Response cache entries and upstream health records in one database.
+
+    Times stored here are wall-clock (``time.time()``) so they mean the same
+    thing in every process.
+    """
+
+    # Expired cache rows are purged every this many writes.
+    PRUNE_EVERY = 256
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        # Reads only; used from the event loop thread, which may not be the
+        # thread that imported the app.
+        self._db = self._connect()
+        self._db.executescript(_SCHEMA)
+        self._writes = 0
+        self._writer_db: Optional[sqlite3.Connection] = None
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="shared-state",
+            initializer=self._open_writer,
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        return db
+
+    def _open_writer(self) -> None:
+        self._writer_db = self._connect()
+
+    def _write(self, fn: Callable[..., object], *args) -> Future:
+        """Run ``fn(*args)`` on the writer thread; errors stay in the future."""
+        return self._writer.submit(fn, *args)
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        if self._writer_db is not None:
+            self._writer_db.close()
+        self._db.close()
+
+    # Response cache
+
+    def cache_get(self, key: tuple) -> Optional[tuple[bytes, float, float]]:
+        """``(wire, stored_at, expires_at)`` for ``key``, if stored."""
+        return self._db.execute(
+            "SELECT wire, stored_at, expires_at FROM cache WHERE key = ?",
+            (_cache_key(key),),
+        ).fetchone()
+
+    def cache_put(
+        self,
+        key: tuple,
+        wire: bytes,
+        stored_at: float,
+        expires_at: float,
+        keep_for: float = 0.0,
+        max_entries: int = 0,
+    ) -> None:
+        """Store an entry in the background, pruning every ``PRUNE_EVERY`` writes.
+
+        Pruning drops rows more than ``keep_for`` seconds past expiry and,
+        with ``max_entries``, the rows expiring soonest beyond that count.
+        """
+        self._write(
+            self._cache_put,
+            _cache_key(key),
+            wire,
+            stored_at,
+            expires_at,
+            keep_for,
+            max_entries,
+        )
+
+    def _cache_put(
+        self,
+        key: bytes,
+        wire: bytes,
+        stored_at: float,
+        expires_at: float,
+        keep_for: float,
+        max_entries: int,
+    ) -> None:
+        db = self._writer_db
+        db.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (key, wire, stored_at, expires_at),
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            db.execute(
+                "DELETE FROM cache WHERE expires_at < ?", (time.time() - keep_for,)
+            )
+            if max_entries:
+                db.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache"
+                    " ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                )
+
+    def cache_clear(self) -> Future:
+        return self._write(self._cache_clear)
+
+    def _cache_clear(self) -> None:
+        self._writer_db.execute("DELETE FROM cache")
+
+    def cache_size(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    # Upstream health
+
+    def health_sync(
+        self, updates: dict[str, Callable[[Optional[dict]], dict]]
+    ) -> Future:
+        """Apply ``updates`` and read every record back, on the writer thread.
+
+        Each ``updates[key]`` turns the stored record of ``key`` (None if
+        there is none) into the new one. All of them run in one transaction,
+        so they are atomic across workers. The future's result is the
+        ``health_all`` mapping after the updates.
+        """
+        return self._write(self._health_sync, updates)
+
+    def _health_sync(
+        self, updates: dict[str, Callable[[Optional[dict]], dict]]
+    ) -> dict[str, dict]:
+        db = self._writer_db
+        if updates:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for key, update in updates.items():
+                    row = db.execute(
+                        "SELECT stats FROM health WHERE key = ?", (key,)
+                    ).fetchone()
+                    record = update(json.loads(row[0]) if row else None)
+                    db.execute(
+                        "INSERT OR REPLACE INTO health VALUES (?, ?)",
+                        (key, json.dumps(record)),
+                    )
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return self._health_all(db)
+
+    def health_all(self) -> dict[str, dict]:
+        return self._health_all(self._db)
+
+    @staticmethod
+    def _health_all(db: sqlite3.Connection) -> dict[str, dict]:
+        return {
+            key: json.loads(stats)
+            for key, stats in db.execute("SELECT key, stats FROM health")
+        }
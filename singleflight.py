@@ -0,0 +1,43 @@
+"""Coalescing of concurrent identical asyncio calls."""
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Share one in-progress call among all concurrent callers of a key.
+
+    The call runs in its own task, so a caller that gives up (e.g. a client
+    that disconnects) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller went away.
+            task.exception()
+
+    async def do(
+        self, key: Hashable, call: Callable[[], Awaitable[T]]
+    ) -> tuple[T, bool]:
+        """Await ``call()``, or the call already running for ``key``.
+
+        Returns ``(result, shared)``; ``shared`` is true when this caller
+        joined a call started by someone else.
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task), shared
+
+    def __len__(self) -> int:
+        return len(self._calls)
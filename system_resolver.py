@@ -0,0 +1,111 @@
+"""Shared system resolver for the ``local`` upstream.
+
+Building a ``dns.asyncresolver.Resolver`` reads and parses
+``/etc/resolv.conf``, so instead of doing that on every ``local`` probe or
+forwarded query one instance is kept and only rebuilt when the file's mtime
+changes (checked at most once per ``check_interval``).
+"""
+
+import os
+import time
+from typing import TYPE_CHECKING, Optional
+
+import dns.rdatatype
+
+import config
+
+if TYPE_CHECKING:
+    import dns.asyncresolver
+    import dns.resolver
+
+RESOLV_CONF = "/etc/resolv.conf"
+
+
+class SystemResolver:
+    """Lazily (re)loaded ``dns.asyncresolver.Resolver`` for the host's config.
+
+    With ``cache_size`` set, answers are kept in dnspython's ``LRUCache``;
+    the cache is dropped along with the resolver when the config changes.
+    """
+
+    def __init__(
+        self,
+        path: str = RESOLV_CONF,
+        cache_size: int = 0,
+        check_interval: float = 1.0,
+    ):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._resolver: Optional["dns.asyncresolver.Resolver"] = None
+        self._mtime: Optional[int] = None
+        self._checked_at = 0.0
+
+    def _config_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            # No resolv.conf (e.g. Windows): dnspython reads the system
+            # config some other way, so load it once.
+            return None
+
+    def get(self) -> "dns.asyncresolver.Resolver":
+        """The current resolver, rebuilt first if the config file changed."""
+        # Imported here: dns.resolver is slow to import and only needed once
+        # a ``local`` upstream or a DoH/DoT hostname is used.
+        import dns.asyncresolver
+        import dns.resolver
+
+        now = time.monotonic()
+        if self._resolver is not None and now - self._checked_at < self.check_interval:
+            return self._resolver
+        self._checked_at = now
+        mtime = self._config_mtime()
+        if self._resolver is None or mtime != self._mtime:
+            resolver = dns.asyncresolver.Resolver(filename=self.path)
+            if self.cache_size:
+                resolver.cache = dns.resolver.LRUCache(self.cache_size)
+            self._resolver = resolver
+            self._mtime = mtime
+            self.reloads += 1
+        return self._resolver
+
+    async def resolve(
+        self, domain: str, rdtype: int, timeout: float = 5.0
+    ) -> "dns.resolver.Answer":
+        """Resolve ``domain`` with ``timeout`` as the overall lifetime."""
+        return await self.get().resolve(
+            domain, dns.rdatatype.to_text(rdtype), lifetime=timeout
+        )
+
+    def nameservers(self) -> list[tuple[str, int]]:
+        """``(address, port)`` of each configured nameserver."""
+        resolver = self.get()
+        return [(str(nameserver), resolver.port) for nameserver in resolver.nameservers]
+
+    def stats(self) -> dict:
+        import dns.resolver
+
+        try:
+            resolver = self.get()
+            nameservers = [str(nameserver) for nameserver in resolver.nameservers]
+            error = None
+        except dns.resolver.NoResolverConfiguration as e:
+            # Only the ``local`` upstream needs it; report why it can't work.
+            resolver, nameservers, error = None, [], str(e)
+        stats = {
+            "available": resolver is not None,
+            "nameservers": nameservers,
+            "reloads": self.reloads,
+            "cache_size": self.cache_size,
+        }
+        if error is not None:
+            stats["error"] = error
+        if resolver is not None and resolver.cache is not None:
+            stats["cache_hits"] = resolver.cache.hits()
+            stats["cache_misses"] = resolver.cache.misses()
+        return stats
+
+
+resolver = SystemResolver(cache_size=config.LOCAL_RESOLVER_CACHE_SIZE)
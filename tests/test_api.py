@@ -0,0 +1,80 @@
+"""Request validation of the HTTP API; nothing here reaches an upstream."""
+
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import dns_tester
+
+
+@pytest.fixture
+def client():
+    # Without the lifespan: no listener, warm-up or scheduled checks.
+    return TestClient(app.app)
+
+
+@pytest.mark.parametrize("server", ["127.0.0.1:xx", "127.0.0.1:abc#qps=5"])
+def test_probe_rejects_malformed_port(client, server):
+    response = client.post(
+        "/api/test", json={"type": "udp", "server": server, "domain": "example.com"}
+    )
+    assert response.status_code == 400
+    assert "Invalid port" in response.json()["detail"]
+
+
+def test_query_rejects_malformed_port(client):
+    response = client.get(
+        "/api/query", params={"domain": "example.com", "server": "udp://127.0.0.1:abc"}
+    )
+    assert response.status_code == 400
+
+
+def test_forwarder_rejects_malformed_port(client):
+    response = client.post(
+        "/dns-query",
+        params={"upstream": "dot://127.0.0.1:abc"},
+        content=b"\0" * 12,
+        headers={"content-type": "application/dns-message"},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("probe", [dns_tester.test_udp, dns_tester.test_dot])
+def test_probe_reports_malformed_port(probe):
+    result = asyncio.run(probe("127.0.0.1:xx", "example.com", "A"))
+    assert result["status"] == "error"
+    assert "Invalid port" in result["error"]
+
+
+def test_query_format_label_is_bounded(client, monkeypatch):
+    async def probe(parsed, *args):
+        return {"status": "success", "latency_ms": 1.0, "answers": []}
+
+    monkeypatch.setattr(app, "_run_probe", probe)
+    for output_format in ("x1", "x2", "simple"):
+        response = client.get(
+            "/api/query",
+            params={
+                "domain": "example.com",
+                "server": "udp://192.0.2.1",
+                "format": output_format,
+            },
+        )
+        assert response.status_code == 200
+    text = client.get("/metrics").text
+    assert 'ezdns_cli_queries_total{format="x1"}' not in text
+    assert 'ezdns_cli_queries_total{format="other"}' in text
+    assert 'ezdns_cli_queries_total{format="simple"}' in text
+
+
+def test_cache_stats_without_resolver_config(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        app.system_resolver,
+        "resolver",
+        app.system_resolver.SystemResolver(str(tmp_path / "missing")),
+    )
+    response = client.get("/api/cache")
+    assert response.status_code == 200
+    assert response.json()["local_resolver"]["available"] is False
@@ -0,0 +1,187 @@
+"""TTL-aware response cache of the forwarder (``dns_cache``)."""
+
+import dns.edns
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+import dns_cache
+import dns_wire
+
+
+class Clock:
+    """Stands in for the ``time`` module so tests can move time forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dns_cache, "time", clock)
+    return clock
+
+
+def response(
+    qname="example.com", ttl=300, rcode=dns.rcode.NOERROR, soa=None, use_edns=None
+):
+    query = dns.message.make_query(qname, "A", use_edns=use_edns)
+    message = dns.message.make_response(query)
+    message.set_rcode(rcode)
+    if rcode == dns.rcode.NOERROR and soa is None:
+        message.answer.append(
+            dns.rrset.from_text(
+                query.question[0].name, ttl, "IN", "A", "192.0.2.1", "192.0.2.2"
+            )
+        )
+    if soa is not None:
+        message.authority.append(
+            dns.rrset.from_text(
+                "com.", soa[0], "IN", "SOA", f"ns.com. host.com. 1 2 3 4 {soa[1]}"
+            )
+        )
+    return message.to_wire()
+
+
+def key(wire: bytes) -> tuple:
+    return dns_cache.DNSCache.make_key(dns_wire.parse_query(wire)[1], None)
+
+
+def ttls(wire: bytes) -> list[int]:
+    message = dns.message.from_wire(wire)
+    return [rrset.ttl for rrset in message.answer + message.authority]
+
+
+def test_answer_lives_for_its_ttl(clock):
+    cache = dns_cache.DNSCache()
+    wire = response(ttl=300)
+    cache.put(key(wire), wire)
+
+    clock.now += 100
+    cached = cache.get(key(wire), 0x1234)
+    assert dns.message.from_wire(cached).id == 0x1234
+    assert ttls(cached) == [200]
+    assert cached[2:] != wire[2:] and len(cached) == len(wire)
+
+    clock.now += 200
+    assert cache.get(key(wire), 1) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_is_capped(clock):
+    cache = dns_cache.DNSCache(max_ttl=60)
+    wire = response(ttl=3600)
+    cache.put(key(wire), wire)
+    clock.now += 59
+    assert cache.get(key(wire), 1) is not None
+    clock.now += 1
+    assert cache.get(key(wire), 1) is None
+
+
+@pytest.mark.parametrize(
+    "rcode, soa, expected",
+    [
+        (dns.rcode.NXDOMAIN, (900, 120), 120),
+        (dns.rcode.NOERROR, (60, 600), 60),
+        (dns.rcode.NXDOMAIN, None, None),
+        (dns.rcode.SERVFAIL, (900, 120), None),
+    ],
+)
+def test_negative_answers_use_the_soa(clock, rcode, soa, expected):
+    cache = dns_cache.DNSCache()
+    wire = response(rcode=rcode, soa=soa)
+    cache.put(key(wire), wire)
+    clock.now += (expected or 0) - 1
+    assert (cache.get(key(wire), 1) is not None) == (expected is not None)
+    clock.now += 1
+    assert cache.get(key(wire), 1) is None
+
+
+def test_truncated_answers_are_not_cached():
+    cache = dns_cache.DNSCache()
+    wire = dns_wire.truncate(response())
+    cache.put(key(wire), wire)
+    assert not cache._entries
+
+
+def test_asker_spelling_of_the_name(clock):
+    cache = dns_cache.DNSCache()
+    wire = response("example.com")
+    cache.put(key(wire), wire)
+
+    query = dns.message.make_query("ExAmPlE.cOm", "A").to_wire()
+    query_id, question = dns_wire.parse_query(query)
+    assert dns_cache.DNSCache.make_key(question, None) == key(wire)
+    qname = query[12 : 12 + len(question[0])]
+    cached = dns.message.from_wire(cache.get(key(wire), query_id, qname=qname))
+    assert cached.id == query_id
+    assert cached.question[0].name.to_text() == "ExAmPlE.cOm."
+
+
+def test_fallback_and_lru(clock):
+    cache = dns_cache.DNSCache(max_entries=2)
+    first, second, third = (response(f"{name}.example") for name in "abc")
+    for wire in (first, second, third):
+        cache.put(key(wire), wire)
+    assert cache.evictions == 1
+    assert cache.get(key(first), 1) is None
+    assert cache.get(key(first), 1, fallback=key(second)) is not None
+
+
+@pytest.mark.parametrize("use_edns", [None, 0])
+def test_stale_answers(clock, use_edns):
+    cache = dns_cache.DNSCache(stale_ttl=600, stale_answer_ttl=30)
+    wire = response(ttl=300, use_edns=use_edns)
+    cache.put(key(wire), wire)
+    clock.now += 400
+    assert cache.get(key(wire), 1) is None
+
+    stale = dns.message.from_wire(cache.get_stale(key(wire), 0x4321))
+    assert stale.id == 0x4321
+    assert [rrset.ttl for rrset in stale.answer] == [30]
+    ede = [option for option in stale.options if option.otype == dns.edns.EDE]
+    if use_edns is None:
+        assert stale.edns == -1
+    else:
+        assert [option.code for option in ede] == [dns.edns.EDECode.STALE_ANSWER]
+    assert cache.stale_hits == 1
+
+    clock.now += 500
+    assert cache.get_stale(key(wire), 1) is None
+
+
+def test_no_stale_answers_when_disabled(clock):
+    cache = dns_cache.DNSCache(stale_ttl=0)
+    wire = response(ttl=300)
+    cache.put(key(wire), wire)
+    clock.now += 301
+    assert cache.get_stale(key(wire), 1) is None
+
+
+def test_prefetch_popular_entries_once(clock):
+    cache = dns_cache.DNSCache(prefetch_min_hits=2, prefetch_window=0.1)
+    wire = response(ttl=100)
+    cache.put(key(wire), wire)
+    cache.get(key(wire), 1)
+    clock.now += 95
+    assert not cache.should_prefetch(key(wire))
+
+    cache.get(key(wire), 1)
+    assert cache.should_prefetch(key(wire))
+    assert not cache.should_prefetch(key(wire))
+    assert cache.prefetches == 1
+
+    # A refreshed answer can be prefetched again.
+    cache.put(key(wire), wire)
+    cache.get(key(wire), 1)
+    cache.get(key(wire), 1)
+    clock.now += 91
+    assert cache.should_prefetch(key(wire))
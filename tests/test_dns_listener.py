@@ -0,0 +1,152 @@
+"""Plain DNS listener framing, truncation and limits (``dns_listener``)."""
+
+import asyncio
+import socket
+import struct
+
+import dns.flags
+import dns.message
+import dns.rrset
+import pytest
+
+import dns_listener
+import dns_wire
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def big_response(query: dns.message.Message) -> bytes:
+    response = dns.message.make_response(query)
+    response.answer.append(
+        dns.rrset.from_text(
+            query.question[0].name,
+            300,
+            "IN",
+            "TXT",
+            *[f'"{i}{"x" * 200}"' for i in range(5)],
+        )
+    )
+    return response.to_wire(max_size=65535)
+
+
+@pytest.mark.parametrize("use_edns", [False, True])
+def test_truncate_keeps_opt(use_edns):
+    query = dns.message.make_query("example.com", "TXT", use_edns=use_edns)
+    wire = big_response(query)
+    original = dns.message.from_wire(wire)
+    truncated = dns.message.from_wire(dns_wire.truncate(wire))
+    assert truncated.flags & dns.flags.TC
+    assert truncated.id == query.id
+    assert truncated.question == query.question
+    assert not truncated.answer and not truncated.authority
+    assert truncated.edns == original.edns
+    assert truncated.payload == original.payload
+
+
+def run_listener(handler, test, **options):
+    async def main():
+        port = free_port()
+        listener = dns_listener.DNSListener(handler, "127.0.0.1", port, **options)
+        await listener.start()
+        try:
+            return await test(port)
+        finally:
+            await listener.stop()
+
+    return asyncio.run(main())
+
+
+def test_udp_truncation_keeps_edns():
+    async def handler(wire, client_ip):
+        return big_response(dns.message.from_wire(wire))
+
+    async def test(port):
+        query = dns.message.make_query("example.com", "TXT", use_edns=0, payload=600)
+        loop = asyncio.get_running_loop()
+        received = loop.create_future()
+
+        class Client(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                received.set_result(data)
+
+        transport, _ = await loop.create_datagram_endpoint(
+            Client, remote_addr=("127.0.0.1", port)
+        )
+        transport.sendto(query.to_wire())
+        try:
+            return dns.message.from_wire(await asyncio.wait_for(received, 5))
+        finally:
+            transport.close()
+
+    response = run_listener(handler, test)
+    assert response.flags & dns.flags.TC
+    assert response.edns == 0
+    assert not response.answer
+
+
+async def tcp_query(writer, reader, query: bytes) -> bytes:
+    writer.write(struct.pack("!H", len(query)) + query)
+    (length,) = struct.unpack("!H", await reader.readexactly(2))
+    return await reader.readexactly(length)
+
+
+def test_tcp_pipelining_is_capped():
+    in_flight = 0
+    peak = 0
+    release = None
+
+    async def handler(wire, client_ip):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await release.wait()
+        in_flight -= 1
+        return dns.message.make_response(dns.message.from_wire(wire)).to_wire()
+
+    async def test(port):
+        nonlocal release
+        release = asyncio.Event()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        queries = [dns.message.make_query(f"q{i}.example", "A") for i in range(20)]
+        for query in queries:
+            wire = query.to_wire()
+            writer.write(struct.pack("!H", len(wire)) + wire)
+        await asyncio.sleep(0.2)
+        capped = peak
+        release.set()
+        ids = set()
+        for _ in queries:
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+            ids.add(dns.message.from_wire(await reader.readexactly(length)).id)
+        writer.close()
+        return capped, ids == {q.id for q in queries}
+
+    capped, all_answered = run_listener(handler, test, max_pipelined=4)
+    assert capped == 4
+    assert all_answered
+
+
+def test_idle_connections_are_closed_and_capped():
+    async def handler(wire, client_ip):
+        return dns.message.make_response(dns.message.from_wire(wire)).to_wire()
+
+    async def test(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        query = dns.message.make_query("example.com", "A")
+        answer = dns.message.from_wire(await tcp_query(writer, reader, query.to_wire()))
+        assert answer.id == query.id
+
+        # One connection is open, so a second one over the cap is closed.
+        extra_reader, extra_writer = await asyncio.open_connection("127.0.0.1", port)
+        assert await asyncio.wait_for(extra_reader.read(), 2) == b""
+        extra_writer.close()
+
+        # And the idle one is closed after the timeout.
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        writer.close()
+
+    run_listener(handler, test, idle_timeout=0.2, max_connections=1)
@@ -0,0 +1,148 @@
+"""Wire-format queries and lazily parsed responses (``dns_wire``)."""
+
+import dns.edns
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
+import dns_wire
+
+
+def make_response(use_edns=None, options=()) -> dns.message.Message:
+    query = dns.message.make_query("example.com", "A", use_edns=use_edns)
+    response = dns.message.make_response(query)
+    if use_edns is not None:
+        response.use_edns(0, 0, 1232, options=list(options))
+    name = query.question[0].name
+    response.answer.append(dns.rrset.from_text(name, 300, "IN", "A", "192.0.2.1"))
+    response.answer.append(dns.rrset.from_text(name, 60, "IN", "AAAA", "2001:db8::1"))
+    response.answer.append(
+        dns.rrset.from_text(name, 120, "IN", "MX", "10 mail.example.com.")
+    )
+    response.authority.append(
+        dns.rrset.from_text(name, 90, "IN", "NS", "ns.example.com.")
+    )
+    return response
+
+
+def test_make_query():
+    first, first_id = dns_wire.make_query("example.com", dns.rdatatype.AAAA)
+    second, _ = dns_wire.make_query("example.com", dns.rdatatype.AAAA)
+    assert first[2:] == second[2:]
+    query = dns.message.from_wire(first)
+    assert query.id == first_id
+    assert query.question[0].rdtype == dns.rdatatype.AAAA
+    assert query.edns == -1
+
+    ecs = dns.edns.ECSOption("192.0.2.0", 24).to_wire()
+    wire, _ = dns_wire.make_query(
+        "example.com", dns.rdatatype.A, payload=4096, dnssec=True, ecs=ecs
+    )
+    query = dns.message.from_wire(wire)
+    assert query.payload == 4096
+    assert query.ednsflags & dns.flags.DO
+    assert query.flags & dns.flags.AD
+    assert [option.otype for option in query.options] == [dns.edns.ECS]
+
+
+def test_parse_query():
+    query = dns.message.make_query("ExAmple.COM", "MX")
+    message_id, question = dns_wire.parse_query(query.to_wire())
+    assert message_id == query.id
+    assert question == (b"\x07example\x03com\x00", dns.rdatatype.MX, 1)
+
+
+@pytest.mark.parametrize(
+    "wire",
+    [
+        b"\0" * 11,
+        b"\0\1\1\0\0\2\0\0\0\0\0\0\0\0\1\0\1\0\0\1\0\1",
+        b"\0\1\1\0\0\1\0\0\0\0\0\0\x07exam",
+        b"\0\1\1\0\0\1\0\0\0\0\0\0\x40example",
+        b"\0\1\1\0\0\1\0\0\0\0\0\0\0\0\1",
+    ],
+    ids=["short", "two questions", "truncated name", "label type", "no class"],
+)
+def test_parse_query_rejects_malformed(wire):
+    with pytest.raises(dns_wire.WireError):
+        dns_wire.parse_query(wire)
+
+
+def test_parse_response_checks_id_and_qr():
+    response = make_response()
+    wire = response.to_wire()
+    assert dns_wire.parse_response(wire, response.id).id == response.id
+    with pytest.raises(dns_wire.WireError, match="ID mismatch"):
+        dns_wire.parse_response(wire, response.id ^ 1)
+    query = dns.message.make_query("example.com", "A")
+    with pytest.raises(dns_wire.WireError, match="not a DNS response"):
+        dns_wire.parse_response(query.to_wire(), query.id)
+
+
+def test_records_and_answers():
+    message = dns_wire.WireMessage(make_response().to_wire())
+    records = list(message.records())
+    assert [(section, rdtype) for section, rdtype, *_ in records] == [
+        (dns_wire.ANSWER, dns.rdatatype.A),
+        (dns_wire.ANSWER, dns.rdatatype.AAAA),
+        (dns_wire.ANSWER, dns.rdatatype.MX),
+        (dns_wire.AUTHORITY, dns.rdatatype.NS),
+    ]
+    assert message.answers(dns.rdatatype.AAAA) == (["[AAAA] 2001:db8::1"], 60)
+    assert message.answers(dns.rdatatype.A, any_type=True) == (
+        ["[A] 192.0.2.1", "[AAAA] 2001:db8::1", "[MX] 10 mail.example.com."],
+        60,
+    )
+    assert message.answers(dns.rdatatype.TXT) == ([], None)
+
+
+def test_truncated_record_is_rejected():
+    wire = make_response().to_wire()
+    with pytest.raises(dns_wire.WireError):
+        list(dns_wire.WireMessage(wire[:-3]).records())
+
+
+def test_edns_fields():
+    response = make_response(use_edns=0, options=[dns.edns.EDEOption(3)])
+    response.set_rcode(dns.rcode.BADVERS)
+    message = dns_wire.WireMessage(response.to_wire())
+    assert message.rcode() == dns.rcode.BADVERS
+    assert message.edns_payload() == 1232
+    assert [code for code, _ in message.edns_options()] == [dns.edns.EDE]
+    # Every TTL but the OPT record's, which holds the extended rcode.
+    assert len(message.ttl_offsets()) == 4
+
+    plain = dns_wire.WireMessage(make_response().to_wire())
+    assert plain.edns_payload() is None and plain.edns_flags() is None
+    assert plain.edns_options() == []
+
+
+def test_replace_opt():
+    opt = dns_wire.build_opt(4096, 0, [(dns.edns.ECS, b"\0\1\0\0")])
+    plain = make_response().to_wire()
+    added = dns.message.from_wire(dns_wire.replace_opt(plain, opt))
+    assert added.payload == 4096
+    assert [option.otype for option in added.options] == [dns.edns.ECS]
+
+    with_edns = make_response(use_edns=0).to_wire()
+    replaced = dns.message.from_wire(dns_wire.replace_opt(with_edns, opt))
+    assert replaced.payload == 4096
+    removed = dns.message.from_wire(dns_wire.replace_opt(with_edns, None))
+    assert removed.edns == -1
+    assert dns_wire.replace_opt(plain, None) == plain
+
+
+def test_restore_qname():
+    wire = bytearray(make_response().to_wire())
+    dns_wire.restore_qname(wire, b"\x07ExAmPlE\x03cOm\x00")
+    assert dns.message.from_wire(bytes(wire)).question[0].name.to_text() == (
+        "ExAmPlE.cOm."
+    )
+    # The answer to a different question is left alone.
+    dns_wire.restore_qname(wire, b"\x07example\x03org\x00")
+    assert dns.message.from_wire(bytes(wire)).question[0].name.to_text() == (
+        "ExAmPlE.cOm."
+    )
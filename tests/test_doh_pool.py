@@ -0,0 +1,119 @@
+"""Pooled DoH clients (``doh_pool``)."""
+
+import asyncio
+
+import httpcore
+import httpx
+import pytest
+
+import bootstrap
+import doh_pool
+
+URL_A = "https://a.example/dns-query"
+URL_B = "https://b.example/dns-query"
+
+
+def test_evicted_client_closes_after_its_requests():
+    async def main():
+        pool = doh_pool.DoHClientPool(max_clients=1)
+        client = pool.get(URL_A)
+        release = asyncio.Event()
+
+        async def post(url, **kwargs):
+            await release.wait()
+            return httpx.Response(
+                200, content=b"answer", request=httpx.Request("POST", url)
+            )
+
+        client.post = post
+        running = asyncio.create_task(pool.query(URL_A, b"query"))
+        await asyncio.sleep(0)
+
+        # Evicting the busy client leaves it open for the running query.
+        pool.get(URL_B)
+        await asyncio.sleep(0)
+        assert not client.is_closed
+
+        release.set()
+        assert await running == (b"answer", "warm")
+        await asyncio.sleep(0)
+        assert client.is_closed
+
+        # An idle client is closed as soon as it is evicted.
+        idle = pool.get(URL_B)
+        pool.get(URL_A)
+        await asyncio.sleep(0)
+        assert idle.is_closed
+        await pool.aclose()
+
+    asyncio.run(main())
+
+
+def test_aclose_closes_busy_clients():
+    async def main():
+        pool = doh_pool.DoHClientPool(max_clients=1)
+        client = pool.get(URL_A)
+        release = asyncio.Event()
+
+        async def post(url, **kwargs):
+            await release.wait()
+            raise httpx.ConnectError("closed")
+
+        client.post = post
+        running = asyncio.create_task(pool.query(URL_A, b"query"))
+        await asyncio.sleep(0)
+        pool.get(URL_B)
+        await pool.aclose()
+        assert client.is_closed
+
+        release.set()
+        results = await asyncio.gather(running, return_exceptions=True)
+        assert isinstance(results[0], httpx.ConnectError)
+        assert not pool.stats()["clients"]
+
+    asyncio.run(main())
+
+
+class RecordingBackend(httpcore.AsyncMockBackend):
+    def __init__(self, buffer):
+        super().__init__(buffer)
+        self.hosts = []
+
+    async def connect_tcp(self, host, port, *args, **kwargs):
+        self.hosts.append((host, port))
+        return await super().connect_tcp(host, port, *args, **kwargs)
+
+
+def test_clients_connect_through_the_bootstrap_backend(monkeypatch):
+    backend = RecordingBackend(
+        [b"HTTP/1.1 200 OK\r\n", b"Content-Length: 6\r\n", b"\r\n", b"answer"]
+    )
+    monkeypatch.setattr(bootstrap.addresses, "network_backend", backend)
+
+    async def main():
+        pool = doh_pool.DoHClientPool()
+        try:
+            return await pool.query(URL_A, b"query")
+        finally:
+            await pool.aclose()
+
+    assert asyncio.run(main()) == (b"answer", "cold")
+    assert backend.hosts == [("a.example", 443)]
+
+
+def test_backend_errors_are_httpx_errors(monkeypatch):
+    class Unreachable:
+        async def connect_tcp(self, host, port, *args, **kwargs):
+            raise httpcore.ConnectError(f"{host} is unreachable")
+
+    monkeypatch.setattr(bootstrap.addresses, "network_backend", Unreachable())
+
+    async def main():
+        pool = doh_pool.DoHClientPool()
+        try:
+            await pool.query(URL_A, b"query")
+        finally:
+            await pool.aclose()
+
+    with pytest.raises(httpx.ConnectError, match="a.example is unreachable"):
+        asyncio.run(main())
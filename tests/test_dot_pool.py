@@ -0,0 +1,96 @@
+"""Pipelined DoT/TCP connections and their pool (``dot_pool``)."""
+
+import asyncio
+import socket
+import struct
+
+import dns.message
+
+import dot_pool
+
+
+async def serve_dns():
+    """A local DNS-over-TCP server answering every query with NOERROR."""
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                query = dns.message.from_wire(await reader.readexactly(length))
+                wire = dns.message.make_response(query).to_wire()
+                writer.write(struct.pack("!H", len(wire)) + wire)
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def closed_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_closed_connections_leave_the_pool():
+    async def main():
+        server, port = await serve_dns()
+        pool = dot_pool.StreamConnectionPool(idle_timeout=0.1, tls=False)
+        query = dns.message.make_query("example.com", "A")
+
+        answers = await asyncio.gather(
+            *(pool.query("127.0.0.1", query.to_wire(), port) for _ in range(3))
+        )
+        assert sorted(state for _, state in answers) == ["cold", "warm", "warm"]
+        assert all(dns.message.from_wire(a).id == query.id for a, _ in answers)
+        assert list(pool._connections) == [("127.0.0.1", port)]
+        assert not pool._locks and not pool._lock_users
+
+        await asyncio.sleep(0.2)
+        assert not pool._connections
+
+        _, state = await pool.query("127.0.0.1", query.to_wire(), port)
+        assert state == "cold"
+        await pool.aclose()
+        assert not pool._connections
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_failed_connects_leave_no_state():
+    async def main():
+        pool = dot_pool.StreamConnectionPool(tls=False)
+        wire = dns.message.make_query("example.com", "A").to_wire()
+        results = await asyncio.gather(
+            *(pool.query("127.0.0.1", wire, closed_port(), 1.0) for _ in range(5)),
+            return_exceptions=True,
+        )
+        assert all(isinstance(r, OSError) for r in results)
+        assert not pool._connections and not pool._locks and not pool._lock_users
+
+    asyncio.run(main())
+
+
+def test_sessions_are_bounded(monkeypatch):
+    pool = dot_pool.StreamConnectionPool(max_sessions=2)
+
+    class Connection:
+        def __init__(self, key):
+            self.session = f"session of {key[0]}"
+
+        async def query(self, wire, timeout):
+            return wire
+
+    async def connection(key, timeout):
+        return Connection(key), "cold"
+
+    monkeypatch.setattr(pool, "_connection", connection)
+
+    async def main():
+        for host in ["a.example", "b.example", "a.example", "c.example"]:
+            await pool.query(host, b"\0" * 12)
+
+    asyncio.run(main())
+    assert list(pool._sessions) == [("a.example", 853), ("c.example", 853)]
@@ -0,0 +1,47 @@
+"""Cache partitions of forwarded queries (``edns.EcsPolicy.prepare``)."""
+
+import dns.edns
+import dns.flags
+import dns.message
+import pytest
+
+import edns
+
+CLIENT = "203.0.113.7"
+
+
+def make_query(ad: bool, use_edns: bool = True, ecs: bool = False) -> bytes:
+    options = []
+    if ecs:
+        options.append(dns.edns.ECSOption("198.51.100.0", 24))
+    query = dns.message.make_query(
+        "example.com", "A", use_edns=0 if use_edns else None, options=options
+    )
+    if ad:
+        query.flags |= dns.flags.AD
+    else:
+        query.flags &= ~dns.flags.AD
+    return query.to_wire()
+
+
+@pytest.mark.parametrize("mode", edns.MODES)
+@pytest.mark.parametrize("use_edns", [False, True])
+@pytest.mark.parametrize("ecs", [False, True])
+def test_ad_bit_splits_partitions(mode, use_edns, ecs):
+    if ecs and not use_edns:
+        pytest.skip("ECS needs EDNS")
+    policy = edns.EcsPolicy(mode)
+    with_ad = policy.prepare(make_query(True, use_edns, ecs), CLIENT)
+    without_ad = policy.prepare(make_query(False, use_edns, ecs), CLIENT)
+    assert with_ad.partition != without_ad.partition
+    if with_ad.shared_partition is not None:
+        assert with_ad.shared_partition != without_ad.shared_partition
+        assert with_ad.shared_partition != without_ad.partition
+
+
+def test_same_flags_share_partition():
+    policy = edns.EcsPolicy(edns.SYNTHESIZE)
+    first = policy.prepare(make_query(True), CLIENT)
+    second = policy.prepare(make_query(True), "203.0.113.99")
+    assert first.partition == second.partition
+    assert first.shared_partition == second.shared_partition
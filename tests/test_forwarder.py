@@ -0,0 +1,108 @@
+"""Racing the default upstreams (``forwarder.race``), exchanges faked."""
+
+import asyncio
+
+import dns.message
+import dns.rcode
+import pytest
+
+import forwarder
+import upstreams
+
+QUERY = dns.message.make_query("example.com", "A")
+
+
+def server(name: str) -> dict:
+    return {"type": "udp", "server": name}
+
+
+class Upstreams:
+    """Replaces ``forwarder.forward_wire`` with per-server delays and rcodes.
+
+    A server set to an exception raises it instead of answering.
+    """
+
+    def __init__(self, **behaviour):
+        self.behaviour = behaviour
+        self.started = []
+        self.cancelled = []
+
+    async def __call__(self, wire, server_type, server, proxy=None, timeout=5.0):
+        self.started.append(server)
+        delay, outcome = self.behaviour[server]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(server)
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = dns.message.make_response(dns.message.from_wire(wire))
+        response.set_rcode(outcome)
+        return response.to_wire()
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    def install(**behaviour):
+        fake = Upstreams(**behaviour)
+        monkeypatch.setattr(forwarder, "forward_wire", fake)
+        return fake
+
+    return install
+
+
+def race(servers, **options) -> dns.message.Message:
+    return dns.message.from_wire(
+        asyncio.run(forwarder.race(QUERY.to_wire(), servers, **options))
+    )
+
+
+def test_fastest_answer_wins(fake):
+    upstream = fake(a=(0.2, dns.rcode.NOERROR), b=(0.01, dns.rcode.NOERROR))
+    health = upstreams.UpstreamHealth()
+    answer = race([server("a"), server("b")], fanout=2, health=health)
+    assert answer.id == QUERY.id
+    assert upstream.started == ["a", "b"]
+    assert upstream.cancelled == ["a"]
+    # The abandoned attempt still tells how slow "a" is at least.
+    assert health.snapshot("udp://a")["ewma_latency_ms"] > 0
+    assert health.snapshot("udp://a")["failures"] == 0
+
+
+def test_failures_bring_in_the_next_server(fake):
+    upstream = fake(
+        a=(0, ConnectionError("refused")),
+        b=(0, dns.rcode.SERVFAIL),
+        c=(0, dns.rcode.NXDOMAIN),
+    )
+    answer = race([server("a"), server("b"), server("c")], fanout=1, hedge_delay=10)
+    assert answer.rcode() == dns.rcode.NXDOMAIN
+    assert upstream.started == ["a", "b", "c"]
+
+
+def test_slow_server_is_hedged(fake):
+    upstream = fake(a=(1.0, dns.rcode.NOERROR), b=(0, dns.rcode.NOERROR))
+    race([server("a"), server("b")], fanout=1, hedge_delay=0.05)
+    assert upstream.started == ["a", "b"]
+    assert upstream.cancelled == ["a"]
+
+
+def test_last_error_when_every_server_fails(fake):
+    fake(a=(0, ConnectionError("refused")), b=(0.05, dns.rcode.REFUSED))
+    with pytest.raises(forwarder.UpstreamError, match="udp://b answered REFUSED"):
+        race([server("a"), server("b")], fanout=2)
+
+
+def test_open_circuits_are_skipped(fake):
+    upstream = fake(a=(0, dns.rcode.NOERROR), b=(0, dns.rcode.NOERROR))
+    health = upstreams.UpstreamHealth(failure_threshold=1)
+    health.record_failure("udp://a", "down")
+    race([server("a"), server("b")], fanout=2, health=health)
+    assert upstream.started == ["b"]
+
+    # With every circuit open, the best scored server is still tried.
+    health.record_failure("udp://b", "down")
+    upstream.started.clear()
+    race([server("a"), server("b")], fanout=1, health=health)
+    assert upstream.started == ["b"]
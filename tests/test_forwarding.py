@@ -0,0 +1,90 @@
+"""The DoH forwarder's answer path (``app.forward_dns_query``), upstreams faked."""
+
+import asyncio
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+import app
+import dns_cache
+import singleflight
+
+
+class Upstream:
+    """Replaces ``forwarder.race``: answers queries or fails on demand."""
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self, wire, servers, proxy=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise ConnectionError("upstream down")
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        response.answer.append(
+            dns.rrset.from_text(query.question[0].name, 60, "IN", "A", "192.0.2.1")
+        )
+        return response.to_wire()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = Upstream()
+    monkeypatch.setattr(app.forwarder, "race", upstream)
+    monkeypatch.setattr(app, "response_cache", dns_cache.DNSCache(stale_ttl=600))
+    monkeypatch.setattr(app, "upstream_flights", singleflight.SingleFlight())
+    return upstream
+
+
+def ask(qname: str = "example.com") -> tuple[dns.message.Message, bytes]:
+    query = dns.message.make_query(qname, "A")
+    return query, asyncio.run(app.forward_dns_query(query.to_wire()))
+
+
+def test_stale_answer_when_upstreams_fail(upstream):
+    ask()
+    # Expire the entry without waiting for its TTL.
+    for entry in app.response_cache._entries.values():
+        entry.expires_at -= 120
+        entry.stored_at -= 120
+    upstream.fail = True
+
+    query, wire = ask()
+    answer = dns.message.from_wire(wire)
+    assert answer.id == query.id
+    assert answer.rcode() == dns.rcode.NOERROR
+    assert answer.answer[0].ttl == app.response_cache.stale_answer_ttl
+    assert upstream.calls == 2
+
+
+def test_servfail_without_stale_answer(upstream):
+    upstream.fail = True
+    query, wire = ask()
+    answer = dns.message.from_wire(wire)
+    assert answer.id == query.id
+    assert answer.rcode() == dns.rcode.SERVFAIL
+
+
+def test_coalesced_answers_match_each_query(upstream, monkeypatch):
+    monkeypatch.setattr(app.config, "CACHE_ENABLED", False)
+    queries = [
+        dns.message.make_query(qname, "A")
+        for qname in ("example.com", "EXAMPLE.com", "eXaMpLe.CoM")
+    ]
+
+    async def main():
+        return await asyncio.gather(
+            *(app.forward_dns_query(query.to_wire()) for query in queries)
+        )
+
+    answers = [dns.message.from_wire(wire) for wire in asyncio.run(main())]
+    assert upstream.calls == 1
+    for query, answer in zip(queries, answers):
+        assert answer.id == query.id
+        assert answer.question[0].name.to_text() == query.question[0].name.to_text()
+        assert answer.answer[0][0].address == "192.0.2.1"
@@ -0,0 +1,191 @@
+"""Latency history: rollups, the lease and the check scheduler (``history``)."""
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import history
+
+CHECK = history.Check("udp://192.0.2.1", "example.com", "A", 0.01)
+KEY = "udp://192.0.2.1"
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history.sqlite")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_parse_checks():
+    checks = history.parse_checks(
+        "udp://8.8.8.8 example.com aaaa 30; 1.1.1.1 example.org\n", 60.0
+    )
+    assert checks == [
+        history.Check("udp://8.8.8.8", "example.com", "AAAA", 30.0),
+        history.Check("1.1.1.1", "example.org", "A", 60.0),
+    ]
+    with pytest.raises(ValueError):
+        history.parse_checks("udp://8.8.8.8")
+    with pytest.raises(ValueError):
+        history.parse_checks("udp://8.8.8.8 example.com A 0")
+
+
+def test_rollups(path):
+    async def main():
+        store = history.HistoryStore(path)
+        base = (time.time() // 3600 - 1) * 3600
+        store.record(CHECK, KEY, 10.0, True, ts=base + 1)
+        store.record(CHECK, KEY, 30.0, True, ts=base + 59)
+        store.record(CHECK, KEY, None, False, ts=base + 61)
+        store.record(CHECK, KEY, 20.0, True, ts=base + 3601)
+        assert await store.flush() == 4
+        assert await store.flush() == 0
+
+        minute = await store.query(
+            KEY, "example.com", "a", base, base + 7200, "minute", 1000
+        )
+        assert minute["step_seconds"] == 60
+        assert [(p["t"], p["count"], p["errors"]) for p in minute["points"]] == [
+            (base, 2, 0),
+            (base + 60, 1, 1),
+            (base + 3600, 1, 0),
+        ]
+        first = minute["points"][0]
+        assert (first["avg_ms"], first["min_ms"], first["max_ms"]) == (20.0, 10.0, 30.0)
+        assert minute["points"][1]["avg_ms"] is None
+
+        hour = await store.query(KEY, "example.com", "A", base, base + 7200, "hour")
+        assert [(p["count"], p["errors"], p["avg_ms"]) for p in hour["points"]] == [
+            (3, 1, 20.0),
+            (1, 0, 20.0),
+        ]
+
+        raw = await store.query(KEY, "example.com", "A", base, base + 7200, "raw", 2)
+        assert raw["step_seconds"] == 3600
+        assert sum(p["count"] for p in raw["points"]) == 4
+
+        with pytest.raises(ValueError):
+            await store.query(KEY, "example.com", "A", base, base + 60, "week")
+
+        series = await store.series()
+        assert series == [
+            {
+                "upstream": KEY,
+                "domain": "example.com",
+                "type": "A",
+                "start": base,
+                "end": base + 7200,
+            }
+        ]
+        await store.close()
+
+    run(main())
+
+
+def test_prune(path):
+    async def main():
+        store = history.HistoryStore(path, raw_retention=60, minute_retention=3600)
+        now = time.time()
+        store.record(CHECK, KEY, 5.0, True, ts=now - 7200)
+        store.record(CHECK, KEY, 5.0, True, ts=now)
+        await store.flush()
+        await store.prune(now)
+        raw = await store.query(KEY, "example.com", "A", now - 86400, now + 1, "raw")
+        minute = await store.query(
+            KEY, "example.com", "A", now - 86400, now + 1, "minute", 10_000
+        )
+        hour = await store.query(KEY, "example.com", "A", now - 86400, now + 1, "hour")
+        assert sum(p["count"] for p in raw["points"]) == 1
+        assert sum(p["count"] for p in minute["points"]) == 1
+        assert sum(p["count"] for p in hour["points"]) == 2
+        await store.close()
+
+    run(main())
+
+
+def test_lease(path):
+    async def main():
+        first = history.HistoryStore(path)
+        second = history.HistoryStore(path)
+        assert await first.acquire_lease("a", 0.2)
+        assert not await second.acquire_lease("b", 0.2)
+        assert await first.acquire_lease("a", 0.2)
+        await asyncio.sleep(0.25)
+        assert await second.acquire_lease("b", 0.2)
+        await first.close()
+        await second.close()
+
+    run(main())
+
+
+def test_failed_flush_keeps_samples(path, monkeypatch):
+    async def main():
+        store = history.HistoryStore(path)
+        store.record(CHECK, KEY, 5.0, True)
+
+        def locked(rows):
+            raise sqlite3.OperationalError("database is locked")
+
+        monkeypatch.setattr(store, "_flush", locked)
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        monkeypatch.undo()
+        assert await store.flush() == 1
+        await store.close()
+
+    run(main())
+
+
+def test_run_checks_survives_errors(path):
+    calls = 0
+
+    async def probe(check):
+        nonlocal calls
+        calls += 1
+        if calls % 2:
+            raise ValueError("Invalid port 'xx'")
+        return KEY, 4.0, True
+
+    async def main():
+        store = history.HistoryStore(path)
+        flushes = 0
+        original = store._flush
+
+        def flaky_flush(rows):
+            nonlocal flushes
+            flushes += 1
+            if flushes == 1:
+                raise sqlite3.OperationalError("database is locked")
+            original(rows)
+
+        store._flush = flaky_flush
+        task = asyncio.create_task(
+            history.run_checks(store, [CHECK], probe, flush_interval=0.05)
+        )
+        await asyncio.sleep(0.4)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await store.close()
+
+        store = history.HistoryStore(path)
+        now = time.time()
+        points = (await store.query(KEY, "example.com", "A", now - 60, now, "raw"))[
+            "points"
+        ]
+        count = sum(p["count"] for p in points)
+        errors = sum(p["errors"] for p in points)
+        await store.close()
+        return count, errors
+
+    count, errors = run(main())
+    # The check kept running past the failed probes and the failed flush,
+    # and every result, failures included, reached the database.
+    assert calls > 4
+    assert count == calls
+    assert errors == (calls + 1) // 2
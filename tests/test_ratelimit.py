@@ -0,0 +1,141 @@
+"""Token buckets and upstream admission control (``ratelimit``)."""
+
+import asyncio
+import time
+
+import pytest
+
+import ratelimit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_token_bucket(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    bucket = ratelimit.TokenBucket(rate=2, burst=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+    clock.now += 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+    clock.now += 10
+    bucket.refund()
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_acquire_waits_for_a_token():
+    async def main():
+        bucket = ratelimit.TokenBucket(rate=20, burst=1)
+        await bucket.acquire()
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+
+    assert 0.04 <= asyncio.run(main()) < 0.5
+
+
+def test_in_flight_cap_and_backlog():
+    async def main():
+        scheduler = ratelimit.UpstreamScheduler(
+            max_in_flight=1, max_backlog=1, max_wait=1.0
+        )
+        release = asyncio.Event()
+        order = []
+
+        async def query(name):
+            async with scheduler.slot("udp://192.0.2.1"):
+                order.append(name)
+                await release.wait()
+
+        first = asyncio.create_task(query("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(query("second"))
+        await asyncio.sleep(0)
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 1)
+
+        # The backlog is full, so a third query is refused at once.
+        with pytest.raises(ratelimit.Overloaded, match="Too many queued"):
+            await query("third")
+
+        release.set()
+        await asyncio.gather(first, second)
+        assert order == ["first", "second"]
+        assert (scheduler.in_flight, scheduler.waiting, scheduler.refused) == (
+            0,
+            0,
+            1,
+        )
+
+    asyncio.run(main())
+
+
+def test_queued_query_times_out():
+    async def main():
+        scheduler = ratelimit.UpstreamScheduler(max_in_flight=1, max_wait=0.05)
+        async with scheduler.slot("udp://192.0.2.1"):
+            with pytest.raises(ratelimit.Overloaded, match="Waited over"):
+                async with scheduler.slot("udp://192.0.2.2"):
+                    pass
+        assert scheduler.waiting == 0
+
+    asyncio.run(main())
+
+
+async def admitted(scheduler, key, count, qps=None, burst=None) -> int:
+    """How many of ``count`` back-to-back queries get a slot."""
+    started = 0
+    for _ in range(count):
+        try:
+            async with scheduler.slot(key, qps, burst):
+                started += 1
+        except ratelimit.Overloaded:
+            pass
+    return started
+
+
+def test_query_limits_only_tighten():
+    async def main():
+        scheduler = ratelimit.UpstreamScheduler(max_wait=0.01)
+        scheduler.configure("udp://192.0.2.1", qps=1, burst=2)
+        # A looser per-query limit does not lift the upstream's own.
+        loose = await admitted(scheduler, "udp://192.0.2.1", 5, qps=100, burst=100)
+        # A stricter one applies on top of the default of no limit.
+        strict = await admitted(scheduler, "udp://192.0.2.2", 5, qps=1, burst=1)
+        unlimited = await admitted(scheduler, "udp://192.0.2.3", 5)
+        return loose, strict, unlimited
+
+    assert asyncio.run(main()) == (2, 1, 5)
+
+
+def test_default_limit_applies_to_unconfigured_upstreams():
+    async def main():
+        scheduler = ratelimit.UpstreamScheduler(
+            max_wait=0.01, default_qps=1, default_burst=3
+        )
+        scheduler.configure("udp://192.0.2.1", qps=0)
+        return (
+            await admitted(scheduler, "udp://192.0.2.1", 5),
+            await admitted(scheduler, "udp://192.0.2.2", 5),
+        )
+
+    assert asyncio.run(main()) == (5, 3)
+
+
+def test_buckets_are_bounded(monkeypatch):
+    monkeypatch.setattr(ratelimit.UpstreamScheduler, "MAX_BUCKETS", 2)
+
+    async def main():
+        scheduler = ratelimit.UpstreamScheduler(default_qps=10)
+        for i in range(5):
+            await admitted(scheduler, f"udp://192.0.2.{i}", 1)
+        return scheduler.stats()["rate_limited_upstreams"]
+
+    assert asyncio.run(main()) == 2
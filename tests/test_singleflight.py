@@ -0,0 +1,74 @@
+"""Coalescing of concurrent identical calls (``singleflight``)."""
+
+import asyncio
+
+import pytest
+
+import singleflight
+
+
+def test_concurrent_callers_share_one_call():
+    calls = 0
+
+    async def lookup():
+        nonlocal calls
+        calls += 1
+        number = calls
+        await asyncio.sleep(0.01)
+        return number
+
+    async def main():
+        flights = singleflight.SingleFlight()
+        results = await asyncio.gather(
+            *(flights.do("a", lookup) for _ in range(5)), flights.do("b", lookup)
+        )
+        assert len(flights) == 0
+        # A later call starts a new lookup.
+        return results, await flights.do("a", lookup)
+
+    results, later = asyncio.run(main())
+    assert sorted(results) == [
+        (1, False),
+        (1, True),
+        (1, True),
+        (1, True),
+        (1, True),
+        (2, False),
+    ]
+    assert later == (3, False)
+
+
+def test_errors_reach_every_caller():
+    async def lookup():
+        await asyncio.sleep(0.01)
+        raise ConnectionError("upstream down")
+
+    async def main():
+        flights = singleflight.SingleFlight()
+        return await asyncio.gather(
+            *(flights.do("a", lookup) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+def test_cancelled_caller_does_not_cancel_the_call():
+    async def main():
+        flights = singleflight.SingleFlight()
+        release = asyncio.Event()
+
+        async def lookup():
+            await release.wait()
+            return "answer"
+
+        first = asyncio.create_task(flights.do("a", lookup))
+        second = asyncio.create_task(flights.do("a", lookup))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        return await second
+
+    assert asyncio.run(main()) == ("answer", True)
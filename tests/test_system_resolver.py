@@ -0,0 +1,29 @@
+"""The shared system resolver behind the ``local`` upstream (``system_resolver``)."""
+
+import os
+
+import system_resolver
+
+
+def test_reloads_when_config_changes(tmp_path):
+    path = tmp_path / "resolv.conf"
+    path.write_text("nameserver 192.0.2.1\n")
+    resolver = system_resolver.SystemResolver(str(path), check_interval=0)
+    assert resolver.nameservers() == [("192.0.2.1", 53)]
+    assert resolver.nameservers() == [("192.0.2.1", 53)]
+    assert resolver.reloads == 1
+
+    path.write_text("nameserver 192.0.2.2\n")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    stats = resolver.stats()
+    assert stats["available"] and stats["nameservers"] == ["192.0.2.2"]
+    assert stats["reloads"] == 2
+
+
+def test_stats_without_config(tmp_path):
+    resolver = system_resolver.SystemResolver(str(tmp_path / "missing"))
+    stats = resolver.stats()
+    assert not stats["available"]
+    assert stats["nameservers"] == []
+    assert stats["error"]
@@ -0,0 +1,114 @@
+"""Server strings and upstream health (``upstreams``)."""
+
+import pytest
+
+import upstreams
+
+
+@pytest.mark.parametrize(
+    "server, expected",
+    [
+        ("8.8.8.8", ("8.8.8.8", 53)),
+        ("127.0.0.1:5353", ("127.0.0.1", 5353)),
+        ("[2001:db8::1]:5353", ("2001:db8::1", 5353)),
+        ("[2001:db8::1]", ("2001:db8::1", 53)),
+        ("2001:db8::1", ("2001:db8::1", 53)),
+    ],
+)
+def test_split_host_port(server, expected):
+    assert upstreams.split_host_port(server, 53) == expected
+
+
+@pytest.mark.parametrize(
+    "server", ["127.0.0.1:xx", "127.0.0.1:", "127.0.0.1:0", "[::1]:70000"]
+)
+def test_split_host_port_rejects_malformed_port(server):
+    with pytest.raises(ValueError, match="Invalid port"):
+        upstreams.split_host_port(server, 53)
+
+
+def test_check_server():
+    upstreams.check_server({"type": "doh", "server": "https://dns.example:x/q"})
+    with pytest.raises(ValueError):
+        upstreams.check_server({"type": "dot", "server": "127.0.0.1:abc"})
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstreams, "time", clock)
+    return clock
+
+
+KEY = "udp://192.0.2.1"
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    health = upstreams.UpstreamHealth(failure_threshold=3, cooldown=30)
+    health.record_failure(KEY, "timeout")
+    health.record_failure(KEY, "timeout")
+    health.record_success(KEY, 20.0)
+    health.record_failure(KEY, "timeout")
+    health.record_failure(KEY, "timeout")
+    assert health.allow(KEY)
+
+    health.record_failure(KEY, "timeout")
+    assert health.snapshot(KEY)["state"] == upstreams.OPEN
+    assert not health.allow(KEY)
+    clock.now += 29
+    assert not health.is_available(KEY)
+
+
+def test_half_open_lets_one_probe_through(clock):
+    health = upstreams.UpstreamHealth(failure_threshold=1, cooldown=30)
+    health.record_failure(KEY, "timeout")
+    clock.now += 30
+    assert health.allow(KEY)
+    assert health.snapshot(KEY)["state"] == upstreams.HALF_OPEN
+    assert not health.allow(KEY)
+
+    # A probe that was never sent gives its slot back.
+    health.release_probe(KEY)
+    assert health.allow(KEY)
+
+    # A failed probe re-opens the circuit for another cooldown.
+    health.record_failure(KEY, "timeout")
+    assert health.snapshot(KEY)["state"] == upstreams.OPEN
+    assert not health.allow(KEY)
+    clock.now += 30
+
+    # A successful one closes it.
+    assert health.allow(KEY)
+    health.record_success(KEY, 20.0)
+    assert health.snapshot(KEY)["state"] == upstreams.CLOSED
+    assert health.allow(KEY) and health.allow(KEY)
+
+
+def test_ordered_by_score_open_circuits_last(clock):
+    health = upstreams.UpstreamHealth(failure_threshold=1)
+    servers = [{"type": "udp", "server": f"192.0.2.{i}"} for i in range(1, 5)]
+    health.record_failure("udp://192.0.2.1", "timeout")
+    health.record_success("udp://192.0.2.2", 80.0)
+    health.record_success("udp://192.0.2.3", 10.0)
+    ordered = [s["server"] for s in health.ordered(servers)]
+    # No samples yet scores 0, so 192.0.2.4 gets tried first.
+    assert ordered == ["192.0.2.4", "192.0.2.3", "192.0.2.2", "192.0.2.1"]
+
+
+def test_unconfigured_upstreams_are_bounded(monkeypatch):
+    monkeypatch.setattr(upstreams, "MAX_OTHER", 2)
+    health = upstreams.UpstreamHealth()
+    for i in range(1, 4):
+        health.record_success(f"udp://198.51.100.{i}", 10.0)
+    assert health.keys() == ["udp://198.51.100.2", "udp://198.51.100.3"]
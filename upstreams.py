@@ -0,0 +1,380 @@
+"""Per-upstream health: rolling latency, error rate and circuit breakers."""
+
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+import shared_state
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Upstreams named in requests rather than configured ones, whose health is
+# kept (in this worker only) for the most recently used this many.
+MAX_OTHER = 1024
+# Metric label of every upstream that is not configured.
+OTHER = "other"
+
+_configured: set[str] = set()
+
+
+def upstream_key(server: dict) -> str:
+    """Return the ``type://server`` string identifying a server entry."""
+    return f"{server['type']}://{server['server']}"
+
+
+def configure(servers: Iterable[dict]) -> None:
+    """Mark the configured upstreams.
+
+    Only these get metric labels and health records of their own in the
+    shared store; any client can name other upstreams in a request.
+    """
+    _configured.update(upstream_key(s) for s in servers)
+
+
+def is_configured(key: str) -> bool:
+    return key in _configured
+
+
+def metric_label(key: str) -> str:
+    """``key`` for a configured upstream, ``OTHER`` for the rest."""
+    return key if key in _configured else OTHER
+
+
+def _port(text: str) -> int:
+    if not text.isdigit() or not 0 < int(text) < 65536:
+        raise ValueError(f"Invalid port {text!r}")
+    return int(text)
+
+
+def split_host_port(server: str, default_port: int) -> tuple[str, int]:
+    """Split ``host``, ``host:port``, ``[v6]`` or ``[v6]:port``.
+
+    A bare IPv6 address (more than one colon) has no port. Raises
+    ValueError for a port that is not a number from 1 to 65535.
+    """
+    if server.startswith("["):
+        host, _, rest = server[1:].partition("]")
+        return host, _port(rest[1:]) if rest.startswith(":") else default_port
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, _port(port)
+    return server, default_port
+
+
+def check_server(server: dict) -> None:
+    """Raise ValueError if a parsed UDP or DoT server has a malformed port."""
+    if server["type"] in ("udp", "dot"):
+        split_host_port(server["server"], 0)
+
+
+def split_limits(server: str) -> tuple[str, dict]:
+    """Split a ``#qps=..&burst=..`` rate limit suffix off a server string.
+
+    Unknown options and malformed values are ignored.
+    """
+    server, _, options = server.partition("#")
+    limits = {}
+    for option in options.split("&"):
+        name, _, value = option.partition("=")
+        if name in ("qps", "burst"):
+            try:
+                limits[name] = float(value)
+            except ValueError:
+                pass
+    return server, limits
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.ewma_latency_ms: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.state = CLOSED
+        # Wall-clock times, so they mean the same in every worker process.
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+        self.last_error: Optional[str] = None
+        self.last_update: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "ewma_latency_ms": (
+                round(self.ewma_latency_ms, 2)
+                if self.ewma_latency_ms is not None
+                else None
+            ),
+            "error_rate": round(self.error_rate, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+    def to_record(self) -> dict:
+        """Every field, for the shared store."""
+        return dict(vars(self))
+
+    @classmethod
+    def from_record(cls, record: dict) -> "UpstreamStats":
+        stats = cls()
+        vars(stats).update(record)
+        return stats
+
+
+class UpstreamHealth:
+    """Health bookkeeping for every upstream the app talks to.
+
+    Latency and error rate are exponentially weighted moving averages.
+    After ``failure_threshold`` consecutive failures the upstream's circuit
+    opens and it is skipped for ``cooldown`` seconds; then a single probe
+    is let through (half-open) and its outcome closes or re-opens the
+    circuit.
+
+    Updates apply to an in-memory view straight away. With a ``shared``
+    store, those of configured upstreams are also queued, and every ``refresh_interval`` seconds the
+    queue is replayed onto the store's records in one transaction on the
+    store's writer thread, which then returns the records of every worker
+    as the new view. The event loop never waits for the store, so other
+    workers' updates (and a half-open probe claimed elsewhere) are seen
+    up to ``refresh_interval`` late. Other upstreams are tracked in this
+    worker only, for the ``MAX_OTHER`` most recently used.
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.3,
+        failure_penalty_ms: float = 5000.0,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        shared: Optional[shared_state.SharedStore] = None,
+        refresh_interval: float = 0.5,
+    ):
+        self.alpha = alpha
+        self.failure_penalty_ms = failure_penalty_ms
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.shared = shared
+        self.refresh_interval = refresh_interval
+        self._refreshed_at: Optional[float] = None
+        self._stats: dict[str, UpstreamStats] = {}
+        self._other: "OrderedDict[str, UpstreamStats]" = OrderedDict()
+        # Updates not yet in the shared store: (apply, args) per key, in order.
+        self._pending: dict[str, list[tuple[Callable, tuple]]] = {}
+        self._syncing: Optional[asyncio.Future] = None
+
+    def _refresh(self) -> None:
+        """Start writing queued updates and reading the other workers' ones."""
+        if self.shared is None or self._syncing is not None:
+            return
+        now = time.monotonic()
+        if self._refreshed_at is not None and (
+            now - self._refreshed_at < self.refresh_interval
+        ):
+            return
+        self._refreshed_at = now
+        pending, self._pending = self._pending, {}
+        future = self.shared.health_sync(
+            {
+                key: functools.partial(self._replay, events)
+                for key, events in pending.items()
+            }
+        )
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not serving (e.g. a script): just wait for it.
+            self._synced(future.result())
+            return
+        self._syncing = asyncio.wrap_future(future, loop=loop)
+        self._syncing.add_done_callback(lambda f: self._sync_done(f, pending))
+
+    def _replay(self, events: list, record: Optional[dict]) -> dict:
+        """Apply queued ``events`` to a stored record (on the writer thread)."""
+        stats = UpstreamStats.from_record(record) if record else UpstreamStats()
+        self._replay_onto(stats, events)
+        return stats.to_record()
+
+    def _sync_done(self, future: asyncio.Future, pending: dict) -> None:
+        self._syncing = None
+        if future.cancelled() or future.exception() is not None:
+            # Keep the updates for the next attempt, ahead of newer ones.
+            for key, events in pending.items():
+                self._pending[key] = events + self._pending.get(key, [])
+            return
+        self._synced(future.result())
+
+    def _synced(self, records: dict[str, dict]) -> None:
+        stats = {
+            key: UpstreamStats.from_record(r)
+            for key, r in records.items()
+            if key in _configured
+        }
+        # Updates made while the sync ran are not in the store yet.
+        for key, events in self._pending.items():
+            self._replay_onto(stats.setdefault(key, UpstreamStats()), events)
+        self._stats = stats
+
+    @staticmethod
+    def _replay_onto(stats: UpstreamStats, events: list) -> None:
+        for apply, args in events:
+            apply(stats, *args)
+
+    def _get(self, key: str) -> Optional[UpstreamStats]:
+        if key in _configured:
+            return self._stats.get(key)
+        return self._other.get(key)
+
+    def _update(self, key: str, apply: Callable, *args) -> UpstreamStats:
+        """Run ``apply(stats, *args)`` on ``key``, queued for the shared store."""
+        if key in _configured:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = UpstreamStats()
+            if self.shared is not None:
+                self._pending.setdefault(key, []).append((apply, args))
+        else:
+            stats = self._other.get(key)
+            if stats is None:
+                stats = self._other[key] = UpstreamStats()
+                if len(self._other) > MAX_OTHER:
+                    self._other.popitem(last=False)
+            self._other.move_to_end(key)
+        apply(stats, *args)
+        return stats
+
+    def _update_latency(self, stats: UpstreamStats, latency_ms: float) -> None:
+        if stats.ewma_latency_ms is None:
+            stats.ewma_latency_ms = latency_ms
+        else:
+            stats.ewma_latency_ms += self.alpha * (latency_ms - stats.ewma_latency_ms)
+        stats.last_update = time.time()
+
+    def _apply_success(
+        self, stats: UpstreamStats, latency_ms: float, now: float
+    ) -> None:
+        self._update_latency(stats, latency_ms)
+        stats.error_rate -= self.alpha * stats.error_rate
+        stats.successes += 1
+        if stats.opened_at is not None and now < stats.opened_at:
+            # Replayed after another worker opened the circuit: too old to
+            # close it.
+            return
+        stats.consecutive_failures = 0
+        stats.state = CLOSED
+        stats.opened_at = None
+        stats.probe_in_flight = False
+
+    def _apply_failure(
+        self, stats: UpstreamStats, error: Optional[str], now: float
+    ) -> None:
+        self._update_latency(stats, self.failure_penalty_ms)
+        stats.error_rate += self.alpha * (1.0 - stats.error_rate)
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        stats.last_error = error
+        stats.probe_in_flight = False
+        if stats.state == HALF_OPEN or (
+            stats.consecutive_failures >= self.failure_threshold
+        ):
+            stats.state = OPEN
+            stats.opened_at = now
+
+    def _apply_cancelled(self, stats: UpstreamStats, elapsed_ms: float) -> None:
+        stats.probe_in_flight = False
+        if stats.ewma_latency_ms is None or elapsed_ms > stats.ewma_latency_ms:
+            self._update_latency(stats, elapsed_ms)
+
+    @staticmethod
+    def _apply_release(stats: UpstreamStats) -> None:
+        stats.probe_in_flight = False
+
+    def _apply_claim(self, stats: UpstreamStats, now: float) -> None:
+        if self._available(stats, now) and stats.state != CLOSED:
+            stats.state = HALF_OPEN
+            stats.probe_in_flight = True
+
+    def record_success(self, key: str, latency_ms: float) -> None:
+        self._update(key, self._apply_success, latency_ms, time.time())
+
+    def record_failure(self, key: str, error: Optional[str] = None) -> None:
+        self._update(key, self._apply_failure, error, time.time())
+
+    def record_cancelled(self, key: str, elapsed_ms: float) -> None:
+        """Record an attempt abandoned after ``elapsed_ms`` because another won.
+
+        The true latency is at least ``elapsed_ms``, so it only ever pushes
+        the average up.
+        """
+        self._update(key, self._apply_cancelled, elapsed_ms)
+
+    def release_probe(self, key: str) -> None:
+        """Give back the probe slot claimed by ``allow`` when no query was sent."""
+        stats = self._get(key)
+        if stats is None or not stats.probe_in_flight:
+            return
+        self._update(key, self._apply_release)
+
+    def _available(self, stats: Optional[UpstreamStats], now: float) -> bool:
+        if stats is None or stats.state == CLOSED:
+            return True
+        if stats.probe_in_flight:
+            return False
+        return now - stats.opened_at >= self.cooldown
+
+    def is_available(self, key: str) -> bool:
+        """Whether ``allow(key)`` would let a query through (no side effects)."""
+        self._refresh()
+        return self._available(self._get(key), time.time())
+
+    def allow(self, key: str) -> bool:
+        """Check the circuit before querying ``key``.
+
+        Moves an open circuit whose cooldown has elapsed to half-open and
+        claims its single probe slot.
+        """
+        if not self.is_available(key):
+            return False
+        stats = self._get(key)
+        if stats is None or stats.state == CLOSED:
+            return True
+        # Replayed on the stored record too: if another worker claimed the
+        # probe first, its record stays half-open with the probe in flight.
+        self._update(key, self._apply_claim, time.time())
+        return True
+
+    def score(self, key: str) -> float:
+        """Lower is better. Upstreams without samples score 0 so they get tried."""
+        self._refresh()
+        stats = self._get(key)
+        if stats is None or stats.ewma_latency_ms is None:
+            return 0.0
+        return stats.ewma_latency_ms + stats.error_rate * self.failure_penalty_ms
+
+    def ordered(self, servers: Iterable[dict]) -> list[dict]:
+        """Sort server entries by score, unavailable circuits last.
+
+        Ties keep the configured order.
+        """
+        return sorted(
+            servers,
+            key=lambda s: (
+                not self.is_available(upstream_key(s)),
+                self.score(upstream_key(s)),
+            ),
+        )
+
+    def snapshot(self, key: str) -> dict:
+        self._refresh()
+        stats = self._get(key) or UpstreamStats()
+        return {**stats.to_dict(), "score": round(self.score(key), 2)}
+
+    def keys(self) -> list[str]:
+        self._refresh()
+        return [*self._stats, *self._other]